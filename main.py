@@ -30,6 +30,7 @@ from src.config.Redis import close_redis_pool, get_redis_client, init_redis_pool
 from src.models.user import User  # 导入 User 模型
 from src.service.knowledgeSev import load_all_knowledge_bases_to_cache
 from src.utils.agent_mcp import get_mcp_agent
+from src.utils.llm_modle import close_llm_clients
 from src.utils.pwdHash import get_password_hash  # 导入密码哈希函数
 
 # 设置简单的日志记录
@@ -85,6 +86,8 @@ async def lifespan(app: FastAPI):
     yield
 
     # 应用关闭时执行清理
+    logger.info("应用程序关闭：正在关闭 LLM 客户端连接池...")
+    await close_llm_clients()
     logger.info("应用程序关闭：正在关闭 Redis 连接池...")
     await close_redis_pool()
     logger.info("Redis 连接池已关闭。")
@@ -114,6 +117,7 @@ from src.router.assistantRouter import AssistantRouter
 from src.router.auth import AuthRouter
 from src.router.chatRouter import ChatRouter
 from src.router.knowledgeRouter import knowledgeRouter
+from src.router.metricsRouter import MetricsRouter
 from src.router.sessionRouter import SessionRouter
 from src.router.userRouter import UserRouter
 
@@ -123,6 +127,7 @@ app.include_router(router=ChatRouter, prefix="/chat", tags=["chat"])
 app.include_router(router=knowledgeRouter, prefix="/knowledge", tags=["knowledge"])
 app.include_router(router=SessionRouter, prefix="/session", tags=["session"])
 app.include_router(router=AssistantRouter, prefix="/assistant", tags=["assistant"])
+app.include_router(router=MetricsRouter, prefix="/metrics", tags=["metrics"])
 
 
 @app.post("/query")
@@ -9,6 +9,7 @@ class Assistant(Document):
     username: str  # 所属用户
     prompt: str | None = None  # 助手所用提示词模板
     knowledge_Id: str | None = None  # 助手指定知识库
+    extra_knowledge_Ids: list[str] = []  # 与 knowledge_Id 联合检索的其他知识库
     created_at: datetime = datetime.now()  # 创建时间
 
     class Settings:
@@ -27,6 +27,12 @@ class KnowledgeBase(Document):
     )
 
     embedding_config: EmbeddingConfig
+    # 向量存储后端: "chroma" 或 "numpy" (内存映射平铺索引)，创建后不可更改
+    vector_backend: str = "chroma"
+    # numpy 后端的向量存储类型: float32 / float16 / int8 (标量量化)，None 为服务端默认
+    vector_dtype: Optional[str] = None
+    # 分片数: 大于 1 时知识库按块哈希拆分为多个独立存储，检索并发扇出后合并
+    shard_count: int = 1
 
     create_at: datetime = Field(default_factory=datetime.now)
 
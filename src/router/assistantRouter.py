@@ -13,6 +13,7 @@ async def create_assistant(assistant: assisitentSev.AssistantRequest):
     username: 用户名
     prompt: 助手提示词
     knowledge_Id: 知识库ID
+    extra_knowledge_Ids: 联合检索的其他知识库ID列表
     """
     return await assisitentSev.create_assistant(assistant)
 
@@ -38,6 +39,7 @@ async def update_assistant(
     title: 助手标题 (来自请求体)
     prompt: 助手提示词 (来自请求体)
     knowledge_Id: 知识库ID (来自请求体)
+    extra_knowledge_Ids: 联合检索的其他知识库ID列表 (来自请求体)
     """
     return await assisitentSev.update_assistant(assistant_id, assistant)
 
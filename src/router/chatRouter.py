@@ -1,15 +1,20 @@
-import json
+import asyncio
 import logging
-from typing import Any, Dict, Literal, Optional
+from typing import Any, Dict, List, Literal, Optional
 
-from fastapi import APIRouter, Depends, HTTPException
+from bson import ObjectId
+from fastapi import APIRouter, Depends, HTTPException, Request
 from fastapi.responses import StreamingResponse
 from pydantic import BaseModel, Field
 
 from src.models.knowledgeBase import KnowledgeBase
-from src.service.ChatSev import ChatSev
+from src.service.ChatSev import ChatSev, join_file_scope
+from src.utils.chain_cache import hash_text
 from src.utils.embedding import get_embedding
+from src.utils.federated_retrieval import FederatedSource
 from src.utils.Knowledge import Knowledge
+from src.utils.metrics import metrics
+from src.utils.sse import coalesce_sse_events, encode_sse_event
 
 ChatRouter = APIRouter()
 
@@ -41,12 +46,47 @@ class RerankerConfig(BaseModel):
 class KnowledgeConfig(BaseModel):
     knowledge_base_id: str
     filter_by_file_md5: Optional[str] = None
+    filter_by_file_md5s: List[str] = Field(
+        default_factory=list,
+        description="多文件检索范围：只在这些文件的向量中检索 (可与 filter_by_file_md5 同时使用，取并集)",
+    )
     search_k: Optional[int] = Field(
         default=10, ge=1, description="基础检索器返回的文档数量 (应 >= rerank_top_n)"
     )
     reranker_config: RerankerConfig = Field(
         default_factory=RerankerConfig, description="重排序器配置"
     )
+    semantic_cache: bool = Field(
+        default=False,
+        description="是否启用语义答案缓存：与历史问题足够相似时直接返回历史答案",
+    )
+    adaptive_search_k: bool = Field(
+        default=False,
+        description="是否启用自适应 search_k：取回较多候选后按相似度分数落差决定交给重排序的数量 (候选数取 search_k 与 ADAPTIVE_MAX_K 中的较大者)",
+    )
+    retrieval_budget_ms: Optional[int] = Field(
+        default=None,
+        ge=0,
+        description="检索阶段的延迟预算 (毫秒)，重排序超出预算时使用向量检索顺序；默认取 RETRIEVAL_BUDGET_MS",
+    )
+    nprobe: Optional[int] = Field(
+        default=None,
+        ge=0,
+        description="IVF 近似检索探查的倒排列表数 (仅对已构建 IVF 的 numpy 后端知识库生效)，0 表示精确检索；默认取知识库构建 IVF 时设定的值",
+    )
+    coarse_top_files: Optional[int] = Field(
+        default=None,
+        ge=1,
+        description="两阶段检索：先按文件摘要向量选出最相近的 N 个文件，再只在这些文件的块中检索；不设置则直接检索全部块",
+    )
+    extra_knowledge_base_ids: List[str] = Field(
+        default_factory=list,
+        description="与 knowledge_base_id 一起联合检索的其他知识库；各知识库并发检索，融合后用主知识库的重排序配置统一重排一次",
+    )
+    fusion: Literal["rrf", "score"] = Field(
+        default="rrf",
+        description="联合检索的结果融合方式: rrf (倒数排名融合) 或 score (各知识库分数 min-max 归一化)",
+    )
 
 
 class ChatConfig(BaseModel):
@@ -62,27 +102,87 @@ class ChatRequest(BaseModel):
     knowledge_config: Optional[KnowledgeConfig] = None
 
 
+def _embedding_key(kb: KnowledgeBase) -> tuple:
+    """嵌入模型标识：相同标识的知识库在联合检索中共享一次查询向量计算"""
+    config = kb.embedding_config
+    return (
+        config.embedding_supplier,
+        config.embedding_model,
+        hash_text(config.embedding_apikey),
+    )
+
+
+def _build_knowledge(kb: KnowledgeBase, knowledge_config: KnowledgeConfig) -> Knowledge:
+    """按知识库的嵌入配置与请求的检索配置创建 Knowledge 实例"""
+    _embedding = get_embedding(
+        kb.embedding_config.embedding_supplier,
+        kb.embedding_config.embedding_model,
+        kb.embedding_config.embedding_apikey,
+    )
+    reranker_cfg = knowledge_config.reranker_config
+    return Knowledge(
+        _embeddings=_embedding,
+        splitter="hybrid",
+        use_reranker=reranker_cfg.use_reranker,
+        reranker_type=reranker_cfg.reranker_type,
+        remote_rerank_config=reranker_cfg.remote_rerank_config,
+        rerank_top_n=reranker_cfg.rerank_top_n,
+        adaptive_search_k=knowledge_config.adaptive_search_k,
+        nprobe=knowledge_config.nprobe,
+        coarse_top_files=knowledge_config.coarse_top_files,
+    )
+
+
+async def _build_federated_sources(
+    kb: KnowledgeBase, knowledge: Knowledge, knowledge_config: KnowledgeConfig
+) -> List[FederatedSource]:
+    """构建联合检索的知识库列表 (主知识库在前)；无其他知识库时返回空列表"""
+    extra_ids = [
+        kb_id
+        for kb_id in dict.fromkeys(knowledge_config.extra_knowledge_base_ids)
+        if kb_id != knowledge_config.knowledge_base_id
+    ]
+    if not extra_ids:
+        return []
+    extra_sources = await asyncio.gather(
+        *(_build_extra_source(kb_id, knowledge_config) for kb_id in extra_ids)
+    )
+    sources = [FederatedSource(str(kb.id), knowledge, _embedding_key(kb))]
+    sources.extend(source for source in extra_sources if source is not None)
+    return sources if len(sources) > 1 else []
+
+
+async def _build_extra_source(
+    kb_id: str, knowledge_config: KnowledgeConfig
+) -> Optional[FederatedSource]:
+    """加载联合检索中的一个其他知识库；ID 无效、不存在或加载失败时只跳过该知识库"""
+    if not ObjectId.is_valid(kb_id):
+        logging.warning(f"无效的知识库 ID 格式: {kb_id}，联合检索中跳过。")
+        return None
+    try:
+        extra_kb = await KnowledgeBase.get(kb_id)
+        if not extra_kb or not extra_kb.embedding_config:
+            logging.warning(f"未找到知识库 {kb_id} 或其 embedding 配置，联合检索中跳过。")
+            return None
+        return FederatedSource(
+            kb_id,
+            _build_knowledge(extra_kb, knowledge_config),
+            _embedding_key(extra_kb),
+        )
+    except Exception as e:
+        logging.error(f"加载知识库 {kb_id} 失败，联合检索中跳过: {e}", exc_info=True)
+        return None
+
+
 async def get_chat_service(request: ChatRequest) -> ChatSev:
     """Dependency function to create ChatSev instance based on request config."""
     knowledge_instance: Optional[Knowledge] = None
+    federated_sources: List[FederatedSource] = []
     if request.knowledge_config:
         try:
             kb = await KnowledgeBase.get(request.knowledge_config.knowledge_base_id)
             if kb.embedding_config:
-                _embedding = get_embedding(
-                    kb.embedding_config.embedding_supplier,
-                    kb.embedding_config.embedding_model,
-                    kb.embedding_config.embedding_apikey,
-                )
-                reranker_cfg = request.knowledge_config.reranker_config
-                knowledge_instance = Knowledge(
-                    _embeddings=_embedding,
-                    splitter="hybrid",
-                    use_reranker=reranker_cfg.use_reranker,
-                    reranker_type=reranker_cfg.reranker_type,
-                    remote_rerank_config=reranker_cfg.remote_rerank_config,
-                    rerank_top_n=reranker_cfg.rerank_top_n,
-                )
+                knowledge_instance = _build_knowledge(kb, request.knowledge_config)
             else:
                 logging.warning(
                     f"未找到知识库 {request.knowledge_config.knowledge_base_id} 或其 embedding 配置。将不初始化 Knowledge 工具。"
@@ -93,11 +193,24 @@ async def get_chat_service(request: ChatRequest) -> ChatSev:
                 exc_info=True,
             )
             knowledge_instance = None
+        if knowledge_instance is not None:
+            # 其他知识库的加载失败只影响联合检索，不影响主知识库
+            try:
+                federated_sources = await _build_federated_sources(
+                    kb, knowledge_instance, request.knowledge_config
+                )
+            except Exception as e:
+                logging.error(f"构建联合检索失败 ({e})，只检索主知识库。", exc_info=True)
+                federated_sources = []
 
     try:
         chat_sev = ChatSev(
             knowledge=knowledge_instance,
             prompt=request.chat_config.prompt_override if request.chat_config else None,
+            federated_sources=federated_sources,
+            fusion=request.knowledge_config.fusion
+            if request.knowledge_config
+            else "rrf",
         )
         return chat_sev
     except Exception as e:
@@ -105,11 +218,19 @@ async def get_chat_service(request: ChatRequest) -> ChatSev:
         raise HTTPException(status_code=500, detail=f"无法初始化聊天服务: {e}")
 
 
-async def stream_response_generator(chat_sev: ChatSev, request_data: ChatRequest):
-    """异步生成器，用于 StreamingResponse，产生 SSE 格式的事件。"""
+async def stream_response_generator(
+    chat_sev: ChatSev,
+    request_data: ChatRequest,
+    http_request: Optional[Request] = None,
+):
+    """
+    异步生成器，用于 StreamingResponse，产生 SSE 格式的事件 (相邻文本块按时间窗口合帧)。
+    每次发送前检测客户端是否断开；断开 (或发送失败) 时关闭上游事件流以取消 LLM 生成与检索。
+    """
     logging.info(f"开始为 session_id={request_data.session_id} 生成流式响应")
+    frames = None
     try:
-        async for chunk_dict in chat_sev.stream_chat(
+        events = chat_sev.stream_chat(
             question=request_data.question,
             api_key=request_data.llm_config.api_key,
             supplier=request_data.llm_config.supplier,
@@ -118,7 +239,10 @@ async def stream_response_generator(chat_sev: ChatSev, request_data: ChatRequest
             knowledge_base_id=request_data.knowledge_config.knowledge_base_id
             if request_data.knowledge_config
             else None,
-            filter_by_file_md5=request_data.knowledge_config.filter_by_file_md5
+            filter_by_file_md5=join_file_scope(
+                [request_data.knowledge_config.filter_by_file_md5]
+                + request_data.knowledge_config.filter_by_file_md5s
+            )
             if request_data.knowledge_config
             else None,
             search_k=request_data.knowledge_config.search_k
@@ -126,23 +250,40 @@ async def stream_response_generator(chat_sev: ChatSev, request_data: ChatRequest
             else 3,
             max_length=None,
             temperature=request_data.llm_config.temperature,
-        ):
-            event_type = chunk_dict.get("type", "message")
-            yield f"data: {json.dumps(chunk_dict)}\n\n"
-            logging.debug(
-                f"Sent chunk: {chunk_dict['type']} for session {request_data.session_id}"
-            )
+            semantic_cache=request_data.knowledge_config.semantic_cache
+            if request_data.knowledge_config
+            else False,
+            retrieval_budget_ms=request_data.knowledge_config.retrieval_budget_ms
+            if request_data.knowledge_config
+            else None,
+        )
+        frames = coalesce_sse_events(events)
+        async for frame in frames:
+            if http_request is not None and await http_request.is_disconnected():
+                logging.info(
+                    f"客户端已断开 (session: {request_data.session_id})，取消流式生成。"
+                )
+                metrics.incr("sse_client_disconnects_total", detected_by="poll")
+                break
+            yield frame
 
+    except (asyncio.CancelledError, GeneratorExit):
+        # 发送失败或服务端取消了响应任务
+        logging.info(
+            f"流式响应被中断 (session: {request_data.session_id})，取消流式生成。"
+        )
+        metrics.incr("sse_client_disconnects_total", detected_by="send")
+        raise
     except Exception as e:
         logging.error(
             f"在 stream_response_generator 中发生错误 (session: {request_data.session_id}): {e}",
             exc_info=True,
         )
-        error_payload = json.dumps(
-            {"type": "error", "data": f"流处理中发生严重错误: {e}"}
-        )
-        yield f"data: {error_payload}\n\n"
+        yield encode_sse_event({"type": "error", "data": f"流处理中发生严重错误: {e}"})
     finally:
+        if frames is not None:
+            # 关闭合帧生成器会取消其上游任务，进而终止 stream_chat 中的 astream
+            await frames.aclose()
         logging.info(f"结束为 session_id={request_data.session_id} 的流式响应")
 
 
@@ -152,7 +293,9 @@ async def stream_response_generator(chat_sev: ChatSev, request_data: ChatRequest
     description="与 AI 进行流式对话，可选使用知识库和重排序。",
 )
 async def chat_stream_endpoint(
-    request: ChatRequest, chat_sev: ChatSev = Depends(get_chat_service)
+    request: ChatRequest,
+    http_request: Request,
+    chat_sev: ChatSev = Depends(get_chat_service),
 ):
     """处理流式聊天请求。"""
     logging.info(
@@ -163,7 +306,8 @@ async def chat_stream_endpoint(
             f", kb_id={request.knowledge_config.knowledge_base_id}, use_reranker={request.knowledge_config.reranker_config.use_reranker}, reranker_type='{request.knowledge_config.reranker_config.reranker_type}'"
         )
     return StreamingResponse(
-        stream_response_generator(chat_sev, request), media_type="text/event-stream"
+        stream_response_generator(chat_sev, request, http_request),
+        media_type="text/event-stream",
     )
 
 
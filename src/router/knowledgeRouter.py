@@ -1,7 +1,7 @@
-from typing import Optional
+from typing import Literal, Optional
 
 from fastapi import APIRouter, Depends, File, Form, HTTPException, UploadFile
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 
 import src.service.knowledgeSev as knowledgeSev
 
@@ -18,6 +18,20 @@ class KnowledgeBaseCreate(BaseModel):
     tag: Optional[list[str]] = None
     description: Optional[str] = None
     embedding_config: EmbeddingConfig  # 直接使用 EmbeddingConfig 模型
+    vector_backend: Literal["chroma", "numpy"] = "chroma"  # 向量存储后端
+    # numpy 后端的向量存储类型，int8 为标量量化 (约 1/4 内存)
+    vector_dtype: Optional[Literal["float32", "float16", "int8"]] = None
+    # 分片数: 超大知识库可拆分为多个独立存储，写入并行、检索并发扇出
+    shard_count: int = Field(default=1, ge=1, le=64)
+
+
+class ReshardRequest(BaseModel):
+    shard_count: int = Field(ge=1, le=64)
+
+
+class IvfBuildRequest(BaseModel):
+    n_lists: Optional[int] = Field(default=None, ge=1)  # 默认约 4 * sqrt(行数)
+    default_nprobe: Optional[int] = Field(default=None, ge=1)  # 该知识库的默认工作点
 
 
 # 创建知识库
@@ -112,3 +126,87 @@ async def delete_file_from_knowledge_base(kb_id: str, file_md5: str):
         # 捕获 service 层可能抛出的其他 500 错误或意外错误
         print(f"删除知识库 {kb_id} 中的文件 {file_md5} 时发生错误: {e}")
         raise HTTPException(status_code=500, detail=f"删除文件失败: {e}")
+
+
+# (重新) 构建 IVF 近似索引
+@knowledgeRouter.post("/{kb_id}/ivf", summary="构建知识库的 IVF 近似索引")
+async def build_ivf_index(kb_id: str, request: IvfBuildRequest):
+    """仅适用于 numpy 后端知识库；重新训练聚类中心并重新分配全部向量。"""
+    try:
+        return await knowledgeSev.build_ivf_index(
+            kb_id, n_lists=request.n_lists, default_nprobe=request.default_nprobe
+        )
+    except FileNotFoundError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"构建 IVF 索引失败: {e}")
+
+
+# IVF 召回率/延迟报告
+@knowledgeRouter.get("/{kb_id}/ivf/report", summary="IVF 召回率与延迟报告")
+async def get_ivf_recall_report(
+    kb_id: str,
+    k: int = 10,
+    nprobes: Optional[str] = None,  # 逗号分隔，例如 "1,4,16"
+    n_queries: int = 100,
+):
+    """以精确检索为基准，统计各 nprobe 下的 recall@k 与 p50/p95 延迟。"""
+    try:
+        nprobe_list = (
+            [int(n) for n in nprobes.split(",") if n.strip()] if nprobes else None
+        )
+        return await knowledgeSev.get_ivf_recall_report(
+            kb_id, k=k, nprobes=nprobe_list, n_queries=n_queries
+        )
+    except FileNotFoundError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"生成 IVF 报告失败: {e}")
+
+
+# int8 量化基准
+@knowledgeRouter.get("/{kb_id}/quantization/report", summary="int8 量化基准报告")
+async def get_quantization_report(kb_id: str, k: int = 10, n_queries: int = 100):
+    """对比 int8 量化检索 (浮点重新打分) 与浮点精确检索的召回率、延迟与内存占用。"""
+    try:
+        return await knowledgeSev.get_quantization_report(
+            kb_id, k=k, n_queries=n_queries
+        )
+    except FileNotFoundError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"生成量化报告失败: {e}")
+
+
+# 重新分片
+@knowledgeRouter.post("/{kb_id}/reshard", summary="重新划分知识库的分片")
+async def reshard_knowledge_base(kb_id: str, request: ReshardRequest):
+    """把现有知识库迁移到新的分片数 (不重新计算向量)，完成后原子切换；期间拒绝文件增删。"""
+    try:
+        return await knowledgeSev.reshard_knowledge_base(kb_id, request.shard_count)
+    except FileNotFoundError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"重新分片失败: {e}")
+
+
+# 回填文件级摘要向量
+@knowledgeRouter.post("/{kb_id}/file-summaries", summary="计算知识库的文件级摘要向量")
+async def build_file_summaries(kb_id: str):
+    """为两阶段检索 (coarse_top_files) 计算每个文件的质心向量；新上传的文件会自动计算。"""
+    try:
+        return await knowledgeSev.build_file_summaries(kb_id)
+    except FileNotFoundError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"计算文件摘要向量失败: {e}")
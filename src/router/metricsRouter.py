@@ -0,0 +1,12 @@
+from fastapi import APIRouter
+
+from src.utils.metrics import metrics
+
+MetricsRouter = APIRouter()
+
+
+# 获取当前进程的运行指标
+@MetricsRouter.get("/", summary="获取运行指标")
+async def get_metrics():
+    """获取当前 worker 进程内的计数器、耗时统计与各缓存的命中情况"""
+    return metrics.snapshot()
@@ -1,10 +1,15 @@
+import asyncio
 import json
 import logging
 import os
+import time
+from functools import lru_cache
+from operator import itemgetter
 from typing import (
     Any,
     AsyncIterable,
     Dict,
+    List,
     Optional,
     Tuple,
     Union,
@@ -13,15 +18,17 @@ from typing import (
 import redis.asyncio as aioredis  # 导入 aioredis
 from bson import ObjectId
 from langchain.chains.combine_documents import create_stuff_documents_chain
-from langchain.chains.retrieval import create_retrieval_chain
 from langchain_core.chat_history import BaseChatMessageHistory
-from langchain_core.messages import BaseMessage
+from langchain_core.documents import Document
+from langchain_core.messages import AIMessage, BaseMessage, HumanMessage
 from langchain_core.prompts import ChatPromptTemplate
 from langchain_core.runnables import (
     ConfigurableFieldSpec,  # f-流式输出
+    Runnable,
+    RunnableBranch,
     RunnableConfig,  # f-流式输出
     RunnableLambda,
-    RunnableSerializable,  # f-流式输出
+    RunnablePassthrough,
 )
 from langchain_core.runnables.history import (
     RunnableWithMessageHistory,
@@ -38,15 +45,132 @@ from src.models.knowledgeBase import KnowledgeBase as KnowledgeBaseModel
 from src.service.knowledgeSev import (  # 导入缓存设置函数和前缀
     KB_CACHE_PREFIX,
     _set_kb_cache,
+    get_kb_version,
 )
-from src.utils.Knowledge import Knowledge
+from src.utils.answer_cache import (
+    build_answer_cache_key,
+    chunk_ids_of,
+    get_cached_answer,
+    get_chunk_id,
+    iter_replay_chunks,
+    set_cached_answer,
+)
+from src.utils.chain_cache import CachedChain, chain_cache, hash_text
+from src.utils.context_packer import pack_context
+from src.utils.federated_retrieval import (
+    FEDERATED_FUSION,
+    FederatedSource,
+    afederated_retrieve,
+)
+from src.utils.Knowledge import RERANK_FALLBACK_PATHS, Knowledge
 
 # utils
 from src.utils.llm_modle import get_llms
+from src.utils.llm_scheduler import (
+    LLM_QUEUE_REPORT_INTERVAL_SECONDS,
+    QueueTimeoutError,
+    SchedulerTicket,
+    llm_scheduler,
+)
+from src.utils.metrics import metrics
+from src.utils.retrieval_cache import build_retrieval_cache_key, retrieval_cache
+from src.utils.retrieval_gate import QUESTION, GateDecision, retrieval_gate
+from src.utils.semantic_cache import semantic_cache as semantic_answer_cache
+from src.utils.single_flight import normalize_question, single_flight
 
 logger = logging.getLogger(__name__)
 
 
+@lru_cache(maxsize=256)
+def _build_chat_prompts(
+    prompt: Optional[str],
+) -> Tuple[ChatPromptTemplate, ChatPromptTemplate]:
+    """根据助手提示词构建 (知识库模板, 普通模板)，结果按提示词缓存"""
+    ai_info = prompt if prompt else "你是一个帮助人们解答各种问题的助手。"
+
+    # 知识库prompt--system
+    knowledge_system_prompt = (
+        f"{ai_info} 【注意：当用户向你提问，请你使用下面检索到的上下文来回答问题。如果检索到的上下文中没有问题的答案，请你直接回答不知道。检索到的上下文如下：\n\n"
+        "{context}】"
+    )
+
+    knowledge_prompt = ChatPromptTemplate.from_messages(  # 知识库prompt
+        [
+            ("system", knowledge_system_prompt),
+            ("placeholder", "{chat_history}"),
+            ("human", "{input}"),
+        ]
+    )
+
+    # 没有指定知识库的模板的AI系统模板
+    normal_prompt = ChatPromptTemplate.from_messages(  # 正常prompt
+        [
+            ("system", ai_info),
+            ("placeholder", "{chat_history}"),
+            ("human", "{input}"),
+        ]
+    )
+    return knowledge_prompt, normal_prompt
+
+
+def _wrap_normal_output(message: BaseMessage) -> Dict[str, Any]:
+    return {"answer": message}
+
+
+FILE_SCOPE_SEPARATOR = ","  # 多文件检索范围在 filter_by_file_md5 中以逗号连接
+
+
+def join_file_scope(file_md5s: List[str]) -> Optional[str]:
+    """将一组文件 MD5 规范化为检索范围字符串 (去重、排序，用作缓存键的一部分)"""
+    unique = sorted({str(md5) for md5 in file_md5s if md5})
+    return FILE_SCOPE_SEPARATOR.join(unique) if unique else None
+
+
+def _file_scope_filter(filter_by_file_md5: Optional[str]) -> Optional[dict]:
+    """将检索范围 (单个 MD5 或逗号连接的多个 MD5) 转换为元数据过滤条件"""
+    if not filter_by_file_md5:
+        return None
+    file_md5s = str(filter_by_file_md5).split(FILE_SCOPE_SEPARATOR)
+    if len(file_md5s) == 1:
+        return {"source_file_md5": file_md5s[0]}
+    return {"source_file_md5": {"$in": file_md5s}}
+
+
+SOURCE_SNIPPET_CHARS = 120  # sources 事件中每个片段摘要的最大字符数
+
+
+def _build_sources(docs: List[Document]) -> List[Dict[str, Any]]:
+    """将检索到的文档块整理为 sources 事件数据，供前端在生成回答前渲染引用"""
+    sources = []
+    for doc in docs:
+        metadata = doc.metadata or {}
+        score = metadata.get("relevance_score", metadata.get("vector_score"))
+        snippet = " ".join(doc.page_content.split())
+        if len(snippet) > SOURCE_SNIPPET_CHARS:
+            snippet = snippet[:SOURCE_SNIPPET_CHARS] + "..."
+        sources.append(
+            {
+                "chunk_id": get_chunk_id(doc),
+                "file_name": metadata.get("source_file_name"),
+                "file_md5": metadata.get("source_file_md5"),
+                "score": float(score) if score is not None else None,
+                "snippet": snippet,
+            }
+        )
+    return sources
+
+
+# 持有后台任务的引用，防止任务在完成前被垃圾回收
+_background_tasks: set = set()
+
+
+def _spawn_background(coro) -> None:
+    """在后台运行协程 (用于取消后仍需完成的收尾工作，如保存被截断的回答)"""
+    task = asyncio.ensure_future(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+
+
 class ChatSev:
     # 废弃-移除类级别的内存历史记录实例
     # _chat_history = ChatMessageHistory()  # 对话历史
@@ -56,8 +180,13 @@ class ChatSev:
         knowledge: Optional[Knowledge] = None,
         prompt: str | None = None,
         chat_history_max_length: Optional[int] = 8,
+        federated_sources: Optional[List[FederatedSource]] = None,
+        fusion: str = FEDERATED_FUSION,
     ):
         self.knowledge = knowledge  # Store the initialized Knowledge instance
+        # 多知识库联合检索的全部知识库 (含主知识库)；为空时只检索主知识库
+        self.federated_sources = federated_sources or []
+        self.fusion = fusion
         # self.chat_history_max_length = chat_history_max_length # 暂时注释掉，因为 MongoDB History 不直接限制长度
 
         # 从环境变量读取 MongoDB 配置
@@ -83,31 +212,18 @@ class ChatSev:
         self.normal_prompt = None  # 正常模板
         self.create_chat_prompt()  # 创建聊天模板
 
-    def create_chat_prompt(self) -> None:
-        ai_info = self.prompt if self.prompt else "你是一个帮助人们解答各种问题的助手。"
-
-        # 知识库prompt--system
-        knowledge_system_prompt = (
-            f"{ai_info} 【注意：当用户向你提问，请你使用下面检索到的上下文来回答问题。如果检索到的上下文中没有问题的答案，请你直接回答不知道。检索到的上下文如下：\n\n"
-            "{context}】"
-        )
-
-        self.knowledge_prompt = ChatPromptTemplate.from_messages(  # 知识库prompt
-            [
-                ("system", knowledge_system_prompt),
-                ("placeholder", "{chat_history}"),
-                ("human", "{input}"),
-            ]
+    def _federated_key(self) -> Optional[tuple]:
+        """参与联合检索的知识库集合，用作合并请求与会话上下文键的一部分"""
+        if not self.federated_sources:
+            return None
+        return (
+            tuple(sorted(source.kb_id for source in self.federated_sources)),
+            self.fusion,
         )
 
-        # 没有指定知识库的模板的AI系统模板
-        self.normal_prompt = ChatPromptTemplate.from_messages(  # 正常prompt
-            [
-                ("system", ai_info),
-                ("placeholder", "{chat_history}"),
-                ("human", "{input}"),
-            ]
-        )
+    def create_chat_prompt(self) -> None:
+        # 相同提示词的模板在进程内复用，避免每次请求重新解析
+        self.knowledge_prompt, self.normal_prompt = _build_chat_prompts(self.prompt)
 
     def get_session_chat_history(self, session_id: str) -> BaseChatMessageHistory:
         """根据 session_id 获取 MongoDB 聊天记录实例"""
@@ -129,19 +245,29 @@ class ChatSev:
         search_k: int,
         max_length: Optional[int],
         temperature: float,
-    ) -> Tuple[str, RunnableSerializable]:
-        """辅助函数：确定上下文显示名称和基础链。优先从 Redis 读取知识库元数据。"""
+        gate: Optional[GateDecision] = None,
+    ) -> Tuple[str, CachedChain]:
+        """
+        辅助函数：确定上下文显示名称和 (缓存的) 已组装链。优先从 Redis 读取知识库元数据。
+        链按 (提示词哈希, supplier, model, API Key 哈希, temperature, 知识库 ID, 重排序配置) 缓存，
+        过滤条件等每次请求的参数通过 _build_run_config 在调用时注入。
+        gate 为检索门控结果：判定为闲聊 (skip) 时直接使用普通链，不读取知识库、不检索。
+        """
         context_display_name = "标准对话"
-        chat = get_llms(
-            supplier=supplier,
-            model=model,
-            api_key=api_key,
-            max_length=max_length,
-            temperature=temperature,
-        )
-        base_chain: RunnableSerializable
+        llm_params = {
+            "supplier": supplier,
+            "model": model,
+            "api_key": api_key,
+            "max_length": max_length,
+            "temperature": temperature,
+        }
+        cached: CachedChain
 
-        if knowledge_base_id and self.knowledge:
+        if knowledge_base_id and self.knowledge and gate and gate.action == "skip":
+            logging.info("检索门控判定为闲聊，跳过知识库检索，使用普通聊天模式。")
+            cached = self._get_or_build_normal_chain(llm_params)
+            context_display_name = "标准对话 (无需检索)"
+        elif knowledge_base_id and self.knowledge:
             logging.info(
                 f"使用知识库: {knowledge_base_id}, 文件过滤器 MD5: {filter_by_file_md5}"
             )
@@ -206,21 +332,23 @@ class ChatSev:
             if kb_data:
                 kb_title = kb_data.get("title", "未知知识库")
                 if filter_by_file_md5:
-                    file_found = False
+                    scope_md5s = set(str(filter_by_file_md5).split(FILE_SCOPE_SEPARATOR))
+                    file_names = []
                     # 确保 filesList 存在且是列表
                     files_list = kb_data.get("filesList")
                     if isinstance(files_list, list):
                         for file_info in files_list:
                             # 确保 file_info 是字典且包含 file_md5
-                            if isinstance(file_info, dict) and str(
-                                file_info.get("file_md5")
-                            ) == str(filter_by_file_md5):
-                                context_display_name = (
-                                    f"文件：{file_info.get('file_name', '未知文件名')}"
+                            if (
+                                isinstance(file_info, dict)
+                                and str(file_info.get("file_md5")) in scope_md5s
+                            ):
+                                file_names.append(
+                                    file_info.get("file_name", "未知文件名")
                                 )
-                                file_found = True
-                                break
-                    if not file_found:
+                    if file_names:
+                        context_display_name = f"文件：{'、'.join(file_names)}"
+                    else:
                         logger.warning(
                             f"在知识库 {knowledge_base_id} (来自 {'缓存' if cached_data_str else 'DB'}) 中未找到 MD5 为 {filter_by_file_md5} 的文件，将显示知识库名称。"
                         )
@@ -236,72 +364,152 @@ class ChatSev:
 
             # --- RAG 链创建逻辑 (基本不变，依赖 kb_data 是否有效来决定是否创建 RAG) ---
             if kb_data:  # 只有成功获取到数据才尝试创建 RAG 链
-                filter_dict = None
-                if filter_by_file_md5:
-                    filter_dict = {"source_file_md5": str(filter_by_file_md5)}
-
                 try:
-                    retriever = self.knowledge.get_retriever_for_knowledge_base(
-                        kb_id=knowledge_base_id,
-                        filter_dict=filter_dict,
-                        search_k=search_k,
-                    )
-                    question_answer_chain = create_stuff_documents_chain(
-                        chat, self.knowledge_prompt
-                    )
-                    base_chain = create_retrieval_chain(
-                        retriever, question_answer_chain
+                    cached = self._get_or_build_rag_chain(
+                        knowledge_base_id, search_k, llm_params
                     )
-                    logging.info("RAG 链创建成功。")
                 except FileNotFoundError as e:
                     logging.warning(
                         f"无法加载知识库向量存储 {knowledge_base_id} (可能不存在或无法访问): {e}。将退回到普通聊天模式。"
                     )
-
-                    def wrap_normal_output(message: BaseMessage) -> Dict[str, Any]:
-                        return {"answer": message}
-
-                    base_chain = (
-                        self.normal_prompt | chat | RunnableLambda(wrap_normal_output)
-                    )
+                    cached = self._get_or_build_normal_chain(llm_params)
                     context_display_name = "标准对话 (知识库向量错误)"  # 更新上下文
                 except Exception as e:
                     logging.error(
                         f"获取知识库检索器或创建 RAG 链时出错 ({knowledge_base_id}): {e}",
                         exc_info=True,
                     )
-
-                    def wrap_normal_output(message: BaseMessage) -> Dict[str, Any]:
-                        return {"answer": message}
-
-                    base_chain = (
-                        self.normal_prompt | chat | RunnableLambda(wrap_normal_output)
-                    )
+                    cached = self._get_or_build_normal_chain(llm_params)
                     context_display_name = "标准对话 (知识库错误)"  # 更新上下文
             else:
                 # 如果 kb_data 获取失败，直接使用普通链
                 logging.warning(
                     f"由于无法获取知识库 {knowledge_base_id} 数据，将使用普通聊天模式。"
                 )
-
-                def wrap_normal_output(message: BaseMessage) -> Dict[str, Any]:
-                    return {"answer": message}
-
-                base_chain = (
-                    self.normal_prompt | chat | RunnableLambda(wrap_normal_output)
-                )
+                cached = self._get_or_build_normal_chain(llm_params)
                 # context_display_name 已在上面设置为错误状态
 
         else:  # 不使用知识库的情况
             logging.info("不使用知识库，使用普通聊天模式。")
+            cached = self._get_or_build_normal_chain(llm_params)
+            # context_display_name 默认为 "标准对话"
 
-            def wrap_normal_output(message: BaseMessage) -> Dict[str, Any]:
-                return {"answer": message}
+        return context_display_name, cached
 
-            base_chain = self.normal_prompt | chat | RunnableLambda(wrap_normal_output)
-            # context_display_name 默认为 "标准对话"
+    def _chain_cache_key(
+        self, llm_params: Dict[str, Any], knowledge_base_id: Optional[str]
+    ) -> tuple:
+        """构造链缓存键，知识库链额外包含知识库 ID 与重排序配置签名"""
+        return (
+            hash_text(self.prompt),
+            llm_params["supplier"],
+            llm_params["model"],
+            hash_text(llm_params["api_key"]),
+            llm_params["temperature"],
+            str(knowledge_base_id) if knowledge_base_id else None,
+            self.knowledge.config_signature()
+            if knowledge_base_id and self.knowledge
+            else None,
+        )
+
+    def _wrap_with_history(self, base_chain: Runnable) -> RunnableWithMessageHistory:
+        """f-历史会话-包装历史记录管理"""
+        # RunnableWithMessageHistory 会自动处理输入和历史消息，并将 base_chain 的输出传递出去
+        return RunnableWithMessageHistory(
+            base_chain,
+            self.get_session_chat_history,  # f-历史会话-获取会话历史-MongoDBChatMessageHistory
+            input_messages_key="input",  # base_chain 需要 'input'
+            history_messages_key="chat_history",  # prompt 需要 'chat_history'
+            output_messages_key="answer",  # 指定从 base_chain 输出字典中提取 'answer' 作为 AI 消息保存
+            history_factory_config=[
+                ConfigurableFieldSpec(
+                    id="session_id",
+                    annotation=str,
+                    name="Session ID",
+                    description="Unique identifier for the chat session.",
+                    default="",
+                    is_shared=True,
+                )
+            ],
+        )
+
+    def _get_or_build_normal_chain(self, llm_params: Dict[str, Any]) -> CachedChain:
+        """获取或构建普通聊天链 (prompt | llm)"""
+        cache_key = self._chain_cache_key(llm_params, None)
+        cached = chain_cache.get(cache_key)
+        if cached is not None:
+            return cached
+        chat = get_llms(**llm_params)
+        base_chain = self.normal_prompt | chat | RunnableLambda(_wrap_normal_output)
+        return chain_cache.set(
+            cache_key,
+            CachedChain(
+                base_chain=base_chain,
+                chain_with_history=self._wrap_with_history(base_chain),
+                prompt_hash=hash_text(self.prompt),
+            ),
+        )
 
-        return context_display_name, base_chain
+    def _get_or_build_rag_chain(
+        self,
+        knowledge_base_id: str,
+        search_k: int,
+        llm_params: Dict[str, Any],
+    ) -> CachedChain:
+        """获取或构建 RAG 链；向量存储不存在时抛出 FileNotFoundError"""
+        cache_key = self._chain_cache_key(llm_params, knowledge_base_id)
+        cached = chain_cache.get(cache_key)
+        if cached is not None:
+            return cached
+        chat = get_llms(**llm_params)
+        retriever = self.knowledge.get_configurable_retriever(
+            kb_id=knowledge_base_id, search_k=search_k
+        )
+        question_answer_chain = create_stuff_documents_chain(
+            chat, self.knowledge_prompt
+        )
+        # 与 create_retrieval_chain 等价，但输入中已带有 context 时跳过检索，
+        # 使调用方可以先单独完成检索 (用于答案缓存等)，再把文档交给链生成回答
+        retrieval_docs = RunnableBranch(
+            (lambda x: "context" in x, itemgetter("context")),
+            itemgetter("input") | retriever,
+        )
+        base_chain = (
+            RunnablePassthrough.assign(
+                context=retrieval_docs.with_config(run_name="retrieve_documents"),
+            )
+            .assign(answer=question_answer_chain)
+            .with_config(run_name="retrieval_chain")
+        )
+        logging.info("RAG 链创建成功。")
+        return chain_cache.set(
+            cache_key,
+            CachedChain(
+                base_chain=base_chain,
+                chain_with_history=self._wrap_with_history(base_chain),
+                kb_id=str(knowledge_base_id),
+                prompt_hash=hash_text(self.prompt),
+                retriever=retriever,
+            ),
+        )
+
+    @staticmethod
+    def _build_run_config(
+        session_id: str,
+        filter_by_file_md5: Optional[str],
+        search_k: int,
+        retrieval_budget_ms: Optional[int] = None,
+    ) -> RunnableConfig:
+        """构造每次请求的运行配置：会话 ID 与检索过滤条件在调用时注入"""
+        filter_dict = _file_scope_filter(filter_by_file_md5)
+        return {
+            "configurable": {
+                "session_id": session_id,
+                "filter_dict": filter_dict,
+                "search_k": search_k,
+                "retrieval_budget_ms": retrieval_budget_ms,
+            }
+        }
 
     # f-流式输出
     async def stream_chat(
@@ -316,17 +524,138 @@ class ChatSev:
         search_k: int = 3,
         max_length: Optional[int] = None,
         temperature: float = 0.8,
+        semantic_cache: bool = False,
+        retrieval_budget_ms: Optional[int] = None,
+    ) -> AsyncIterable[Dict[str, Any]]:
+        """
+        f-流式输出-流式聊天入口。
+        temperature == 0 的确定性请求按 (知识库, 文件过滤, 归一化问题, supplier, model,
+        API Key, 提示词, 检索参数) 做 single-flight 合并：并发的相同问题只执行一次检索与 LLM 调用，
+        follower 订阅 leader 的事件流，并各自写入自己的会话历史。
+        """
+        stream_kwargs = dict(
+            question=question,
+            api_key=api_key,
+            supplier=supplier,
+            model=model,
+            session_id=session_id,
+            knowledge_base_id=knowledge_base_id,
+            filter_by_file_md5=filter_by_file_md5,
+            search_k=search_k,
+            max_length=max_length,
+            temperature=temperature,
+            semantic_cache=semantic_cache,
+            retrieval_budget_ms=retrieval_budget_ms,
+        )
+        # 闲聊与追问依赖各自的会话历史，不同会话之间不能合并
+        history_dependent = (
+            knowledge_base_id is not None
+            and retrieval_gate.classify(question)[0] != QUESTION
+        )
+        if temperature != 0 or history_dependent:
+            async for event in self._stream_chat(**stream_kwargs):
+                yield event
+            return
+
+        flight_key = (
+            str(knowledge_base_id) if knowledge_base_id and self.knowledge else None,
+            str(filter_by_file_md5) if filter_by_file_md5 else None,
+            normalize_question(question),
+            supplier,
+            model,
+            # 不同 API Key 的请求不能合并：follower 的回答不能由 leader 的 Key 生成与计费
+            hash_text(api_key),
+            hash_text(self.prompt),
+            self.knowledge.config_signature()
+            if knowledge_base_id and self.knowledge
+            else None,
+            self._federated_key(),
+            search_k,
+            retrieval_budget_ms,
+            max_length,
+            semantic_cache,
+        )
+        flight, is_leader = single_flight.join(
+            flight_key, lambda: self._stream_chat(**stream_kwargs)
+        )
+        if is_leader:
+            # leader 的会话历史由链中的 RunnableWithMessageHistory 写入
+            async for event in single_flight.subscribe(flight):
+                yield event
+            return
+
+        logging.info(f"session_id: {session_id} 合并到进行中的相同请求 (single-flight)")
+        answer_parts: list = []
+        failed = False
+        try:
+            async for event in single_flight.subscribe(flight):
+                if event.get("type") == "chunk":
+                    answer_parts.append(event.get("data") or "")
+                elif event.get("type") == "error":
+                    failed = True
+                yield event
+        except (asyncio.CancelledError, GeneratorExit):
+            metrics.incr("chat_stream_cancelled_total")
+            _spawn_background(
+                self._save_answer(
+                    session_id, question, "".join(answer_parts), truncated=True
+                )
+            )
+            raise
+        if not failed:
+            await self._save_answer(session_id, question, "".join(answer_parts))
+
+    async def _stream_chat(
+        self,
+        question: str,
+        api_key: Optional[str],
+        supplier: str,
+        model: str,
+        session_id: str,
+        knowledge_base_id: Optional[str] = None,
+        filter_by_file_md5: Optional[str] = None,
+        search_k: int = 3,
+        max_length: Optional[int] = None,
+        temperature: float = 0.8,
+        semantic_cache: bool = False,
+        retrieval_budget_ms: Optional[int] = None,
     ) -> AsyncIterable[Dict[str, Any]]:  # 返回结构化的字典流
         """
         f-流式输出-异步执行聊天调用，并流式返回结果。
+        客户端断开导致流被取消时，会终止上游生成与检索，并仅保存已生成的部分回答 (标记为截断)。
+        semantic_cache=True 时，知识库问答会先按查询向量相似度查找语义缓存。
+        retrieval_budget_ms 为检索阶段的延迟预算，重排序超出预算时使用向量检索顺序。
         Yields:
-            字典，包含 'type' ('context', 'chunk', 'error') 和 'data'。
+            字典，包含 'type' ('context', 'sources', 'queued', 'chunk', 'error') 和 'data'。
         """
+        answer_parts: list = []  # 已发送的回答片段，用于取消时保存部分回答
+        # 链是否已完整输出 (此时 RunnableWithMessageHistory 已写入完整的一轮会话历史)
+        stream_finished = False
+        ticket: Optional[SchedulerTicket] = None  # LLM 并发调度凭证
+        started_at = time.monotonic()
         try:
+            # 0. 检索门控：闲聊跳过检索，追问复用本会话上一轮的检索上下文
+            gate: Optional[GateDecision] = None
+            gate_context_key: Optional[tuple] = None
+            gate_kb_version: Optional[int] = None  # 复用的上下文必须来自同一知识库版本
+            if knowledge_base_id and self.knowledge:
+                gate_context_key = (
+                    session_id,
+                    str(knowledge_base_id),
+                    str(filter_by_file_md5) if filter_by_file_md5 else None,
+                    self._federated_key(),
+                )
+                gate_kb_version = await get_kb_version(knowledge_base_id)
+                gate = retrieval_gate.decide(
+                    question, gate_context_key, gate_kb_version
+                )
+            # 追问的回答依赖会话历史，不使用按问题文本键控的答案缓存与语义缓存
+            history_dependent = gate is not None and gate.intent != QUESTION
+
             # 1. 确定上下文和基础链
             (
                 context_display_name,
-                base_chain,
+                cached_chain,
             ) = await self._determine_context_and_base_chain(
                 api_key,
                 supplier,
@@ -336,40 +665,137 @@ class ChatSev:
                 search_k,
                 max_length,
                 temperature,
+                gate,
             )
 
+            federated = bool(self.federated_sources) and cached_chain.retriever is not None
+            if federated:
+                context_display_name += f" 等 {len(self.federated_sources)} 个知识库"
+
             # 1.f-流式输出-发送上下文信息作为流的第一个元素
             yield {"type": "context", "data": context_display_name}
 
-            # 2.f-历史会话-包装历史记录管理
-            # RunnableWithMessageHistory 会自动处理输入和历史消息，并将 base_chain 的输出传递出去
-            chain_with_history = RunnableWithMessageHistory(
-                base_chain,
-                self.get_session_chat_history,  # f-历史会话-获取会话历史-MongoDBChatMessageHistory
-                input_messages_key="input",  # base_chain 需要 'input'
-                history_messages_key="chat_history",  # prompt 需要 'chat_history'
-                output_messages_key="answer",  # 指定从 base_chain 输出字典中提取 'answer' 作为 AI 消息保存
-                history_factory_config=[
-                    ConfigurableFieldSpec(
-                        id="session_id",
-                        annotation=str,
-                        name="Session ID",
-                        description="Unique identifier for the chat session.",
-                        default="",
-                        is_shared=True,
-                    )
-                ],
+            chain_input: Dict[str, Any] = {"input": question}
+            config = self._build_run_config(
+                session_id, filter_by_file_md5, search_k, retrieval_budget_ms
             )
+            answer_cache_key: Optional[str] = None
+
+            # 知识库版本号：依赖检索结果的各级缓存都以它为键的一部分，Redis 不可用时为 None
+            # 联合检索的结果依赖多个知识库的版本，不使用这些按单个知识库键控的缓存
+            kb_version: Optional[int] = None
+            if cached_chain.retriever is not None and not federated:
+                if gate_context_key is not None and cached_chain.kb_id == str(
+                    knowledge_base_id
+                ):
+                    kb_version = gate_kb_version  # 门控时已读取
+                else:
+                    kb_version = await get_kb_version(cached_chain.kb_id)
+
+            # 1.1 语义缓存：与历史问题足够相似时直接回放历史答案 (跳过检索与 LLM)
+            semantic_key: Optional[tuple] = None
+            query_vector: Optional[list] = None
+            if (
+                cached_chain.retriever is not None
+                and semantic_cache
+                and not history_dependent
+            ):
+                if kb_version is not None:
+                    # 与 single-flight 键相同的请求参数 (不含问题)：只在生成条件一致的请求间复用答案
+                    semantic_key = (
+                        cached_chain.kb_id,  # 第一个元素为知识库 ID (按知识库失效)
+                        str(filter_by_file_md5) if filter_by_file_md5 else None,
+                        supplier,
+                        model,
+                        hash_text(api_key),
+                        hash_text(self.prompt),
+                        self.knowledge.config_signature(),
+                        search_k,
+                        retrieval_budget_ms,
+                        max_length,
+                        temperature,
+                    )
+                    query_vector = await self.knowledge.aembed_query(question)
+                    hit = semantic_answer_cache.lookup(
+                        semantic_key, kb_version, query_vector
+                    )
+                    if hit:
+                        logging.info(
+                            f"语义缓存命中 (session_id: {session_id}, 相似度: {hit.similarity:.3f})"
+                        )
+                        async for event in self._replay_cached_answer(
+                            session_id, question, hit.answer, answer_parts
+                        ):
+                            yield event
+                        return
+
+            # 1.2 RAG：先单独执行检索，检索结果随后直接交给链，不会重复检索
+            docs: list = []
+            if cached_chain.retriever is not None:
+                if gate is not None and gate.action == "reuse":
+                    docs = gate.docs
+                elif federated:
+                    docs = await self._federated_retrieve(
+                        question, filter_by_file_md5, search_k, retrieval_budget_ms
+                    )
+                    docs = await asyncio.to_thread(pack_context, docs)
+                    retrieval_gate.remember(gate_context_key, docs, gate_kb_version)
+                else:
+                    docs = await self._retrieve(
+                        cached_chain,
+                        question,
+                        filter_by_file_md5,
+                        search_k,
+                        kb_version,
+                        config,
+                    )
+                    # 合并相邻块、去除近似重复，并在 token 预算内按分数截取上下文
+                    # (SimHash 与 token 计数为 CPU 密集计算，在线程中执行，不阻塞事件循环)
+                    docs = await asyncio.to_thread(pack_context, docs)
+                    retrieval_gate.remember(gate_context_key, docs, gate_kb_version)
+                chain_input["context"] = docs
+                # 检索 (含重排序) 完成即发送引用来源，早于第一个 LLM token
+                yield {"type": "sources", "data": _build_sources(docs)}
+
+                # 1.3 确定性请求 (temperature == 0) 查询答案缓存，命中则直接回放
+                if (
+                    temperature == 0
+                    and kb_version is not None
+                    and not history_dependent
+                ):
+                    answer_cache_key = self._build_answer_cache_key(
+                        cached_chain.kb_id,
+                        kb_version,
+                        filter_by_file_md5,
+                        question,
+                        supplier,
+                        model,
+                        docs,
+                    )
+                if answer_cache_key:
+                    cached_answer = await get_cached_answer(answer_cache_key)
+                    if cached_answer:
+                        logging.info(f"答案缓存命中 (session_id: {session_id})")
+                        async for event in self._replay_cached_answer(
+                            session_id, question, cached_answer, answer_parts
+                        ):
+                            yield event
+                        return
+
+            # 2.准入控制：按 (supplier, model) 限制并发，超出上限时按会话公平排队
+            ticket = llm_scheduler.submit(supplier, model, session_id)
+            async for queued_event in self._wait_for_llm_slot(ticket):
+                yield queued_event
+
+            # 2.1 f-历史会话-使用缓存中已包装历史记录管理的链
+            chain_with_history = cached_chain.chain_with_history
 
             # 3. f-流式输出-配置并调用 astream
-            config: RunnableConfig = {"configurable": {"session_id": session_id}}
             logging.info(
-                f"使用 session_id: {session_id} 调用流式链 ({'RAG' if knowledge_base_id and self.knowledge else 'Normal'})... 上下文: {context_display_name}"
+                f"使用 session_id: {session_id} 调用流式链 ({'RAG' if cached_chain.kb_id else 'Normal'})... 上下文: {context_display_name}"
             )
             # f-流式输出-Chain.astream()
-            stream_iterator = chain_with_history.astream(
-                {"input": question}, config=config
-            )
+            stream_iterator = chain_with_history.astream(chain_input, config=config)
 
             # 4. f-流式输出-处理流式块
             async for chunk in stream_iterator:
@@ -415,14 +841,170 @@ class ChatSev:
                 # --- 结束核心处理逻辑 ---
                 # 发送 chunk
                 if content_piece:  # 仅当提取到有效内容时才发送 chunk
+                    answer_parts.append(content_piece)
                     yield {"type": "chunk", "data": content_piece}
+            stream_finished = True
 
+            # 5. 完整生成的回答写入答案缓存与语义缓存
+            if answer_parts:
+                full_answer = "".join(answer_parts)
+                if answer_cache_key:
+                    await set_cached_answer(answer_cache_key, full_answer)
+                if semantic_key is not None and query_vector is not None:
+                    semantic_answer_cache.store(
+                        semantic_key,
+                        kb_version,
+                        query_vector,
+                        full_answer,
+                        chunk_ids_of(docs),
+                        latency=time.monotonic() - started_at,
+                    )
+
+        except (asyncio.CancelledError, GeneratorExit):
+            # 客户端断开：上游 astream (含检索与重排序) 随本生成器一同被取消
+            logging.info(
+                f"流式处理被取消 (session_id: {session_id})，已生成 {len(answer_parts)} 个片段。"
+            )
+            metrics.incr("chat_stream_cancelled_total")
+            # 链已完整输出后 (写入缓存时) 才被取消的，会话历史已由链写入，不再保存截断的回答
+            if not stream_finished:
+                _spawn_background(
+                    self._save_answer(
+                        session_id, question, "".join(answer_parts), truncated=True
+                    )
+                )
+            raise
+        except QueueTimeoutError as e:
+            logging.warning(f"排队超时 (session_id: {session_id}): {e}")
+            yield {"type": "error", "data": f"服务繁忙，请稍后重试: {e}"}
         except Exception as e:
             logging.error(
                 f"流式处理时发生错误 (session_id: {session_id}): {e}", exc_info=True
             )
             # 在流中发送错误信息
             yield {"type": "error", "data": f"处理请求时发生错误: {e}"}
+        finally:
+            if ticket is not None:
+                ticket.release()
+
+    async def _replay_cached_answer(
+        self, session_id: str, question: str, answer: str, answer_parts: list
+    ) -> AsyncIterable[Dict[str, Any]]:
+        """以 chunk 事件快速回放缓存的答案，并写入会话历史"""
+        for piece in iter_replay_chunks(answer):
+            answer_parts.append(piece)
+            yield {"type": "chunk", "data": piece}
+        await self._save_answer(session_id, question, answer)
+
+    async def _retrieve(
+        self,
+        cached_chain: CachedChain,
+        question: str,
+        filter_by_file_md5: Optional[str],
+        search_k: int,
+        kb_version: Optional[int],
+        config: RunnableConfig,
+    ) -> List[Document]:
+        """
+        执行知识库检索。知识库版本号可用时先查检索结果缓存 (块 ID 与分数)，
+        命中则按 ID 取回文档，跳过向量检索与重排序。
+        重排序因超时或出错被跳过的降级结果不写入缓存，以便后续请求重新获得重排序结果。
+        """
+        cache_key: Optional[str] = None
+        if kb_version is not None:
+            cache_key = build_retrieval_cache_key(
+                kb_id=cached_chain.kb_id,
+                kb_version=kb_version,
+                filter_by_file_md5=filter_by_file_md5,
+                question=normalize_question(question),
+                search_k=search_k,
+                config_signature=self.knowledge.config_signature(),
+            )
+            docs = await retrieval_cache.get(
+                cache_key, self.knowledge, cached_chain.kb_id
+            )
+            if docs is not None:
+                logging.info(f"检索缓存命中，取回 {len(docs)} 个文档块。")
+                return docs
+
+        started_at = time.perf_counter()
+        docs = await cached_chain.retriever.ainvoke(question, config=config)
+        elapsed = time.perf_counter() - started_at
+        metrics.observe("retrieval_seconds", elapsed)
+        retrieval_gate.record_retrieval(elapsed)
+        degraded = any(
+            (doc.metadata or {}).get("retrieval_path") in RERANK_FALLBACK_PATHS
+            for doc in docs
+        )
+        if cache_key and docs and not degraded:
+            await retrieval_cache.set(cache_key, docs)
+        return docs
+
+    async def _federated_retrieve(
+        self,
+        question: str,
+        filter_by_file_md5: Optional[str],
+        search_k: int,
+        retrieval_budget_ms: Optional[int],
+    ) -> List[Document]:
+        """多知识库联合检索：各知识库并发检索、融合后由主知识库的重排序器统一重排一次"""
+        filter_dict = _file_scope_filter(filter_by_file_md5)
+        started_at = time.perf_counter()
+        docs = await afederated_retrieve(
+            self.federated_sources,
+            question,
+            reranker=self.knowledge,
+            filter_dict=filter_dict,
+            search_k=search_k,
+            budget_ms=retrieval_budget_ms,
+            fusion=self.fusion,
+        )
+        elapsed = time.perf_counter() - started_at
+        metrics.observe("retrieval_seconds", elapsed, mode="federated")
+        retrieval_gate.record_retrieval(elapsed)
+        return docs
+
+    def _build_answer_cache_key(
+        self,
+        kb_id: str,
+        kb_version: int,
+        filter_by_file_md5: Optional[str],
+        question: str,
+        supplier: str,
+        model: str,
+        docs: list,
+    ) -> str:
+        """构造答案缓存键"""
+        return build_answer_cache_key(
+            kb_id=kb_id,
+            kb_version=kb_version,
+            filter_by_file_md5=filter_by_file_md5,
+            question=normalize_question(question),
+            supplier=supplier,
+            model=model,
+            prompt_hash=hash_text(self.prompt),
+            chunk_ids=chunk_ids_of(docs),
+        )
+
+    async def _wait_for_llm_slot(
+        self, ticket: SchedulerTicket
+    ) -> AsyncIterable[Dict[str, Any]]:
+        """
+        等待调度器分配 LLM 执行槽。
+        排队期间定期产出 'queued' 事件 (携带队列位置)，超过最长等待时间抛出 QueueTimeoutError。
+        """
+        if ticket.granted:
+            return
+        deadline = time.monotonic() + llm_scheduler.max_wait_seconds
+        while not ticket.granted:
+            yield {"type": "queued", "data": {"position": ticket.position()}}
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                metrics.incr("llm_queue_timeouts_total", lane=ticket.lane.name)
+                raise QueueTimeoutError(
+                    f"排队超过 {llm_scheduler.max_wait_seconds} 秒 ({ticket.lane.name})"
+                )
+            await ticket.wait(min(LLM_QUEUE_REPORT_INTERVAL_SECONDS, remaining))
 
     # 废弃-保留 invoke 方法，以防需要非流式接口
     # 注意：当前的 invoke 实现依赖于旧的链结构和 streaming_parse，需要更新以匹配新逻辑
@@ -445,7 +1027,7 @@ class ChatSev:
         异步执行聊天调用，并一次性返回结果。
         """
         logging.warning("调用了旧版 invoke 方法，考虑切换到 stream_chat。")
-        context_display_name, base_chain = await self._determine_context_and_base_chain(
+        context_display_name, cached_chain = await self._determine_context_and_base_chain(
             api_key,
             supplier,
             model,
@@ -480,7 +1062,7 @@ class ChatSev:
                     "context_display_name": context_display_name,
                 }
 
-        final_chain = base_chain | RunnableLambda(format_output)
+        final_chain = cached_chain.base_chain | RunnableLambda(format_output)
 
         chain_with_history = RunnableWithMessageHistory(
             final_chain,  # 使用调整后的链
@@ -500,9 +1082,9 @@ class ChatSev:
             ],
         )
 
-        config = {"configurable": {"session_id": session_id}}
+        config = self._build_run_config(session_id, filter_by_file_md5, search_k)
         logging.info(
-            f"使用 session_id: {session_id} 调用非流式链 ({'RAG' if knowledge_base_id and self.knowledge else 'Normal'})... 上下文: {context_display_name}"
+            f"使用 session_id: {session_id} 调用非流式链 ({'RAG' if cached_chain.kb_id else 'Normal'})... 上下文: {context_display_name}"
         )
 
         try:
@@ -520,6 +1102,31 @@ class ChatSev:
                 "context_display_name": context_display_name,
             }
 
+    async def _save_answer(
+        self, session_id: str, question: str, answer: str, truncated: bool = False
+    ) -> None:
+        """
+        直接写入一轮对话到会话历史：用户问题 + 回答。
+        用于未经 RunnableWithMessageHistory 的路径 (被取消的流、single-flight 的 follower)。
+        truncated=True 时回答通过 additional_kwargs 标记为截断。
+        """
+        try:
+            history = self.get_session_chat_history(session_id)
+            messages: list = [HumanMessage(content=question)]
+            if answer:
+                messages.append(
+                    AIMessage(
+                        content=answer,
+                        additional_kwargs={"truncated": True} if truncated else {},
+                    )
+                )
+            await history.aadd_messages(messages)
+            logging.info(
+                f"已保存 session_id: {session_id} 的{'被截断的部分' if truncated else ''}回答。"
+            )
+        except Exception as e:
+            logging.error(f"保存回答到会话历史时出错 (session: {session_id}): {e}")
+
     def clear_history(self, session_id: str) -> None:
         """清除指定 session_id 的历史信息"""
         history = self.get_session_chat_history(session_id)
@@ -7,6 +7,7 @@ from pydantic import BaseModel
 from src.models.assistant import Assistant
 from src.models.session import Session
 from src.service.ChatSev import ChatSev
+from src.utils.chain_cache import chain_cache
 
 
 class AssistantRequest(BaseModel):
@@ -14,6 +15,7 @@ class AssistantRequest(BaseModel):
     username: str
     prompt: str = "你是一个AI助手，请根据用户的问题给出回答。"
     knowledge_Id: str | None = None
+    extra_knowledge_Ids: list[str] = []
 
 
 async def create_assistant(assistant_data: AssistantRequest) -> Assistant:
@@ -26,6 +28,7 @@ async def create_assistant(assistant_data: AssistantRequest) -> Assistant:
             - username: 用户名
             - prompt: 助手提示词 (可选)
             - knowledge_Id: 知识库ID (可选)
+            - extra_knowledge_Ids: 联合检索的其他知识库ID列表 (可选)
 
     Returns:
         返回创建的 Assistant 文档对象。
@@ -39,6 +42,7 @@ async def create_assistant(assistant_data: AssistantRequest) -> Assistant:
         username=assistant_data.username,
         prompt=assistant_data.prompt,
         knowledge_Id=assistant_data.knowledge_Id,
+        extra_knowledge_Ids=assistant_data.extra_knowledge_Ids,
     )
     await assistant_doc.insert()
     return assistant_doc
@@ -67,7 +71,7 @@ async def update_assistant(
 ) -> Assistant:
     """
     根据助手 ID 更新指定助手的信息。
-    只更新 title, prompt, knowledge_Id。
+    只更新 title, prompt, knowledge_Id, extra_knowledge_Ids。
 
     Args:
         assistant_id: 要更新的助手的 ID (来自路径参数)。
@@ -76,6 +80,7 @@ async def update_assistant(
             - username: (此字段在更新时被忽略)
             - prompt: 新的助手提示词 (可选)
             - knowledge_Id: 新的知识库ID (可选)
+            - extra_knowledge_Ids: 新的联合检索知识库ID列表 (可选)
 
     Returns:
         更新后的 Assistant 文档对象。
@@ -92,9 +97,13 @@ async def update_assistant(
     if not assistant:
         raise HTTPException(status_code=404, detail="找不到指定的助手")
 
+    # 提示词可能变更，使旧提示词下缓存的链失效
+    chain_cache.invalidate_prompt(assistant.prompt)
+
     assistant.title = assistant_data.title
     assistant.prompt = assistant_data.prompt
     assistant.knowledge_Id = assistant_data.knowledge_Id
+    assistant.extra_knowledge_Ids = assistant_data.extra_knowledge_Ids
 
     await assistant.save()
     return assistant
@@ -135,6 +144,7 @@ async def delete_assistant(assistant_id: str) -> dict:
             print(f"删除会话 {session.id} 或其历史记录时出错: {e}")
 
     await assistant.delete()
+    chain_cache.invalidate_prompt(assistant.prompt)
 
     return {"message": "助手及关联会话已成功删除"}
 
@@ -1,22 +1,30 @@
+import asyncio
 import json  # 导入 json
 import logging  # 导入 logging
 import os
 import shutil  # 用于文件操作和删除目录
 import tempfile  # 用于创建临时文件
 from datetime import datetime, timedelta  # 导入 datetime 和 timedelta 模块
-from typing import Union
+from typing import Optional, Union
 
 import redis.asyncio as aioredis  # 导入 aioredis
 from bson import ObjectId  # 用于验证 kb_id
 from fastapi import HTTPException, UploadFile  # 添加 HTTPException
-from langchain_chroma import Chroma  # 添加 Chroma 导入
 
 from src.config.Redis import get_redis_client  # 导入 get_redis_client
 from src.models.knowledgeBase import (
     KnowledgeBase as KnowledgeBaseModel,
 )
+from src.utils import write_queue
+from src.utils.chain_cache import chain_cache
 from src.utils.embedding import get_embedding
+from src.utils.file_summary import FileSummaryIndex
+from src.utils.flat_index import FlatIndexStore
 from src.utils.Knowledge import Knowledge
+from src.utils.retrieval_gate import retrieval_gate
+from src.utils.segmented_store import SegmentedChromaStore
+from src.utils.semantic_cache import semantic_cache
+from src.utils.sharded_store import SHARD_GC_GRACE_SECONDS, ShardedVectorStore, reshard
 
 chroma_dir = "chroma/"  # 确保这里有定义
 logger = logging.getLogger(__name__)  # 获取 logger 实例
@@ -24,6 +32,10 @@ logger = logging.getLogger(__name__)  # 获取 logger 实例
 # --- Redis 缓存相关常量 ---
 KB_CACHE_PREFIX = "kb:"  # 知识库缓存键前缀
 KB_CACHE_TTL_SECONDS = int(timedelta(days=1).total_seconds())  # 缓存 TTL: 1天
+KB_VERSION_PREFIX = "kb_version:"  # 知识库版本号键前缀 (文件增删时递增)
+
+# 正在重新分片的知识库 ID (期间直接拒绝新的文件增删，而不是让它们在写入队列中长时间等待)
+_resharding_kbs: set = set()
 
 
 # --- Redis 缓存辅助函数 ---
@@ -69,6 +81,43 @@ async def _delete_kb_cache(kb_id: Union[str, ObjectId]):
         logger.error(f"删除知识库 {kb_id} 缓存时发生未知错误: {e}", exc_info=True)
 
 
+# --- 知识库版本号 ---
+async def get_kb_version(kb_id: Union[str, ObjectId]) -> Optional[int]:
+    """
+    获取知识库的版本号 (单调递增，文件增删或知识库删除时加一)。
+    依赖版本号的缓存把它放进缓存键，使旧条目自然失效。Redis 不可用时返回 None。
+    """
+    try:
+        redis = get_redis_client()
+        version = await redis.get(f"{KB_VERSION_PREFIX}{kb_id}")
+        return int(version) if version else 0
+    except (RuntimeError, aioredis.RedisError) as e:
+        logger.warning(f"获取知识库 {kb_id} 版本号失败: {e}")
+        return None
+
+
+async def _bump_kb_version(kb_id: Union[str, ObjectId]) -> None:
+    """递增知识库版本号"""
+    try:
+        redis = get_redis_client()
+        version = await redis.incr(f"{KB_VERSION_PREFIX}{kb_id}")
+        logger.info(f"知识库 {kb_id} 版本号已递增为 {version}。")
+    except (RuntimeError, aioredis.RedisError) as e:
+        logger.error(f"递增知识库 {kb_id} 版本号失败: {e}")
+
+
+async def _on_kb_changed(kb_id: Union[str, ObjectId]) -> None:
+    """
+    知识库内容变更 (文件增删、知识库删除) 后调用：
+    递增版本号 (跨进程失效依赖版本号的缓存)，并清理本进程内的链缓存、语义缓存
+    与检索门控保存的检索上下文。
+    """
+    await _bump_kb_version(kb_id)
+    chain_cache.invalidate_kb(kb_id)
+    semantic_cache.invalidate_kb(str(kb_id))
+    retrieval_gate.invalidate_kb(str(kb_id))
+
+
 # --- 缓存预加载函数 ---
 async def load_all_knowledge_bases_to_cache():
     """从 MongoDB 加载所有 KnowledgeBase 文档并写入 Redis 缓存。"""
@@ -102,6 +151,9 @@ async def create_knowledge(knowledge_base_data, current_user) -> KnowledgeBaseMo
         # 直接将 Pydantic 模型转换为字典或 Beanie 能处理的对象
         # Beanie 通常可以直接处理 Pydantic 模型
         embedding_config=embedding_config_data,  # 传递 EmbeddingConfig 实例
+        vector_backend=knowledge_base_data.vector_backend,
+        vector_dtype=knowledge_base_data.vector_dtype,
+        shard_count=knowledge_base_data.shard_count,
         filesList=[],  # 初始化为空列表
     )
     await new_knowledge_base.insert()
@@ -134,6 +186,8 @@ async def process_uploaded_file(
         or not knowledge_base_doc.embedding_config.embedding_supplier
     ):
         raise ValueError(f"知识库 {kb_id} 的嵌入配置不完整。")
+    if str(kb_id) in _resharding_kbs:
+        raise ValueError(f"知识库 {kb_id} 正在重新分片，请稍后再上传文件。")
 
     # 2. 将上传的文件保存到临时位置
     # 使用 tempfile 确保安全和自动清理
@@ -177,9 +231,14 @@ async def process_uploaded_file(
             config.embedding_model,
             config.embedding_apikey,  # 使用配置中的 API Key
         )
-        knowledge_util = Knowledge(_embeddings=_embedding)
+        knowledge_util = Knowledge(
+            _embeddings=_embedding,
+            vector_backend=knowledge_base_doc.vector_backend,
+            vector_dtype=knowledge_base_doc.vector_dtype,
+            shard_count=knowledge_base_doc.shard_count,
+        )
 
-        # 6. 调用 Knowledge 类处理文件并存入 Chroma
+        # 6. 调用 Knowledge 类处理文件并存入向量库 (Chroma 或平铺索引)
         await knowledge_util.add_file_to_knowledge_base(
             kb_id=kb_id,
             file_path=tmp_file_path,  # 使用临时文件路径
@@ -200,6 +259,8 @@ async def process_uploaded_file(
         logger.info(
             f"文件 {file.filename} (MD5: {file_md5}) 元数据已添加到 MongoDB 知识库 {kb_id}。"
         )
+        # 知识库内容变更，递增版本号并使相关缓存失效
+        await _on_kb_changed(kb_id)
 
         # 8. 更新 Redis 缓存 (在 MongoDB 更新之后)
         # 重新获取最新文档并更新缓存
@@ -281,9 +342,17 @@ async def delete_knowledge_base(kb_id: str) -> None:
             # 记录错误，但继续尝试删除缓存
     else:
         logger.info(f"ChromaDB 目录 '{collection_path}' 不存在或不是目录，无需删除。")
+    try:
+        FlatIndexStore.destroy(kb_id_str)
+        ShardedVectorStore.destroy(kb_id_str)
+        SegmentedChromaStore.destroy(kb_id_str)
+        FileSummaryIndex.destroy(kb_id_str)
+    except OSError as e:
+        logger.error(f"删除平铺索引/分片存储 '{kb_id_str}' 时出错: {e}")
 
     # 3. 删除 Redis 缓存
     await _delete_kb_cache(kb_id)
+    await _on_kb_changed(kb_id)
 
 
 async def delete_file_from_knowledge_base(kb_id: str, file_md5: str) -> dict:
@@ -298,6 +367,10 @@ async def delete_file_from_knowledge_base(kb_id: str, file_md5: str) -> dict:
     knowledge_base_doc = await KnowledgeBaseModel.get(ObjectId(kb_id))
     if not knowledge_base_doc:
         raise HTTPException(status_code=404, detail=f"知识库 ID 未找到: {kb_id}")
+    if str(kb_id) in _resharding_kbs:
+        raise HTTPException(
+            status_code=409, detail=f"知识库 {kb_id} 正在重新分片，请稍后再删除文件。"
+        )
 
     # 3. 更新 MongoDB: 从 filesList 移除文件信息
     logger.info(f"从 MongoDB 知识库 {kb_id} 的 filesList 中移除 MD5: {file_md5}")
@@ -307,7 +380,6 @@ async def delete_file_from_knowledge_base(kb_id: str, file_md5: str) -> dict:
 
     # 4. 删除 ChromaDB 中的相关向量
     kb_id_str = str(kb_id)
-    persist_directory = os.path.join(chroma_dir, kb_id_str)
     collection_exists = Knowledge.is_already_vector_database(kb_id_str)
 
     chroma_deleted = False  # 标记 Chroma 是否尝试删除
@@ -339,19 +411,14 @@ async def delete_file_from_knowledge_base(kb_id: str, file_md5: str) -> dict:
                 config.embedding_model,
                 config.embedding_apikey,  # 使用配置中的 API Key (如果需要的话)
             )
-            vectorstore = Chroma(
-                collection_name=kb_id_str,
-                persist_directory=persist_directory,
-                embedding_function=_embedding,
-            )
-
-            # 执行删除 (同步操作)
-            # TODO: 考虑改为异步执行器 vectorstore.delete(where={"source_file_md5": file_md5})
+            # 按知识库实际使用的后端删除，在专用的向量执行器中执行
             logger.info(
-                f"执行 ChromaDB 删除操作 (同步), filter: {{'source_file_md5': '{file_md5}'}}"
+                f"执行向量删除操作, filter: {{'source_file_md5': '{file_md5}'}}"
             )
             # ChromaDB 的 delete 方法不返回删除的数量，无法直接判断效果
-            vectorstore.delete(where={"source_file_md5": file_md5})
+            await Knowledge(_embeddings=_embedding).adelete_file_vectors(
+                kb_id_str, file_md5
+            )
             logger.info(
                 f"ChromaDB 集合 '{kb_id_str}' 中与 MD5 {file_md5} 相关的向量已删除。"
             )
@@ -365,6 +432,8 @@ async def delete_file_from_knowledge_base(kb_id: str, file_md5: str) -> dict:
     else:
         logger.info(f"ChromaDB 集合 '{kb_id_str}' 不存在，无需删除向量。")
 
+    await _on_kb_changed(kb_id)
+
     # 更新 Redis 缓存 (无论 Chroma 是否删除，只要 MongoDB 更新了就要更新缓存)
     # 重新获取最新文档来更新缓存
     updated_kb_doc = await KnowledgeBaseModel.get(ObjectId(kb_id))
@@ -376,3 +445,157 @@ async def delete_file_from_knowledge_base(kb_id: str, file_md5: str) -> dict:
         await _delete_kb_cache(kb_id)
 
     return {"message": f"文件 MD5 {file_md5} 已成功从知识库 {kb_id} 删除。"}
+
+
+async def _get_flat_index_store(kb_id: str) -> FlatIndexStore:
+    """获取 numpy 后端知识库的平铺索引 (IVF 维护任务无需 embedding 函数)"""
+    if not ObjectId.is_valid(kb_id):
+        raise ValueError(f"无效的知识库 ID 格式: {kb_id}")
+    knowledge_base_doc = await KnowledgeBaseModel.get(ObjectId(kb_id))
+    if not knowledge_base_doc:
+        raise FileNotFoundError(f"知识库 ID 未找到: {kb_id}")
+    if knowledge_base_doc.vector_backend != "numpy" or not FlatIndexStore.exists(
+        str(kb_id)
+    ):
+        raise ValueError(f"知识库 {kb_id} 不是已有数据的 numpy 后端知识库，无法使用 IVF/量化维护接口。")
+    return FlatIndexStore(str(kb_id), None)
+
+
+async def build_ivf_index(
+    kb_id: str, n_lists: Optional[int] = None, default_nprobe: Optional[int] = None
+) -> dict:
+    """(重新) 构建知识库的 IVF 近似索引 (在线程池中执行，完成后原子发布)"""
+    store = await _get_flat_index_store(kb_id)
+    result = await asyncio.to_thread(store.build_ivf, n_lists, default_nprobe)
+    # 检索结果可能变化，使检索/答案缓存失效
+    await _on_kb_changed(kb_id)
+    return result
+
+
+async def get_ivf_recall_report(
+    kb_id: str, k: int = 10, nprobes: Optional[list] = None, n_queries: int = 100
+) -> dict:
+    """IVF 的 recall@k 与延迟报告 (相对精确检索)"""
+    store = await _get_flat_index_store(kb_id)
+    kwargs = {"k": k, "n_queries": n_queries}
+    if nprobes:
+        kwargs["nprobes"] = nprobes
+    return await asyncio.to_thread(store.ivf_recall_report, **kwargs)
+
+
+async def get_quantization_report(kb_id: str, k: int = 10, n_queries: int = 100) -> dict:
+    """int8 量化知识库的召回率、延迟与内存占用基准 (相对浮点精确检索)"""
+    store = await _get_flat_index_store(kb_id)
+    return await asyncio.to_thread(store.quantization_report, k=k, n_queries=n_queries)
+
+
+# 持有后台任务的引用，防止任务在完成前被垃圾回收
+_background_tasks: set = set()
+
+
+def _spawn_background(coro) -> None:
+    task = asyncio.ensure_future(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+
+
+async def _drop_unsharded_later(kb_id: str) -> None:
+    """
+    重新分片后删除未分片的旧存储。进行中的检索与缓存中的旧实例可能仍在读取它
+    (Chroma 后端为打开中的 sqlite 文件)，等待 SHARD_GC_GRACE_SECONDS 秒后
+    再作为写入队列中的一次写入删除。
+    """
+
+    def drop() -> None:
+        if not ShardedVectorStore.exists(kb_id):
+            return  # 知识库已被删除
+        collection_path = os.path.join(chroma_dir, kb_id)
+        if os.path.isdir(collection_path):
+            shutil.rmtree(collection_path, ignore_errors=True)
+        FlatIndexStore.destroy(kb_id)
+        SegmentedChromaStore.destroy(kb_id)
+
+    await asyncio.sleep(SHARD_GC_GRACE_SECONDS)
+    try:
+        await write_queue.submit_write(kb_id, "drop_unsharded", drop)
+        logger.info(f"已删除知识库 {kb_id} 重新分片前的未分片存储。")
+    except Exception as e:
+        logger.error(f"删除知识库 {kb_id} 重新分片前的未分片存储失败: {e}", exc_info=True)
+
+
+async def reshard_knowledge_base(kb_id: str, shard_count: int) -> dict:
+    """
+    将知识库 (未分片或已分片) 重新划分为 shard_count 个分片。
+    迁移复用已存储的向量，作为该知识库写入队列中的屏障执行：之前排队的上传/删除先落盘，
+    之后的写入等新布局切换完成后再写入，迁移期间不会有写入落到即将删除的旧存储中。
+    新布局写完后原子切换，期间检索仍读旧存储。
+    """
+    if not ObjectId.is_valid(kb_id):
+        raise ValueError(f"无效的知识库 ID 格式: {kb_id}")
+    knowledge_base_doc = await KnowledgeBaseModel.get(ObjectId(kb_id))
+    if not knowledge_base_doc:
+        raise FileNotFoundError(f"知识库 ID 未找到: {kb_id}")
+
+    kb_id_str = str(kb_id)
+    if kb_id_str in _resharding_kbs:
+        raise ValueError(f"知识库 {kb_id} 正在重新分片。")
+    config = knowledge_base_doc.embedding_config
+    _embedding = get_embedding(
+        config.embedding_supplier, config.embedding_model, config.embedding_apikey
+    )
+    knowledge = Knowledge(_embeddings=_embedding)
+    replaced_unsharded = []
+
+    def run_reshard() -> dict:
+        if not Knowledge.is_already_vector_database(kb_id_str):
+            return {"shard_count": shard_count, "rows": 0}
+        source = knowledge.load_knowledge(kb_id_str)
+        result = reshard(
+            source,
+            kb_id_str,
+            _embedding,
+            knowledge_base_doc.vector_backend,
+            shard_count,
+            knowledge_base_doc.vector_dtype,
+        )
+        if not isinstance(source, ShardedVectorStore):
+            replaced_unsharded.append(True)
+        return result
+
+    _resharding_kbs.add(kb_id_str)
+    try:
+        result = await write_queue.submit_write(kb_id_str, "reshard", run_reshard)
+    finally:
+        _resharding_kbs.discard(kb_id_str)
+    if replaced_unsharded:
+        # 新的分片布局已发布 (加载时优先使用)，未分片的旧存储在宽限期后删除
+        _spawn_background(_drop_unsharded_later(kb_id_str))
+
+    await knowledge_base_doc.update({"$set": {"shard_count": shard_count}})
+    await _on_kb_changed(kb_id)
+    updated_kb_doc = await KnowledgeBaseModel.get(ObjectId(kb_id))
+    if updated_kb_doc:
+        await _set_kb_cache(updated_kb_doc)
+    return result
+
+
+async def build_file_summaries(kb_id: str) -> dict:
+    """为已有知识库回填文件级摘要向量 (由已存储的块向量计算，不重新调用嵌入模型)"""
+    if not ObjectId.is_valid(kb_id):
+        raise ValueError(f"无效的知识库 ID 格式: {kb_id}")
+    knowledge_base_doc = await KnowledgeBaseModel.get(ObjectId(kb_id))
+    if not knowledge_base_doc:
+        raise FileNotFoundError(f"知识库 ID 未找到: {kb_id}")
+    kb_id_str = str(kb_id)
+    if not Knowledge.is_already_vector_database(kb_id_str):
+        raise FileNotFoundError(f"知识库 {kb_id} 尚无向量数据。")
+    config = knowledge_base_doc.embedding_config
+    _embedding = get_embedding(
+        config.embedding_supplier, config.embedding_model, config.embedding_apikey
+    )
+    vectorstore = Knowledge(_embeddings=_embedding).load_knowledge(kb_id_str)
+    return await asyncio.to_thread(
+        FileSummaryIndex(kb_id_str).rebuild,
+        vectorstore,
+        knowledge_base_doc.filesList or [],
+    )
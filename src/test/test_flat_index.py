@@ -0,0 +1,103 @@
+import numpy as np
+import pytest
+
+pytest.importorskip("langchain_core")
+
+from src.utils import flat_index  # noqa: E402
+from src.utils.flat_index import FlatIndexStore  # noqa: E402
+
+DIM = 32
+
+
+class _Embeddings:
+    """按文本内容生成确定的随机向量"""
+
+    def embed_documents(self, texts):
+        return [self.embed_query(text) for text in texts]
+
+    def embed_query(self, text):
+        seed = int.from_bytes(text.encode("utf-8")[:8].ljust(8, b"\0"), "little")
+        return np.random.default_rng(seed).normal(size=DIM).tolist()
+
+
+def _store(tmp_path, dtype="float32") -> FlatIndexStore:
+    return FlatIndexStore(
+        "kb", _Embeddings(), persist_directory=str(tmp_path / "kb"), dtype=dtype
+    )
+
+
+def _add(store, prefix, n, md5):
+    ids = [f"{prefix}{i}" for i in range(n)]
+    store.add_texts(ids, [{"source_file_md5": md5} for _ in ids], ids=ids)
+    return ids
+
+
+def _brute_force(store, query, k):
+    snapshot = store.snapshot()
+    scores = np.asarray(snapshot.float_vectors, dtype=np.float32) @ query
+    return [snapshot.row(int(i))["id"] for i in np.argsort(-scores)[:k]]
+
+
+def _query(seed=3):
+    vector = np.random.default_rng(seed).normal(size=(1, DIM))
+    return flat_index._normalize_rows(vector)[0]
+
+
+def test_append_delete_search_round_trip(tmp_path):
+    store = _store(tmp_path)
+    _add(store, "a", 50, "m1")
+    path = store.snapshot().path
+    _add(store, "b", 50, "m2")
+    snapshot = store.snapshot()
+    # 追加写入原地扩展当前版本目录
+    assert snapshot.path == path and snapshot.count == 100
+
+    hits = store.similarity_search_with_score("b7", k=1)
+    assert hits[0][0].id == "b7" and hits[0][1] == pytest.approx(1.0, abs=1e-5)
+    filtered = store.similarity_search_with_score(
+        "a3", k=5, filter={"source_file_md5": "m2"}
+    )
+    assert filtered and all(doc.id.startswith("b") for doc, _ in filtered)
+
+    store.delete(ids=["b7"])
+    store.delete(where={"source_file_md5": "m1"})
+    assert store.snapshot().count == 49
+    assert store.get_by_ids(["b7", "a3", "b8"])[0].id == "b8"
+    assert all(doc.id != "b7" for doc, _ in store.similarity_search_with_score("b7", k=5))
+    assert store.similarity_search("a3", k=5, filter={"source_file_md5": "m1"}) == []
+
+
+def test_int8_rescoring_matches_float_baseline(tmp_path):
+    store = _store(tmp_path, dtype="int8")
+    _add(store, "d", 400, "m1")
+    snapshot = store.snapshot()
+    assert snapshot.quantized
+    query = _query()
+    approx = snapshot.search(query, 10, nprobe=0)
+    exact = snapshot.search(query, 10, nprobe=0, exact=True)
+    # 量化编码只用于筛选候选，返回的分数是浮点向量重新打分的结果
+    assert len({row for row, _ in approx} & {row for row, _ in exact}) >= 9
+    exact_scores = dict(exact)
+    for row, score in approx:
+        if row in exact_scores:
+            assert score == pytest.approx(exact_scores[row], abs=1e-5)
+    report = store.quantization_report(k=10, n_queries=20)
+    assert report["recall_at_k"] >= 0.9 and report["memory_reduction"] == 4.0
+
+
+def test_ivf_searches_rows_appended_after_build(tmp_path, monkeypatch):
+    monkeypatch.setattr(flat_index, "FLAT_INDEX_COMPACT_MIN_ROWS", 10000)
+    store = _store(tmp_path)
+    _add(store, "d", 400, "m1")
+    store.build_ivf(n_lists=8, default_nprobe=2)
+    path = store.snapshot().path
+    _add(store, "t", 100, "m2")
+    snapshot = store.snapshot()
+    # 尾部新行还未分配倒排列表，但必须可检索
+    assert snapshot.path == path and snapshot.ivf_lists == 8
+    assert snapshot.indexed_count == 400 and snapshot.count == 500
+    for doc_id in ("t0", "t42", "t99"):
+        assert store.similarity_search(doc_id, k=1, nprobe=1)[0].id == doc_id
+    query = _query()
+    hits = store.similarity_search_by_vector_with_score(query.tolist(), 5, nprobe=8)
+    assert [doc.id for doc, _ in hits] == _brute_force(store, query, 5)
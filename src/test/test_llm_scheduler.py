@@ -0,0 +1,65 @@
+import asyncio
+
+from src.utils.llm_scheduler import LLMScheduler
+
+
+def test_round_robin_across_sessions():
+    async def scenario():
+        scheduler = LLMScheduler(default_limit=1)
+        holder = scheduler.submit("oneapi", "m", "holder")
+        assert holder.granted
+        # 会话 a 先排了三个请求，b、c 各一个：轮转交替获得执行槽，a 不能连续占用
+        tickets = {
+            name: scheduler.submit("oneapi", "m", name[0])
+            for name in ("a1", "a2", "a3", "b1", "c1")
+        }
+        positions = {name: ticket.position() for name, ticket in tickets.items()}
+        order = []
+        active = holder
+        for _ in tickets:
+            active.release()
+            name = next(n for n, t in tickets.items() if t.granted and n not in order)
+            order.append(name)
+            active = tickets[name]
+        active.release()
+        return positions, order, scheduler.stats()["oneapi:m"]
+
+    positions, order, stats = asyncio.run(scenario())
+    assert order == ["a1", "b1", "c1", "a2", "a3"]
+    assert [positions[name] for name in order] == [1, 2, 3, 4, 5]
+    assert stats["active"] == 0 and stats["queued"] == 0
+
+
+def test_lanes_are_limited_per_supplier_and_model():
+    async def scenario():
+        scheduler = LLMScheduler(default_limit=1, limit_overrides={"ollama": 2})
+        first = scheduler.submit("oneapi", "m", "s1")
+        other_model = scheduler.submit("oneapi", "n", "s1")
+        ollama = [scheduler.submit("ollama", "m", f"s{i}") for i in range(3)]
+        return first, other_model, ollama
+
+    first, other_model, ollama = asyncio.run(scenario())
+    assert first.granted and other_model.granted
+    assert [t.granted for t in ollama] == [True, True, False]
+
+
+def test_wait_times_out_and_leaving_frees_the_queue():
+    async def scenario():
+        scheduler = LLMScheduler(default_limit=1)
+        holder = scheduler.submit("oneapi", "m", "s1")
+        waiter = scheduler.submit("oneapi", "m", "s2")
+        assert not await waiter.wait(timeout=0.05)
+        assert waiter.position() == 1
+        # 超时的请求退出队列，不会在之后占用执行槽
+        waiter.release()
+        assert scheduler.stats()["oneapi:m"]["queued"] == 0
+        late = scheduler.submit("oneapi", "m", "s3")
+        holder.release()
+        assert await late.wait(timeout=1)
+        assert waiter.future.cancelled()
+        late.release()
+        late.release()  # 重复释放无副作用
+        return scheduler.stats()["oneapi:m"]
+
+    stats = asyncio.run(scenario())
+    assert stats["active"] == 0 and stats["queued"] == 0
@@ -0,0 +1,163 @@
+import asyncio
+
+import pytest
+
+from src.utils.resilience import CircuitOpenError, ResilientCaller, get_resilient_caller
+
+
+async def _fail():
+    raise RuntimeError("remote error")
+
+
+async def _ok():
+    return "ok"
+
+
+async def _hang():
+    await asyncio.sleep(60)
+
+
+def _open_caller() -> ResilientCaller:
+    """返回一个已熔断、冷却期为 0 (下一次调用即为半开试探) 的调用器"""
+    caller = ResilientCaller(
+        "test", failure_threshold=1, cooldown_seconds=0, hedge_enabled=False
+    )
+
+    async def trip():
+        with pytest.raises(RuntimeError):
+            await caller.call(_fail)
+
+    asyncio.run(trip())
+    assert caller.breaker.state == "open"
+    return caller
+
+
+def test_cancelled_half_open_probe_releases_probe_slot():
+    caller = _open_caller()
+
+    async def scenario():
+        # 试探请求被外层超时取消，既不算成功也不算失败
+        with pytest.raises(asyncio.TimeoutError):
+            await asyncio.wait_for(caller.call(_hang), timeout=0.01)
+        assert caller.breaker.state == "half_open"
+        # 下一次调用重新试探，成功后熔断器关闭
+        assert await caller.call(_ok) == "ok"
+
+    asyncio.run(scenario())
+    assert caller.breaker.state == "closed"
+
+
+def test_half_open_rejects_concurrent_calls_while_probe_in_flight():
+    caller = _open_caller()
+
+    async def scenario():
+        probe = asyncio.ensure_future(caller.call(_hang))
+        await asyncio.sleep(0)
+        with pytest.raises(CircuitOpenError):
+            await caller.call(_ok)
+        probe.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await probe
+        assert await caller.call(_ok) == "ok"
+
+    asyncio.run(scenario())
+    assert caller.breaker.state == "closed"
+
+
+def test_failed_half_open_probe_reopens_circuit():
+    caller = _open_caller()
+    caller.breaker.cooldown_seconds = 60
+
+    async def scenario():
+        caller.breaker.opened_at -= 60  # 冷却期已过
+        with pytest.raises(RuntimeError):
+            await caller.call(_fail)
+        with pytest.raises(CircuitOpenError):
+            await caller.call(_ok)
+
+    asyncio.run(scenario())
+    assert caller.breaker.state == "open"
+
+
+def test_call_sync_cancelled_probe_releases_probe_slot():
+    caller = _open_caller()
+
+    def interrupted():
+        raise KeyboardInterrupt
+
+    with pytest.raises(KeyboardInterrupt):
+        caller.call_sync(interrupted)
+    assert caller.breaker.state == "half_open"
+    assert caller.call_sync(lambda: "ok") == "ok"
+    assert caller.breaker.state == "closed"
+
+
+def test_get_resilient_caller_without_hedging():
+    caller = get_resilient_caller("test-batch", hedge=False)
+    assert not caller.hedge_enabled
+    assert caller._hedge_delay() is None
+    assert get_resilient_caller("test-batch") is caller
+
+
+class _StatusError(Exception):
+    """模拟 httpx.HTTPStatusError：状态码在 error.response.status_code"""
+
+    def __init__(self, status_code: int):
+        super().__init__(f"HTTP {status_code}")
+        self.response = type("Response", (), {"status_code": status_code})()
+
+
+def _raise_status(status_code: int):
+    async def call():
+        raise _StatusError(status_code)
+
+    return call
+
+
+def test_caller_errors_do_not_trip_breaker():
+    caller = ResilientCaller(
+        "test-4xx", failure_threshold=2, cooldown_seconds=60, hedge_enabled=False
+    )
+
+    async def scenario():
+        # 无效 API Key 等调用方错误不影响共用熔断器的其他调用方
+        for status in (401, 403, 400, 404, 401):
+            with pytest.raises(_StatusError):
+                await caller.call(_raise_status(status))
+        assert caller.breaker.state == "closed"
+        assert caller.breaker.consecutive_failures == 0
+        assert await caller.call(_ok) == "ok"
+        # 429、5xx 与传输错误计入熔断
+        with pytest.raises(_StatusError):
+            await caller.call(_raise_status(429))
+        with pytest.raises(_StatusError):
+            await caller.call(_raise_status(503))
+        assert caller.breaker.state == "open"
+
+    asyncio.run(scenario())
+    assert caller.counters["caller_errors"] == 5
+    assert caller.counters["failures"] == 2
+
+
+def test_caller_errors_do_not_trip_breaker_sync():
+    caller = ResilientCaller("test-4xx-sync", failure_threshold=1, hedge_enabled=False)
+
+    def unauthorized():
+        raise _StatusError(401)
+
+    with pytest.raises(_StatusError):
+        caller.call_sync(unauthorized)
+    assert caller.breaker.state == "closed"
+
+
+def test_caller_error_on_probe_keeps_half_open():
+    caller = _open_caller()
+
+    async def scenario():
+        with pytest.raises(_StatusError):
+            await caller.call(_raise_status(401))
+        assert caller.breaker.state == "half_open"
+        assert await caller.call(_ok) == "ok"
+
+    asyncio.run(scenario())
+    assert caller.breaker.state == "closed"
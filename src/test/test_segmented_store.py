@@ -0,0 +1,123 @@
+import os
+
+import numpy as np
+import pytest
+
+pytest.importorskip("langchain_chroma")
+
+from src.utils import segmented_store  # noqa: E402
+from src.utils.segmented_store import SegmentedChromaStore  # noqa: E402
+
+DIM = 16
+
+
+class _Embeddings:
+    """按文本内容生成确定的归一化随机向量"""
+
+    def embed_documents(self, texts):
+        return [self.embed_query(text) for text in texts]
+
+    def embed_query(self, text):
+        seed = int.from_bytes(text.encode("utf-8")[:8].ljust(8, b"\0"), "little")
+        vector = np.random.default_rng(seed).normal(size=DIM)
+        return (vector / np.linalg.norm(vector)).tolist()
+
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    monkeypatch.setattr(segmented_store, "segment_dir", str(tmp_path))
+    return SegmentedChromaStore.create("kb", _Embeddings())
+
+
+def _reader() -> SegmentedChromaStore:
+    """另一个读取方实例，只通过已发布的清单看到数据"""
+    return SegmentedChromaStore("kb", _Embeddings())
+
+
+def _add(store, prefix, n, md5):
+    ids = [f"{prefix}{i}" for i in range(n)]
+    store.add_texts(ids, [{"source_file_md5": md5} for _ in ids], ids=ids)
+    return ids
+
+
+def test_file_delete_is_hidden_by_tombstone_until_done(store, monkeypatch):
+    _add(store, "a", 3, "m1")
+    _add(store, "b", 3, "m2")
+    seen_during_delete = []
+    delete = segmented_store.Chroma.delete
+
+    def observed_delete(self, *args, **kwargs):
+        # 物理删除进行中：墓碑已发布，读请求看不到该文件的任何块
+        reader = _reader()
+        seen_during_delete.append(
+            (
+                reader.manifest()["tombstones"],
+                [doc.id for doc in reader.get_by_ids(["a0", "b0"])],
+                {
+                    doc.metadata["source_file_md5"]
+                    for doc in reader.similarity_search("a1", k=6)
+                },
+            )
+        )
+        return delete(self, *args, **kwargs)
+
+    monkeypatch.setattr(segmented_store.Chroma, "delete", observed_delete)
+    store.delete(where={"source_file_md5": "m1"})
+
+    assert seen_during_delete
+    assert all(seen == (["m1"], ["b0"], {"m2"}) for seen in seen_during_delete)
+    reader = _reader()
+    assert reader.manifest()["tombstones"] == []
+    assert reader.get_by_ids(["a0", "a1", "b1"])[0].id == "b1"
+
+
+def test_compaction_merges_segments_and_retires_old_ones(store, monkeypatch):
+    monkeypatch.setattr(segmented_store, "SEGMENT_COMPACT_THRESHOLD", 2)
+    ids = _add(store, "a", 2, "m1") + _add(store, "b", 2, "m2")
+    old_segments = store.manifest()["segments"]
+    assert len(old_segments) == 2
+
+    ids += _add(store, "c", 2, "m3")  # 第三个分段超过阈值，触发合并
+    manifest = _reader().manifest()
+    assert len(manifest["segments"]) == 1
+    assert manifest["segments"][0] not in old_segments
+    # 旧分段在宽限期内保留，供仍在使用旧清单的读请求完成
+    assert {entry["path"] for entry in manifest["retired"]} >= set(old_segments)
+    assert sorted(doc.id for doc in _reader().get_by_ids(ids)) == sorted(ids)
+    top = _reader().similarity_search_with_score("b1", k=1)
+    assert top[0][0].id == "b1" and top[0][1] == pytest.approx(1.0, abs=1e-5)
+
+    monkeypatch.setattr(segmented_store, "SEGMENT_GC_GRACE_SECONDS", 0)
+    _add(store, "d", 1, "m4")
+    manifest = _reader().manifest()
+    assert manifest["retired"] == []
+    assert not any(os.path.exists(path) for path in old_segments)
+
+
+def test_readers_do_not_see_unpublished_segment(store, monkeypatch):
+    _add(store, "a", 2, "m1")
+    from_texts = segmented_store.Chroma.from_texts
+    seen_during_write = []
+
+    def observed_from_texts(cls, *args, **kwargs):
+        written = from_texts(*args, **kwargs)
+        # 新分段已写完但清单尚未发布
+        reader = _reader()
+        seen_during_write.append(
+            (
+                len(reader.manifest()["segments"]),
+                [doc.id for doc in reader.get_by_ids(["a0", "n0"])],
+                {doc.id for doc in reader.similarity_search("n0", k=3)},
+            )
+        )
+        return written
+
+    monkeypatch.setattr(
+        segmented_store.Chroma, "from_texts", classmethod(observed_from_texts)
+    )
+    _add(store, "n", 2, "m2")
+
+    assert seen_during_write == [(1, ["a0"], {"a0", "a1"})]
+    reader = _reader()
+    assert len(reader.manifest()["segments"]) == 2
+    assert [doc.id for doc in reader.get_by_ids(["a0", "n0"])] == ["a0", "n0"]
@@ -0,0 +1,94 @@
+import asyncio
+
+from src.utils.single_flight import SingleFlight, normalize_question
+
+
+async def _take(stream, n: int) -> list:
+    return [await stream.__anext__() for _ in range(n)]
+
+
+def test_normalize_question():
+    assert normalize_question("  年假  怎么 请？ ") == "年假 怎么 请"
+    assert normalize_question("What IS RAG?!") == "what is rag"
+
+
+def test_late_follower_receives_buffered_events():
+    async def scenario():
+        flights = SingleFlight()
+        release = asyncio.Event()
+
+        async def source():
+            yield {"type": "chunk", "data": "1"}
+            yield {"type": "chunk", "data": "2"}
+            await release.wait()
+            yield {"type": "chunk", "data": "3"}
+
+        flight, is_leader = flights.join("k", source)
+        leader = flights.subscribe(flight)
+        assert is_leader
+        assert await _take(leader, 2) == [
+            {"type": "chunk", "data": "1"},
+            {"type": "chunk", "data": "2"},
+        ]
+        # follower 在前两个事件发布之后加入，仍从头收到全部事件
+        same, is_leader = flights.join("k", source)
+        assert same is flight and not is_leader
+        follower = flights.subscribe(flight)
+        release.set()
+        leader_rest = [event async for event in leader]
+        follower_events = [event async for event in follower]
+        return leader_rest, follower_events, flights.stats()
+
+    leader_rest, follower_events, stats = asyncio.run(scenario())
+    assert leader_rest == [{"type": "chunk", "data": "3"}]
+    assert [event["data"] for event in follower_events] == ["1", "2", "3"]
+    assert stats == {"in_flight": 0, "subscribers": 0}
+
+
+def test_upstream_cancelled_when_last_subscriber_leaves():
+    async def scenario():
+        flights = SingleFlight()
+        cancelled = asyncio.Event()
+
+        async def source():
+            try:
+                yield {"type": "chunk", "data": "1"}
+                await asyncio.sleep(60)
+            except asyncio.CancelledError:
+                cancelled.set()
+                raise
+
+        flight, _ = flights.join("k", source)
+        flights.join("k", source)
+        leader, follower = flights.subscribe(flight), flights.subscribe(flight)
+        await _take(leader, 1)
+        await _take(follower, 1)
+        # leader 离开后 follower 仍在订阅，上游继续执行
+        await leader.aclose()
+        await asyncio.sleep(0.01)
+        assert not cancelled.is_set() and not flight.task.done()
+        await follower.aclose()
+        await asyncio.wait_for(cancelled.wait(), timeout=1)
+        await asyncio.sleep(0)
+        # 已结束的调用不再被合并，下一次 join 发起新的调用
+        _, is_leader = flights.join("k", source)
+        return flight, is_leader
+
+    flight, is_leader = asyncio.run(scenario())
+    assert flight.done and is_leader
+
+
+def test_upstream_error_is_published_to_subscribers():
+    async def scenario():
+        flights = SingleFlight()
+
+        async def source():
+            yield {"type": "chunk", "data": "1"}
+            raise RuntimeError("boom")
+
+        flight, _ = flights.join("k", source)
+        return [event async for event in flights.subscribe(flight)]
+
+    events = asyncio.run(scenario())
+    assert events[0] == {"type": "chunk", "data": "1"}
+    assert events[1]["type"] == "error" and "boom" in events[1]["data"]
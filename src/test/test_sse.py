@@ -0,0 +1,71 @@
+import asyncio
+import json
+
+from src.utils.sse import coalesce_sse_events
+
+
+def _decode(frame: bytes) -> dict:
+    assert frame.startswith(b"data: ") and frame.endswith(b"\n\n")
+    return json.loads(frame[len(b"data: ") :])
+
+
+async def _collect(events, **kwargs) -> list:
+    return [_decode(frame) async for frame in coalesce_sse_events(events, **kwargs)]
+
+
+def _chunks(frames: list) -> list:
+    return [frame["data"] for frame in frames if frame["type"] == "chunk"]
+
+
+def test_first_chunk_is_flushed_immediately():
+    release = asyncio.Event()
+
+    async def events():
+        yield {"type": "chunk", "data": "你"}
+        await release.wait()
+        yield {"type": "chunk", "data": "好"}
+
+    async def scenario():
+        # 时间窗口很长时，首个 chunk 也不等待窗口到期
+        frames = coalesce_sse_events(events(), flush_interval_ms=10_000)
+        first = await asyncio.wait_for(frames.__anext__(), timeout=1)
+        assert _decode(first) == {"type": "chunk", "data": "你"}
+        release.set()
+        rest = [_decode(frame) async for frame in frames]
+        assert _chunks(rest) == ["好"]
+
+    asyncio.run(scenario())
+
+
+def test_chunks_are_coalesced_by_time_window():
+    async def events():
+        for text in ("a", "b", "c"):
+            yield {"type": "chunk", "data": text}
+        await asyncio.sleep(0.2)  # 超过时间窗口，之前缓冲的文本单独成帧
+        yield {"type": "chunk", "data": "d"}
+
+    frames = asyncio.run(_collect(events(), flush_interval_ms=50, max_bytes=1024))
+    assert _chunks(frames) == ["a", "bc", "d"]
+
+
+def test_chunks_are_coalesced_by_size():
+    async def events():
+        for text in ("a", "xx", "yy", "z"):
+            yield {"type": "chunk", "data": text}
+
+    frames = asyncio.run(_collect(events(), flush_interval_ms=10_000, max_bytes=4))
+    assert _chunks(frames) == ["a", "xxyy", "z"]
+
+
+def test_other_events_flush_buffered_text_first():
+    async def events():
+        yield {"type": "chunk", "data": "a"}
+        yield {"type": "chunk", "data": "b"}
+        yield {"type": "error", "data": "失败"}
+
+    frames = asyncio.run(_collect(events(), flush_interval_ms=10_000))
+    assert frames == [
+        {"type": "chunk", "data": "a"},
+        {"type": "chunk", "data": "b"},
+        {"type": "error", "data": "失败"},
+    ]
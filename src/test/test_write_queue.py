@@ -0,0 +1,101 @@
+import asyncio
+
+import pytest
+
+pytest.importorskip("langchain_core")
+
+from langchain_core.documents import Document  # noqa: E402
+
+from src.utils import write_queue  # noqa: E402
+from src.utils.write_queue import submit_add, submit_write  # noqa: E402
+
+
+def _docs(*texts: str) -> list:
+    return [Document(page_content=text) for text in texts]
+
+
+def test_queued_adds_are_coalesced_into_one_write(monkeypatch):
+    monkeypatch.setattr(write_queue, "WRITE_COALESCE_WAIT_MS", 20)
+    calls = []
+
+    def apply(documents):
+        calls.append([doc.page_content for doc in documents])
+        return len(documents)
+
+    async def scenario():
+        return await asyncio.gather(
+            submit_add("wq-coalesce", _docs("a1", "a2"), apply),
+            submit_add("wq-coalesce", _docs("b1"), apply),
+            submit_add("wq-coalesce", _docs("c1"), apply),
+        )
+
+    results = asyncio.run(scenario())
+    assert calls == [["a1", "a2", "b1", "c1"]]
+    # 合并后的每个请求都拿到这次批量写入的结果
+    assert results == [4, 4, 4]
+
+
+def test_coalescing_respects_max_docs(monkeypatch):
+    monkeypatch.setattr(write_queue, "WRITE_COALESCE_WAIT_MS", 20)
+    monkeypatch.setattr(write_queue, "WRITE_COALESCE_MAX_DOCS", 2)
+    calls = []
+
+    async def scenario():
+        await asyncio.gather(
+            *(
+                submit_add("wq-max", _docs(text), lambda d: calls.append(len(d)))
+                for text in ("a", "b", "c")
+            )
+        )
+
+    asyncio.run(scenario())
+    assert calls == [2, 1]
+
+
+def test_non_add_write_is_a_barrier(monkeypatch):
+    monkeypatch.setattr(write_queue, "WRITE_COALESCE_WAIT_MS", 20)
+    order = []
+
+    def add(documents):
+        order.append(("add", [doc.page_content for doc in documents]))
+
+    def delete():
+        order.append(("delete", None))
+
+    async def scenario():
+        await asyncio.gather(
+            submit_add("wq-barrier", _docs("a"), add),
+            submit_add("wq-barrier", _docs("b"), add),
+            submit_write("wq-barrier", "delete", delete),
+            submit_add("wq-barrier", _docs("c"), add),
+        )
+
+    asyncio.run(scenario())
+    # 删除前后的 add 不跨屏障合并，执行顺序与提交顺序一致
+    assert order == [("add", ["a", "b"]), ("delete", None), ("add", ["c"])]
+
+
+def test_failed_batch_is_retried_per_request(monkeypatch):
+    monkeypatch.setattr(write_queue, "WRITE_COALESCE_WAIT_MS", 20)
+    calls = []
+
+    def apply(documents):
+        texts = [doc.page_content for doc in documents]
+        calls.append(texts)
+        if "bad" in texts:
+            raise ValueError("bad chunk")
+        return len(texts)
+
+    async def scenario():
+        return await asyncio.gather(
+            submit_add("wq-retry", _docs("a"), apply),
+            submit_add("wq-retry", _docs("bad"), apply),
+            submit_add("wq-retry", _docs("c"), apply),
+            return_exceptions=True,
+        )
+
+    ok_a, failed, ok_c = asyncio.run(scenario())
+    assert calls == [["a", "bad", "c"], ["a"], ["bad"], ["c"]]
+    # 只有出错的请求失败，其他请求各自写入成功
+    assert ok_a == 1 and ok_c == 1
+    assert isinstance(failed, ValueError)
@@ -1,21 +1,41 @@
+import asyncio
 import logging  # 添加日志记录
 import os
+import shutil
+import time
 from hashlib import md5
-from typing import Any, Dict, Literal, Optional, Sequence  # 更新 typing
+from typing import Any, Callable, Dict, List, Literal, Optional, Sequence  # 更新 typing
 
 from langchain.retrievers import ContextualCompressionRetriever
 from langchain.retrievers.document_compressors import CrossEncoderReranker
 from langchain_chroma import Chroma
 from langchain_community.cross_encoders import HuggingFaceCrossEncoder
-from langchain_core.callbacks import Callbacks  # Callbacks for compressor
+from langchain_core.callbacks import (
+    AsyncCallbackManagerForRetrieverRun,
+    CallbackManagerForRetrieverRun,
+    Callbacks,  # Callbacks for compressor
+)
 from langchain_core.documents import (
     BaseDocumentCompressor,  # 导入基类
     Document,
 )
 from langchain_core.retrievers import BaseRetriever
+from langchain_core.runnables import ConfigurableField, RunnableSerializable
+from langchain_core.vectorstores import VectorStore
 
+from src.utils import write_queue
 from src.utils.DocumentChunker import DocumentChunker
+from src.utils.file_summary import FileSummaryIndex, coarse_file_filter
+from src.utils.flat_index import FLAT_INDEX_DTYPE, FlatIndexStore, flat_index_dir
+from src.utils.metrics import metrics
 from src.utils.remote_rerank import call_siliconflow_rerank
+from src.utils.segmented_store import SegmentedChromaStore, segment_dir
+from src.utils.sharded_store import (
+    ShardedVectorStore,
+    search_by_vector_with_relevance,
+    shard_dir,
+)
+from src.utils.vector_executor import run_vector_op
 
 # 配置日志
 logger = logging.getLogger(__name__)
@@ -24,6 +44,17 @@ logger = logging.getLogger(__name__)
 DEFAULT_LOCAL_RERANK_MODEL = "src/utils/bge-reranker-large"  # 本地重排序模型路径
 DEFAULT_REMOTE_RERANK_MODEL = "BAAI/bge-reranker-v2-m3"  # 默认远程模型
 chroma_dir = "chroma/"  # 向量数据库的路径
+VECTOR_BACKENDS = ("chroma", "numpy")  # 可选的向量存储后端 (numpy 为内存映射平铺索引)
+# 检索阶段 (向量检索 + 重排序) 的默认延迟预算 (毫秒)，重排序超出预算时退回向量检索顺序
+RETRIEVAL_BUDGET_MS = int(os.getenv("RETRIEVAL_BUDGET_MS", 3000))
+RERANK_FALLBACK_PATHS = ("rerank_timeout", "rerank_error")  # 重排序被跳过的降级路径
+# --- 自适应 search_k 配置 ---
+ADAPTIVE_MIN_K = int(os.getenv("ADAPTIVE_MIN_K", 2))  # 至少保留的候选数
+ADAPTIVE_MAX_K = int(os.getenv("ADAPTIVE_MAX_K", 20))  # 一次取回的候选数，也是保留上限
+# 与最高分相差超过该值的候选被截去
+ADAPTIVE_SCORE_WINDOW = float(os.getenv("ADAPTIVE_SCORE_WINDOW", 0.15))
+# 相邻候选的分数落差达到该值时视为拐点，在拐点处截断
+ADAPTIVE_MIN_GAP = float(os.getenv("ADAPTIVE_MIN_GAP", 0.05))
 
 # --- 自定义远程 Reranker Compressor ---
 
@@ -61,14 +92,15 @@ class RemoteRerankerCompressor(BaseDocumentCompressor):
 
         Returns:
             根据 SiliconFlow API 重排序后的文档序列。
+
+        Raises:
+            RuntimeError: 缺少 API key，或远程调用失败 (HTTP 错误、超时、熔断) / 未返回有效结果。
+                调用方 (arerank_within_budget) 据此走 rerank_error 降级路径。
         """
         if not documents:
             return []
         if not self.api_key:
-            logger.error("缺少 SiliconFlow API key，无法执行远程重排序。")
-            # 在这种情况下，可以选择返回原始文档或空列表
-            # 返回原始文档可能更好，避免完全丢失信息
-            return documents
+            raise RuntimeError("缺少 SiliconFlow API key，无法执行远程重排序。")
 
         doc_contents = [doc.page_content for doc in documents]
         logger.debug(
@@ -101,6 +133,7 @@ class RemoteRerankerCompressor(BaseDocumentCompressor):
                     # 创建新的 Document 对象，包含更新后的 metadata
                     final_docs.append(
                         Document(
+                            id=original_doc.id,  # 保留文档块 ID
                             page_content=original_doc.page_content,
                             metadata=new_metadata,
                         )
@@ -108,11 +141,9 @@ class RemoteRerankerCompressor(BaseDocumentCompressor):
                 else:
                     logger.warning(f"SiliconFlow 返回了无效的索引: {original_index}")
             logger.info(f"远程重排序完成，返回 {len(final_docs)} 个文档。")
-        else:
-            logger.warning("远程 Rerank 调用失败或未返回有效结果，将返回原始文档。")
-            # 在失败时返回原始文档的前 top_n 个，或全部返回？
-            # 暂时返回所有原始文档以避免信息丢失
-            return documents
+        if not final_docs:
+            # 不能把原始顺序当作重排序结果返回，否则会被标记为 reranked 并写入检索缓存
+            raise RuntimeError("远程 Rerank 调用失败或未返回有效结果。")
 
         return final_docs
 
@@ -150,8 +181,129 @@ class RemoteRerankerCompressor(BaseDocumentCompressor):
             )
         except Exception as e:
             logger.error(f"运行同步 compress_documents 时出错: {e}")
-            # 返回原始文档作为后备
-            return documents
+            # 返回向量检索顺序的前 top_n 个文档作为后备
+            return list(documents)[: self.top_n]
+
+
+def choose_adaptive_k(
+    scores: Sequence[float],
+    min_k: int = ADAPTIVE_MIN_K,
+    max_k: int = ADAPTIVE_MAX_K,
+    score_window: float = ADAPTIVE_SCORE_WINDOW,
+    min_gap: float = ADAPTIVE_MIN_GAP,
+) -> int:
+    """
+    根据降序排列的相似度分数决定保留的候选数：
+    先保留与最高分相差不超过 score_window 的候选，
+    再在其中寻找最大的分数落差 (拐点)，落差不小于 min_gap 时在拐点处截断。
+    结果限制在 [min_k, max_k] 内 (且不超过候选总数)。
+    """
+    if not scores:
+        return 0
+    upper = min(max_k, len(scores))
+    lower = min(max(1, min_k), upper)
+    k = sum(1 for score in scores[:upper] if score >= scores[0] - score_window)
+    k = max(lower, k)
+    best_gap, cut = 0.0, k
+    for i in range(lower, k):
+        gap = scores[i - 1] - scores[i]
+        if gap > best_gap:
+            best_gap, cut = gap, i
+    return cut if best_gap >= min_gap else k
+
+
+class ScoredVectorStoreRetriever(BaseRetriever):
+    """
+    基础向量检索器：行为与 vectorstore.as_retriever() 相同，
+    但会把相似度分数写入 metadata["vector_score"]，供检索缓存等下游使用。
+    """
+
+    vectorstore: Any
+    "向量存储实例 (Chroma 或 FlatIndexStore)。"
+    search_kwargs: dict = {}
+    "传给相似度检索的参数，例如 {'k': 3, 'filter': {...}}。"
+    adaptive_min_k: Optional[int] = None
+    "设置时启用自适应 k：取回 k 个候选后按分数分布截断，至少保留该数量。"
+    kb_id: Optional[str] = None
+    "所属知识库 ID，异步检索按知识库限制并发。"
+
+    def _with_scores(self, docs_and_scores: List[tuple]) -> List[Document]:
+        docs = []
+        for doc, score in docs_and_scores:
+            doc.metadata = {**(doc.metadata or {}), "vector_score": float(score)}
+            docs.append(doc)
+        if self.adaptive_min_k is not None and docs:
+            k = choose_adaptive_k(
+                [doc.metadata["vector_score"] for doc in docs],
+                min_k=self.adaptive_min_k,
+                max_k=len(docs),
+            )
+            metrics.observe("adaptive_search_k", k)
+            logger.debug(f"自适应 search_k: {len(docs)} 个候选中保留 {k} 个")
+            docs = docs[:k]
+        return docs
+
+    def _get_relevant_documents(
+        self, query: str, *, run_manager: CallbackManagerForRetrieverRun
+    ) -> List[Document]:
+        return self._with_scores(
+            self.vectorstore.similarity_search_with_relevance_scores(
+                query, **self.search_kwargs
+            )
+        )
+
+    async def _aget_relevant_documents(
+        self, query: str, *, run_manager: AsyncCallbackManagerForRetrieverRun
+    ) -> List[Document]:
+        # 在专用的向量执行器中检索，不占用默认线程池
+        return self._with_scores(
+            await run_vector_op(
+                self.kb_id,
+                "search",
+                self.vectorstore.similarity_search_with_relevance_scores,
+                query,
+                **self.search_kwargs,
+            )
+        )
+
+
+class KnowledgeBaseRetriever(BaseRetriever):
+    """
+    面向单个知识库的检索器。
+    filter_dict 与 search_k 声明为可配置字段，使同一条已组装好的 RAG 链
+    可以在每次调用时注入不同的过滤条件，而无需重新构建链。
+    """
+
+    knowledge: Any
+    "所属的 Knowledge 实例 (持有向量存储与重排序器缓存)。"
+    kb_id: str
+    "知识库 ID，即 Chroma 集合名称。"
+    filter_dict: Optional[dict] = None
+    "元数据过滤条件。"
+    search_k: int = 3
+    "基础检索器返回的文档数量。"
+    budget_ms: Optional[int] = None
+    "检索阶段的延迟预算 (毫秒)，为 None 时使用 RETRIEVAL_BUDGET_MS。"
+
+    def _get_relevant_documents(
+        self, query: str, *, run_manager: CallbackManagerForRetrieverRun
+    ) -> List[Document]:
+        retriever = self.knowledge.get_retriever_for_knowledge_base(
+            kb_id=self.kb_id, filter_dict=self.filter_dict, search_k=self.search_k
+        )
+        return retriever.invoke(query, config={"callbacks": run_manager.get_child()})
+
+    async def _aget_relevant_documents(
+        self, query: str, *, run_manager: AsyncCallbackManagerForRetrieverRun
+    ) -> List[Document]:
+        return await self.knowledge.aretrieve(
+            kb_id=self.kb_id,
+            query=query,
+            filter_dict=self.filter_dict,
+            search_k=self.search_k,
+            budget_ms=self.budget_ms,
+            callbacks=run_manager.get_child(),
+        )
 
 
 # --- 更新 Knowledge 类 ---
@@ -171,6 +323,12 @@ class Knowledge:
         local_rerank_model_path: str = DEFAULT_LOCAL_RERANK_MODEL,  # 本地模型路径
         remote_rerank_config: Optional[Dict[str, Any]] = None,  # 远程配置字典
         rerank_top_n: int = 3,  # 返回的文档数量
+        adaptive_search_k: bool = False,  # 是否根据分数分布自适应决定候选数量
+        vector_backend: str = "chroma",  # 新建知识库时使用的向量存储后端
+        vector_dtype: Optional[str] = None,  # 新建平铺索引的存储类型 (float32/float16/int8)
+        nprobe: Optional[int] = None,  # IVF 近似检索探查的列表数 (仅平铺索引后端)
+        shard_count: int = 1,  # 新建知识库的分片数 (大于 1 时使用分片存储)
+        coarse_top_files: Optional[int] = None,  # 两阶段检索: 先按文件摘要向量选出的文件数 (None 为不启用)
     ):
         self._embeddings = _embeddings
         self.splitter = splitter
@@ -193,6 +351,18 @@ class Knowledge:
             )
             # 可以考虑禁用重排序 self.use_reranker = False
         self.rerank_top_n = rerank_top_n
+        self.adaptive_search_k = adaptive_search_k
+        if vector_backend not in VECTOR_BACKENDS:
+            raise ValueError(f"不支持的向量存储后端: {vector_backend}")
+        self.vector_backend = vector_backend
+        self.vector_dtype = vector_dtype
+        self.nprobe = nprobe
+        self.shard_count = shard_count
+        self.coarse_top_files = coarse_top_files
+
+        # --- 复用的向量存储与重排序器 (随 Knowledge 实例缓存) ---
+        self._vectorstores: Dict[str, VectorStore] = {}
+        self._compressor: Optional[BaseDocumentCompressor] = None
 
         logger.info(
             f"Knowledge 初始化: Reranker={'启用' if use_reranker else '禁用'}, 类型={reranker_type if use_reranker else 'N/A'}, TopN={rerank_top_n if use_reranker else 'N/A'}"
@@ -200,14 +370,41 @@ class Knowledge:
 
     @staticmethod
     def is_already_vector_database(collection_name: str) -> bool:
-        """检查指定集合名称的 ChromaDB 物理存储是否存在"""
+        """检查指定集合名称的向量存储 (ChromaDB、分段、平铺索引或分片存储) 是否存在"""
         persist_directory = os.path.join(chroma_dir, collection_name)
-        return os.path.isdir(persist_directory)
+        return (
+            os.path.isdir(persist_directory)
+            or FlatIndexStore.exists(collection_name)
+            or ShardedVectorStore.exists(collection_name)
+            or SegmentedChromaStore.exists(collection_name)
+        )
 
-    def load_knowledge(self, collection_name) -> Chroma:
-        """加载指定名称的 Chroma 向量数据库"""
+    @staticmethod
+    def delete_vector_database(collection_name: str) -> None:
+        """删除指定集合名称的全部向量存储 (所有后端及分片布局)"""
+        persist_directory = os.path.join(chroma_dir, collection_name)
+        if os.path.isdir(persist_directory):
+            shutil.rmtree(persist_directory)
+        FlatIndexStore.destroy(collection_name)
+        ShardedVectorStore.destroy(collection_name)
+        SegmentedChromaStore.destroy(collection_name)
+        FileSummaryIndex.destroy(collection_name)
+
+    def load_knowledge(self, collection_name) -> VectorStore:
+        """加载指定名称的向量数据库 (根据磁盘上已有的存储判断后端)"""
         if not self._embeddings:
             raise ValueError("无法加载知识库，因为缺少 embedding 函数。")
+        if ShardedVectorStore.exists(collection_name):
+            logger.info(f"尝试从 '{shard_dir}' 加载分片知识库 '{collection_name}'")
+            return ShardedVectorStore(collection_name, self._embeddings)
+        if SegmentedChromaStore.exists(collection_name):
+            logger.info(f"尝试从 '{segment_dir}' 加载分段知识库 '{collection_name}'")
+            return SegmentedChromaStore(collection_name, self._embeddings)
+        if FlatIndexStore.exists(collection_name):
+            logger.info(
+                f"尝试从 '{flat_index_dir}' 加载平铺索引 '{collection_name}'"
+            )
+            return FlatIndexStore(collection_name, self._embeddings)
         persist_directory = os.path.join(chroma_dir, collection_name)
         logger.info(f"尝试从 '{persist_directory}' 加载集合 '{collection_name}'")
         return Chroma(
@@ -275,12 +472,14 @@ class Knowledge:
         }
         logger.debug(f"为文档块添加元数据: {metadata_to_add}")
         processed_documents = []
-        for doc in documents:
+        for chunk_index, doc in enumerate(documents):
             if doc.metadata is None:
                 doc.metadata = {}
             # 更新元数据，使用 .copy() 避免意外修改原始 metadata_to_add
             current_metadata = doc.metadata.copy()
             current_metadata.update(metadata_to_add)
+            # 块在文件中的序号，用于检索后合并同一文件的相邻块
+            current_metadata["chunk_index"] = chunk_index
             # 创建一个新的 Document 或直接修改，取决于 DocumentChunker 实现
             # 为安全起见，可以创建新 Document
             processed_documents.append(
@@ -288,33 +487,28 @@ class Knowledge:
             )
             # 或者如果可以直接修改: doc.metadata.update(metadata_to_add)
 
-        # --- 3. 添加到 ChromaDB ---
+        # --- 3. 写入向量存储 (经该知识库的写入队列串行执行，并与其他排队写入合并) ---
         kb_id_str = str(kb_id)  # 确保是字符串
-        persist_directory = os.path.join(chroma_dir, kb_id_str)
 
         try:
-            if not self.is_already_vector_database(kb_id_str):
-                logger.info(f"集合 '{kb_id_str}' 不存在，首次创建并添加文档...")
-                # 首次创建
-                await Chroma.afrom_documents(
-                    documents=processed_documents,  # 使用处理过的文档
-                    embedding=self._embeddings,
-                    collection_name=kb_id_str,
-                    persist_directory=persist_directory,
-                )
-                logger.info(f"集合 '{kb_id_str}' 创建成功。")
-            else:
-                logger.info(f"集合 '{kb_id_str}' 已存在，加载并添加新文档...")
-                # 集合已存在，加载后添加
-                vectorstore = self.load_knowledge(kb_id_str)
-                await vectorstore.aadd_documents(
-                    documents=processed_documents
-                )  # 使用处理过的文档
-                logger.info(f"新文档块已添加到现有集合 '{kb_id_str}'。")
-
+            await write_queue.submit_add(
+                kb_id_str, processed_documents, self._document_writer(kb_id_str)
+            )
             logger.info(
                 f"文件 {file_path} 的向量数据成功添加/更新到集合 '{kb_id_str}'。"
             )
+            # 计算文件级摘要向量 (质心)，供两阶段检索的粗筛使用；失败不影响文件入库
+            try:
+                summaries = FileSummaryIndex(kb_id_str)
+                await write_queue.submit_write(
+                    kb_id_str,
+                    "summary",
+                    lambda: summaries.update_file(
+                        self.load_knowledge(kb_id_str), file_md5, file_name
+                    ),
+                )
+            except Exception as e:
+                logger.error(f"计算文件 {file_md5} 的摘要向量失败: {e}", exc_info=True)
 
         except Exception as e:
             logger.error(
@@ -323,6 +517,60 @@ class Knowledge:
             )
             raise
 
+    def _document_writer(
+        self, kb_id_str: str
+    ) -> Callable[[List[Document]], None]:
+        """
+        返回写入队列使用的同步写入函数：知识库不存在时按配置的后端首次创建，否则追加。
+        在写入队列中串行执行，存在性判断与创建之间不会与同一知识库的其他写入交错。
+        """
+
+        def write(documents: List[Document]) -> None:
+            if not self.is_already_vector_database(kb_id_str):
+                logger.info(
+                    f"集合 '{kb_id_str}' 不存在，首次创建 ({self.vector_backend}) 并添加 {len(documents)} 个文档块..."
+                )
+                if self.shard_count > 1:
+                    ShardedVectorStore.from_documents(
+                        documents=documents,
+                        embedding=self._embeddings,
+                        collection_name=kb_id_str,
+                        backend=self.vector_backend,
+                        shard_count=self.shard_count,
+                        dtype=self.vector_dtype,
+                    )
+                elif self.vector_backend == "numpy":
+                    FlatIndexStore.from_documents(
+                        documents=documents,
+                        embedding=self._embeddings,
+                        collection_name=kb_id_str,
+                        dtype=self.vector_dtype or FLAT_INDEX_DTYPE,
+                    )
+                else:
+                    # Chroma 后端使用分段存储：写入新分段，完成后原子发布
+                    SegmentedChromaStore.from_documents(
+                        documents=documents,
+                        embedding=self._embeddings,
+                        collection_name=kb_id_str,
+                    )
+                logger.info(f"集合 '{kb_id_str}' 创建成功。")
+            else:
+                vectorstore = self.load_knowledge(kb_id_str)
+                if type(vectorstore) is Chroma:
+                    # 旧版本的单目录 Chroma 集合：纳入为基础分段，此后的写入都写新分段
+                    logger.info(f"集合 '{kb_id_str}' 转换为分段存储。")
+                    vectorstore = SegmentedChromaStore.create(
+                        kb_id_str,
+                        self._embeddings,
+                        base_directory=os.path.join(chroma_dir, kb_id_str),
+                    )
+                vectorstore.add_documents(documents)
+                logger.info(
+                    f"{len(documents)} 个文档块已添加到现有集合 '{kb_id_str}'。"
+                )
+
+        return write
+
     def get_retriever_for_knowledge_base(
         self, kb_id: str, filter_dict: Optional[dict] = None, search_k: int = 3
     ) -> BaseRetriever:
@@ -341,6 +589,42 @@ class Knowledge:
             f"准备为知识库 '{kb_id_str}' 获取检索器... Reranker: {'启用' if self.use_reranker else '禁用'}, Type: {self.reranker_type if self.use_reranker else 'N/A'}"
         )
 
+        try:
+            base_retriever = self._get_base_retriever(kb_id_str, filter_dict, search_k)
+
+            # --- 根据配置应用重排序 ---
+            if self.use_reranker:
+                compressor = self._get_compressor()
+                # --- 如果成功创建了 compressor，则包装 Retriever ---
+                if compressor:
+                    compression_retriever = ContextualCompressionRetriever(
+                        base_compressor=compressor, base_retriever=base_retriever
+                    )
+                    logger.info("ContextualCompressionRetriever 创建成功。")
+                    return compression_retriever
+                else:
+                    logger.warning("未能创建 Reranker Compressor，返回基础检索器。")
+                    return base_retriever
+
+            else:
+                # --- 不使用重排序 ---
+                logger.info("重排序未启用，返回基础检索器。")
+                return base_retriever
+
+        except FileNotFoundError:
+            raise
+        except Exception as e:
+            error_msg = f"加载知识库 '{kb_id_str}' 或创建检索器时出错: {e}"
+            logger.error(error_msg, exc_info=True)
+            raise RuntimeError(error_msg) from e
+
+    def _get_base_retriever(
+        self, kb_id_str: str, filter_dict: Optional[dict], search_k: int
+    ) -> "ScoredVectorStoreRetriever":
+        """
+        创建基础向量检索器 (不含重排序)。
+        :raises FileNotFoundError: 知识库向量存储不存在时抛出。
+        """
         # 调整 search_k 以确保 reranker 有足够文档处理
         effective_search_k = search_k
         if self.use_reranker and search_k < self.rerank_top_n:
@@ -353,6 +637,14 @@ class Knowledge:
                 f"search_k ({search_k}) 略小于 rerank_top_n ({self.rerank_top_n}) 的推荐倍数。考虑增加 search_k 以获得更好的重排效果。"
             )
 
+        adaptive_min_k = None
+        if self.adaptive_search_k:
+            # 自适应模式：一次取回 ADAPTIVE_MAX_K 个候选，再按分数落差截断
+            effective_search_k = max(ADAPTIVE_MAX_K, effective_search_k)
+            adaptive_min_k = max(
+                ADAPTIVE_MIN_K, self.rerank_top_n if self.use_reranker else 1
+            )
+
         search_kwargs = {"k": effective_search_k}  # 使用调整后的 k
         if filter_dict:
             search_kwargs["filter"] = filter_dict
@@ -365,113 +657,336 @@ class Knowledge:
             logger.error(error_msg)
             raise FileNotFoundError(error_msg)
 
-        logger.info(f"加载知识库 '{kb_id_str}'...")
+        vectorstore = self._get_vectorstore(kb_id_str)
+        if self.nprobe is not None and isinstance(
+            vectorstore, (FlatIndexStore, ShardedVectorStore)
+        ):
+            search_kwargs["nprobe"] = self.nprobe
+        logger.info(f"将知识库 '{kb_id_str}' 作为基础检索器，配置: {search_kwargs}")
+        return ScoredVectorStoreRetriever(
+            vectorstore=vectorstore,
+            search_kwargs=search_kwargs,
+            adaptive_min_k=adaptive_min_k,
+            kb_id=kb_id_str,
+        )
+
+    async def aretrieve(
+        self,
+        kb_id: str,
+        query: str,
+        filter_dict: Optional[dict] = None,
+        search_k: int = 3,
+        budget_ms: Optional[int] = None,
+        callbacks: Callbacks = None,
+    ) -> List[Document]:
+        """
+        在延迟预算内渐进式检索：先完成向量检索，再在剩余预算内执行重排序。
+        重排序超时或出错时退回向量检索的顺序 (截取前 rerank_top_n 个)，
+        使检索阶段的尾延迟受预算约束，而不是受上游重排序服务的最坏超时约束。
+        每个文档的 metadata["retrieval_path"] 记录本次采用的路径：
+        vector (未启用重排序) / reranked / rerank_timeout / rerank_error。
+        """
+        started_at = time.monotonic()
+        kb_id_str = str(kb_id)
+        if self.coarse_top_files:
+            # 两阶段检索：先按文件摘要向量选出最相近的文件，再只在这些文件的块中检索
+            filter_dict = await run_vector_op(
+                kb_id_str,
+                "coarse",
+                coarse_file_filter,
+                kb_id_str,
+                await self.aembed_query(query),
+                self.coarse_top_files,
+                filter_dict,
+            )
         try:
-            vectorstore = self.load_knowledge(kb_id_str)
-            logger.info(f"将知识库 '{kb_id_str}' 作为基础检索器，配置: {search_kwargs}")
-            base_retriever = vectorstore.as_retriever(search_kwargs=search_kwargs)
+            base_retriever = self._get_base_retriever(kb_id_str, filter_dict, search_k)
+        except FileNotFoundError:
+            raise
+        except Exception as e:
+            error_msg = f"加载知识库 '{kb_id_str}' 或创建检索器时出错: {e}"
+            logger.error(error_msg, exc_info=True)
+            raise RuntimeError(error_msg) from e
+        docs = await base_retriever.ainvoke(query, config={"callbacks": callbacks})
+        return await self.arerank_within_budget(
+            query, docs, started_at=started_at, budget_ms=budget_ms, callbacks=callbacks
+        )
 
-            # --- 根据配置应用重排序 ---
-            if self.use_reranker:
-                logger.info(
-                    f"启用重排序 (类型: {self.reranker_type}, TopN: {self.rerank_top_n})..."
+    async def arerank_within_budget(
+        self,
+        query: str,
+        docs: List[Document],
+        started_at: Optional[float] = None,
+        budget_ms: Optional[int] = None,
+        callbacks: Callbacks = None,
+    ) -> List[Document]:
+        """
+        在检索预算的剩余时间内对候选文档重排序 (未启用重排序时原样返回)。
+        started_at 为检索开始的 time.monotonic()，预算从该时刻起算。
+        """
+        started_at = time.monotonic() if started_at is None else started_at
+        budget_seconds = (
+            RETRIEVAL_BUDGET_MS if budget_ms is None else budget_ms
+        ) / 1000
+        compressor = self._get_compressor() if self.use_reranker and docs else None
+        path = "vector"
+        if compressor is not None:
+            remaining = budget_seconds - (time.monotonic() - started_at)
+            try:
+                docs = list(
+                    await asyncio.wait_for(
+                        compressor.acompress_documents(
+                            docs, query, callbacks=callbacks
+                        ),
+                        timeout=max(remaining, 0),
+                    )
+                )
+                path = "reranked"
+            except asyncio.TimeoutError:
+                logger.warning(
+                    f"重排序未能在预算 {budget_seconds:.2f}s 内完成，使用向量检索顺序。"
                 )
-                compressor: Optional[BaseDocumentCompressor] = None
+                path = "rerank_timeout"
+            except Exception as e:
+                logger.error(f"重排序出错，使用向量检索顺序: {e}", exc_info=True)
+                path = "rerank_error"
+            if path != "reranked":
+                docs = docs[: self.rerank_top_n]
+
+        for doc in docs:
+            doc.metadata = {**(doc.metadata or {}), "retrieval_path": path}
+        metrics.incr("retrieval_path_total", path=path)
+        metrics.observe(
+            "retrieval_stage_seconds", time.monotonic() - started_at, path=path
+        )
+        return docs
 
-                if self.reranker_type == "local":
-                    # --- 使用本地 CrossEncoder Reranker ---
-                    try:
-                        logger.info(
-                            f"加载本地重排序模型: {self.local_rerank_model_path}"
-                        )
-                        # 确保 rerank_model 路径正确且模型存在
-                        model_kwargs = {"device": "cpu"}  # 默认 CPU，可按需修改
-                        # import torch
-                        # if torch.cuda.is_available(): model_kwargs = {"device": "cuda"}
-
-                        encoder_model = HuggingFaceCrossEncoder(
-                            model_name=self.local_rerank_model_path,
-                            model_kwargs=model_kwargs,
-                        )
-                        compressor = CrossEncoderReranker(
-                            model=encoder_model, top_n=self.rerank_top_n
-                        )
-                        logger.info("本地 CrossEncoderReranker 初始化成功。")
-                    except Exception as e:
-                        logger.error(
-                            f"加载或初始化本地重排序模型 '{self.local_rerank_model_path}' 时出错: {e}",
-                            exc_info=True,
-                        )
-                        # 出错则不使用重排序
-                        self.use_reranker = False  # 禁用重排序以避免后续错误
-                        return base_retriever  # 返回基础检索器
-
-                elif self.reranker_type == "remote":
-                    # --- 使用远程 SiliconFlow Reranker ---
-                    if self.remote_rerank_config and self.remote_rerank_config.get(
-                        "api_key"
-                    ):
-                        api_key = self.remote_rerank_config["api_key"]
-                        # remote_rerank_config 可能包含 'model'，也可能不包含
-                        # RemoteRerankerCompressor 会处理默认值
-                        try:
-                            # 使用关键字参数初始化，Pydantic 会根据类属性进行匹配
-                            compressor = RemoteRerankerCompressor(
-                                api_key=api_key,
-                                # 如果提供了 model，则使用它，否则使用类定义的默认值
-                                model_name=self.remote_rerank_config.get(
-                                    "model", DEFAULT_REMOTE_RERANK_MODEL
-                                ),
-                                top_n=self.rerank_top_n,
-                            )
-                            logger.info("远程 RemoteRerankerCompressor 初始化成功。")
-                        # except ValueError as e: # 这个 ValueError 是我们之前在 __init__ 里加的，现在不需要了
-                        #    logger.error(f"初始化 RemoteRerankerCompressor 时出错: {e}")
-                        #    self.use_reranker = False
-                        #    return base_retriever
-                        except Exception as e:
-                            # 捕获 Pydantic 初始化可能发生的其他错误 (例如类型不匹配)
-                            logger.error(
-                                f"初始化 RemoteRerankerCompressor 时发生 Pydantic 或其他错误: {e}",
-                                exc_info=True,
-                            )
-                            self.use_reranker = False
-                            return base_retriever
-                    else:
-                        logger.error(
-                            "无法使用远程 Reranker，因为 'remote_rerank_config' 或 'api_key' 未提供。"
-                        )
-                        self.use_reranker = False  # 禁用重排序
-                        return base_retriever  # 返回基础检索器
+    def search_by_vector(
+        self,
+        kb_id: str,
+        embedding: List[float],
+        k: int = 3,
+        filter_dict: Optional[dict] = None,
+    ) -> List[Document]:
+        """
+        用已计算好的查询向量做向量检索 (不含重排序)，相似度写入 metadata["vector_score"]。
+        同步方法，供多知识库联合检索在线程池中调用。
+        :raises FileNotFoundError: 知识库向量存储不存在时抛出。
+        """
+        kb_id_str = str(kb_id)
+        if not self.is_already_vector_database(kb_id_str):
+            raise FileNotFoundError(f"知识库集合 '{kb_id_str}' 的向量存储不存在！")
+        vectorstore = self._get_vectorstore(kb_id_str)
+        if self.coarse_top_files:
+            filter_dict = coarse_file_filter(
+                kb_id_str, embedding, self.coarse_top_files, filter_dict
+            )
+        docs = []
+        for doc, score in search_by_vector_with_relevance(
+            vectorstore, embedding, k, filter_dict, self.nprobe
+        ):
+            doc.metadata = {**(doc.metadata or {}), "vector_score": score}
+            docs.append(doc)
+        return docs
 
-                else:
-                    logger.warning(
-                        f"未知的 reranker_type: '{self.reranker_type}'。将不使用重排序。"
-                    )
-                    self.use_reranker = False  # 禁用重排序
-                    return base_retriever  # 返回基础检索器
+    async def asearch_by_vector(
+        self,
+        kb_id: str,
+        embedding: List[float],
+        k: int = 3,
+        filter_dict: Optional[dict] = None,
+    ) -> List[Document]:
+        """search_by_vector 的异步版本，在专用的向量执行器中执行"""
+        return await run_vector_op(
+            str(kb_id), "search", self.search_by_vector, kb_id, embedding, k, filter_dict
+        )
 
-                # --- 如果成功创建了 compressor，则包装 Retriever ---
-                if compressor:
-                    compression_retriever = ContextualCompressionRetriever(
-                        base_compressor=compressor, base_retriever=base_retriever
-                    )
-                    logger.info("ContextualCompressionRetriever 创建成功。")
-                    return compression_retriever
-                else:
-                    # compressor 未能创建成功（理论上应该在上面处理了）
-                    logger.warning("未能创建 Reranker Compressor，返回基础检索器。")
-                    return base_retriever
+    async def adelete_file_vectors(self, kb_id: str, file_md5: str) -> None:
+        """delete_file_vectors 的异步版本，经该知识库的写入队列与其他写入串行执行"""
+        await write_queue.submit_write(
+            str(kb_id), "delete", lambda: self.delete_file_vectors(kb_id, file_md5)
+        )
+
+    def delete_file_vectors(self, kb_id: str, file_md5: str) -> None:
+        """删除指定文件在知识库中的全部向量"""
+        kb_id_str = str(kb_id)
+        if not self.is_already_vector_database(kb_id_str):
+            logger.warning(f"知识库集合 '{kb_id_str}' 不存在，无需删除向量。")
+            return
+        vectorstore = self.load_knowledge(kb_id_str)
+        vectorstore.delete(where={"source_file_md5": file_md5})
+        FileSummaryIndex(kb_id_str).remove_file(file_md5)
+        self._vectorstores.pop(kb_id_str, None)
+
+    def _get_vectorstore(self, kb_id: str) -> VectorStore:
+        """获取 (并缓存) 指定知识库的向量存储实例，避免每次检索都重新创建客户端"""
+        vectorstore = self._vectorstores.get(kb_id)
+        if type(vectorstore) is Chroma and SegmentedChromaStore.exists(kb_id):
+            vectorstore = None  # 旧集合已转换为分段存储，重新加载
+        if vectorstore is None:
+            logger.info(f"加载知识库 '{kb_id}'...")
+            vectorstore = self.load_knowledge(kb_id)
+            self._vectorstores[kb_id] = vectorstore
+        return vectorstore
+
+    def _get_compressor(self) -> Optional[BaseDocumentCompressor]:
+        """
+        获取 (并缓存) 重排序压缩器。
+        本地 CrossEncoder 模型加载代价很高，因此只在首次使用时创建一次。
+        创建失败时会禁用重排序并返回 None。
+        """
+        if self._compressor is not None:
+            return self._compressor
+
+        logger.info(
+            f"启用重排序 (类型: {self.reranker_type}, TopN: {self.rerank_top_n})..."
+        )
+        compressor: Optional[BaseDocumentCompressor] = None
 
+        if self.reranker_type == "local":
+            # --- 使用本地 CrossEncoder Reranker ---
+            try:
+                logger.info(f"加载本地重排序模型: {self.local_rerank_model_path}")
+                # 确保 rerank_model 路径正确且模型存在
+                model_kwargs = {"device": "cpu"}  # 默认 CPU，可按需修改
+                # import torch
+                # if torch.cuda.is_available(): model_kwargs = {"device": "cuda"}
+
+                encoder_model = HuggingFaceCrossEncoder(
+                    model_name=self.local_rerank_model_path,
+                    model_kwargs=model_kwargs,
+                )
+                compressor = CrossEncoderReranker(
+                    model=encoder_model, top_n=self.rerank_top_n
+                )
+                logger.info("本地 CrossEncoderReranker 初始化成功。")
+            except Exception as e:
+                logger.error(
+                    f"加载或初始化本地重排序模型 '{self.local_rerank_model_path}' 时出错: {e}",
+                    exc_info=True,
+                )
+                # 出错则不使用重排序
+                self.use_reranker = False  # 禁用重排序以避免后续错误
+                return None
+
+        elif self.reranker_type == "remote":
+            # --- 使用远程 SiliconFlow Reranker ---
+            if self.remote_rerank_config and self.remote_rerank_config.get("api_key"):
+                api_key = self.remote_rerank_config["api_key"]
+                # remote_rerank_config 可能包含 'model'，也可能不包含
+                # RemoteRerankerCompressor 会处理默认值
+                try:
+                    # 使用关键字参数初始化，Pydantic 会根据类属性进行匹配
+                    compressor = RemoteRerankerCompressor(
+                        api_key=api_key,
+                        # 如果提供了 model，则使用它，否则使用类定义的默认值
+                        model_name=self.remote_rerank_config.get(
+                            "model", DEFAULT_REMOTE_RERANK_MODEL
+                        ),
+                        top_n=self.rerank_top_n,
+                    )
+                    logger.info("远程 RemoteRerankerCompressor 初始化成功。")
+                except Exception as e:
+                    # 捕获 Pydantic 初始化可能发生的其他错误 (例如类型不匹配)
+                    logger.error(
+                        f"初始化 RemoteRerankerCompressor 时发生 Pydantic 或其他错误: {e}",
+                        exc_info=True,
+                    )
+                    self.use_reranker = False
+                    return None
             else:
-                # --- 不使用重排序 ---
-                logger.info("重排序未启用，返回基础检索器。")
-                return base_retriever
+                logger.error(
+                    "无法使用远程 Reranker，因为 'remote_rerank_config' 或 'api_key' 未提供。"
+                )
+                self.use_reranker = False  # 禁用重排序
+                return None
 
-        except Exception as e:
-            error_msg = f"加载知识库 '{kb_id_str}' 或创建检索器时出错: {e}"
-            logger.error(error_msg, exc_info=True)
-            raise RuntimeError(error_msg) from e
+        else:
+            logger.warning(
+                f"未知的 reranker_type: '{self.reranker_type}'。将不使用重排序。"
+            )
+            self.use_reranker = False  # 禁用重排序
+            return None
+
+        self._compressor = compressor
+        return compressor
+
+    def get_configurable_retriever(
+        self, kb_id: str, search_k: int = 3
+    ) -> RunnableSerializable:
+        """
+        获取可在调用时注入过滤条件的检索器，用于构建可缓存复用的 RAG 链。
+        每次请求通过 config["configurable"] 传入 filter_dict 与 search_k。
+        :raises FileNotFoundError: 知识库向量存储不存在时抛出。
+        """
+        kb_id_str = str(kb_id)
+        if not self.is_already_vector_database(kb_id_str):
+            error_msg = f"知识库集合 '{kb_id_str}' 的物理存储 (在 {chroma_dir}) 不存在或无法访问！"
+            logger.error(error_msg)
+            raise FileNotFoundError(error_msg)
+
+        return KnowledgeBaseRetriever(
+            knowledge=self, kb_id=kb_id_str, search_k=search_k
+        ).configurable_fields(
+            filter_dict=ConfigurableField(
+                id="filter_dict",
+                name="Filter Dict",
+                description="元数据过滤条件，例如 {'source_file_md5': '...'}",
+            ),
+            search_k=ConfigurableField(
+                id="search_k",
+                name="Search K",
+                description="基础检索器返回的文档数量",
+            ),
+            budget_ms=ConfigurableField(
+                id="retrieval_budget_ms",
+                name="Retrieval Budget (ms)",
+                description="检索阶段的延迟预算，重排序超出预算时退回向量检索顺序",
+            ),
+        )
+
+    async def aget_documents_by_ids(
+        self, kb_id: str, ids: Sequence[str]
+    ) -> Optional[List[Document]]:
+        """
+        按块 ID 从向量库取回文档，结果保持 ids 的顺序。
+        任一 ID 已不存在 (文件被删除) 时返回 None。
+        """
+        if not ids:
+            return []
+        vectorstore = self._get_vectorstore(str(kb_id))
+        found = {
+            doc.id: doc
+            for doc in await run_vector_op(
+                str(kb_id), "get", vectorstore.get_by_ids, list(ids)
+            )
+        }
+        if any(doc_id not in found for doc_id in ids):
+            return None
+        return [found[doc_id] for doc_id in ids]
+
+    async def aembed_query(self, query: str) -> List[float]:
+        """使用知识库的嵌入模型计算查询向量"""
+        if not self._embeddings:
+            raise ValueError("无法计算查询向量，因为缺少 embedding 函数。")
+        return await self._embeddings.aembed_query(query)
+
+    def config_signature(self) -> tuple:
+        """返回重排序相关配置的签名，用作链缓存键的一部分 (API Key 仅保留哈希)"""
+        remote_cfg = self.remote_rerank_config or {}
+        api_key = remote_cfg.get("api_key") or ""
+        return (
+            self.splitter,
+            self.use_reranker,
+            self.reranker_type,
+            self.local_rerank_model_path if self.reranker_type == "local" else None,
+            remote_cfg.get("model"),
+            md5(api_key.encode("utf-8")).hexdigest() if api_key else "",
+            self.rerank_top_n,
+            self.adaptive_search_k,
+            self.nprobe,
+            self.coarse_top_files,
+        )
 
     @staticmethod
     def get_file_md5(file_path: str) -> str:
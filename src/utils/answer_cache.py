@@ -0,0 +1,92 @@
+import hashlib
+import logging
+import os
+from datetime import timedelta
+from typing import Iterator, List, Optional, Sequence
+
+import redis.asyncio as aioredis
+from langchain_core.documents import Document
+
+from src.config.Redis import get_redis_client
+from src.utils.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# --- 答案缓存相关常量 ---
+ANSWER_CACHE_PREFIX = "answer:"  # 答案缓存键前缀
+ANSWER_CACHE_TTL_SECONDS = int(
+    os.getenv("ANSWER_CACHE_TTL_SECONDS", timedelta(days=1).total_seconds())
+)
+ANSWER_REPLAY_CHUNK_SIZE = 64  # 命中时回放的分块大小 (字符)
+
+
+def get_chunk_id(doc: Document) -> str:
+    """获取文档块的稳定 ID：优先使用向量库返回的 id，否则使用内容的 MD5"""
+    doc_id = getattr(doc, "id", None)
+    if doc_id:
+        return str(doc_id)
+    return hashlib.md5(doc.page_content.encode("utf-8")).hexdigest()
+
+
+def build_answer_cache_key(
+    kb_id: str,
+    kb_version: int,
+    filter_by_file_md5: Optional[str],
+    question: str,
+    supplier: str,
+    model: str,
+    prompt_hash: str,
+    chunk_ids: Sequence[str],
+) -> str:
+    """
+    构造答案缓存键。知识库版本号包含在键中，文件增删后旧条目自然失效 (随 TTL 过期)。
+    """
+    digest = hashlib.sha256(
+        "\x1f".join(
+            [
+                filter_by_file_md5 or "",
+                question,
+                supplier,
+                model,
+                prompt_hash,
+                ",".join(chunk_ids),
+            ]
+        ).encode("utf-8")
+    ).hexdigest()
+    return f"{ANSWER_CACHE_PREFIX}{kb_id}:{kb_version}:{digest}"
+
+
+async def get_cached_answer(cache_key: str) -> Optional[str]:
+    """读取缓存的答案，Redis 不可用时视为未命中"""
+    try:
+        redis = get_redis_client()
+        answer = await redis.get(cache_key)
+    except (RuntimeError, aioredis.RedisError) as e:
+        logger.warning(f"读取答案缓存失败，按未命中处理: {e}")
+        answer = None
+    metrics.incr("answer_cache_requests_total", result="hit" if answer else "miss")
+    return answer
+
+
+async def set_cached_answer(cache_key: str, answer: str) -> None:
+    """写入答案缓存"""
+    if not answer:
+        return
+    try:
+        redis = get_redis_client()
+        await redis.set(cache_key, answer, ex=ANSWER_CACHE_TTL_SECONDS)
+        logger.debug(f"答案缓存已设置: {cache_key}")
+    except (RuntimeError, aioredis.RedisError) as e:
+        logger.warning(f"写入答案缓存失败: {e}")
+
+
+def iter_replay_chunks(
+    answer: str, chunk_size: int = ANSWER_REPLAY_CHUNK_SIZE
+) -> Iterator[str]:
+    """将缓存的答案切分为若干块，以流式事件的形式快速回放"""
+    for start in range(0, len(answer), chunk_size):
+        yield answer[start : start + chunk_size]
+
+
+def chunk_ids_of(docs: List[Document]) -> List[str]:
+    return [get_chunk_id(doc) for doc in docs]
@@ -0,0 +1,117 @@
+import hashlib
+import logging
+import os
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Optional
+
+from langchain_core.runnables import Runnable
+
+from src.utils.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# 最多缓存的已组装链数量
+CHAIN_CACHE_SIZE = int(os.getenv("CHAIN_CACHE_SIZE", 128))
+
+
+def hash_text(text: Optional[str]) -> str:
+    """对提示词、API Key 等文本取哈希，用作缓存键的一部分"""
+    if not text:
+        return ""
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()[:16]
+
+
+class CachedChain:
+    """缓存中的一条已组装好的链"""
+
+    def __init__(
+        self,
+        base_chain: Runnable,
+        chain_with_history: Runnable,
+        kb_id: Optional[str] = None,
+        prompt_hash: str = "",
+        retriever: Optional[Runnable] = None,
+    ):
+        self.base_chain = base_chain  # 基础链 (RAG 链或普通链)
+        self.chain_with_history = chain_with_history  # 包装了历史记录的链
+        self.retriever = retriever  # RAG 链的检索器，可在调用链之前单独执行检索
+        self.kb_id = kb_id  # 所用知识库 ID，用于按知识库失效
+        self.prompt_hash = prompt_hash  # 提示词哈希，用于按助手失效
+
+
+class ChainCache:
+    """
+    已组装链的 LRU 缓存。
+    键由调用方构造 (提示词哈希、supplier、model、知识库 ID、重排序配置等)，
+    每次请求只需在调用时注入问题、会话与过滤条件。
+    """
+
+    def __init__(self, max_size: int = CHAIN_CACHE_SIZE):
+        self.max_size = max_size
+        self._entries: "OrderedDict[Hashable, CachedChain]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Hashable) -> Optional[CachedChain]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def set(self, key: Hashable, entry: CachedChain) -> CachedChain:
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+        return entry
+
+    def invalidate_kb(self, kb_id: Any) -> int:
+        """使指定知识库相关的所有链失效 (文件增删或知识库删除时调用)"""
+        kb_id_str = str(kb_id)
+        with self._lock:
+            keys = [k for k, v in self._entries.items() if v.kb_id == kb_id_str]
+            for k in keys:
+                del self._entries[k]
+        if keys:
+            logger.info(f"知识库 {kb_id_str} 变更，已失效 {len(keys)} 条缓存链。")
+        return len(keys)
+
+    def invalidate_prompt(self, prompt: Optional[str]) -> int:
+        """使使用指定提示词的所有链失效 (助手更新或删除时调用)"""
+        prompt_hash = hash_text(prompt)
+        with self._lock:
+            keys = [
+                k for k, v in self._entries.items() if v.prompt_hash == prompt_hash
+            ]
+            for k in keys:
+                del self._entries[k]
+        if keys:
+            logger.info(f"助手提示词变更，已失效 {len(keys)} 条缓存链。")
+        return len(keys)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+            }
+
+
+# 进程内全局链缓存
+chain_cache = ChainCache()
+metrics.register_provider("chain_cache", chain_cache.stats)
@@ -0,0 +1,235 @@
+import logging
+import os
+import re
+from functools import lru_cache
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+from langchain_core.documents import Document
+
+from src.utils.answer_cache import get_chunk_id
+from src.utils.metrics import metrics
+
+try:
+    import tiktoken
+
+    TIKTOKEN_AVAILABLE = True
+except ImportError:
+    TIKTOKEN_AVAILABLE = False
+
+logger = logging.getLogger(__name__)
+
+# --- 上下文打包配置 ---
+CONTEXT_PACKING_ENABLED = os.getenv("CONTEXT_PACKING_ENABLED", "true").lower() == "true"
+# 交给 LLM 的检索上下文的 token 预算
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", 3000))
+# SimHash 汉明距离不超过该值的两个块视为近似重复
+CONTEXT_DEDUP_MAX_HAMMING = int(os.getenv("CONTEXT_DEDUP_MAX_HAMMING", 3))
+# 合并相邻块时，用于识别重叠部分的最大/最小字符数 (分块重叠为 50 字符)
+MERGE_MAX_OVERLAP_CHARS = 200
+MERGE_MIN_OVERLAP_CHARS = 20
+TOKENIZER_ENCODING = os.getenv("TOKENIZER_ENCODING", "cl100k_base")
+
+_CJK_PATTERN = re.compile(r"[\u3000-\u303f\u3400-\u9fff\uff00-\uffef]")
+_SIMHASH_BITS = np.arange(64, dtype=np.uint64)
+_SIMHASH_BASE = np.uint64(0x100000001B3)
+
+
+@lru_cache(maxsize=1)
+def _get_encoding():
+    """加载 (并缓存) tiktoken 编码器；不可用时返回 None，改用估算"""
+    if not TIKTOKEN_AVAILABLE:
+        return None
+    try:
+        return tiktoken.get_encoding(TOKENIZER_ENCODING)
+    except Exception as e:
+        logger.warning(f"加载 tiktoken 编码 {TOKENIZER_ENCODING} 失败，改用估算: {e}")
+        return None
+
+
+@lru_cache(maxsize=8192)
+def count_tokens(text: str) -> int:
+    """计算文本的 token 数 (结果按文本缓存，同一文档块重复出现时无需重新编码)"""
+    encoding = _get_encoding()
+    if encoding is not None:
+        return len(encoding.encode(text, disallowed_special=()))
+    # 估算：中日韩字符约 1 token/字，其余约 4 字符/token
+    cjk = len(_CJK_PATTERN.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+def _score_of(doc: Document) -> Optional[float]:
+    """
+    文档的排序分数：合并块取成员最高分，其次为重排序分数、
+    多知识库融合分数 (各知识库的向量相似度不可直接比较)、向量相似度
+    """
+    metadata = doc.metadata or {}
+    for key in ("pack_score", "relevance_score", "fusion_score", "vector_score"):
+        if metadata.get(key) is not None:
+            return float(metadata[key])
+    return None
+
+
+def _mix64(h: np.ndarray) -> np.ndarray:
+    """splitmix64 的末尾混合，使 n-gram 哈希的各位近似均匀"""
+    h = (h ^ (h >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    h = (h ^ (h >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return h ^ (h >> np.uint64(31))
+
+
+@lru_cache(maxsize=8192)
+def simhash(text: str, shingle_size: int = 3) -> int:
+    """
+    基于字符 n-gram 的 64 位 SimHash (对中文无需分词)。
+    各 n-gram 的哈希与逐位投票均以 NumPy 向量运算完成；结果按文本缓存，
+    同一文档块重复出现时无需重新计算。
+    """
+    normalized = "".join(text.split())
+    codes = np.frombuffer(normalized.encode("utf-32-le"), dtype=np.uint32)
+    codes = codes.astype(np.uint64)
+    width = min(shingle_size, len(codes))
+    n = max(len(codes) - shingle_size + 1, 1)
+    shingles = np.full(n, width, dtype=np.uint64)
+    with np.errstate(over="ignore"):  # 哈希按 2^64 取模
+        for offset in range(width):
+            shingles = shingles * _SIMHASH_BASE + codes[offset : offset + n]
+        hashes = _mix64(shingles)
+    bits = (hashes[:, None] >> _SIMHASH_BITS) & np.uint64(1)
+    votes = 2 * bits.sum(axis=0, dtype=np.int64) - n
+    return int(((votes > 0).astype(np.uint64) << _SIMHASH_BITS).sum())
+
+
+def _overlap_length(left: str, right: str) -> int:
+    """left 的结尾与 right 的开头相同部分的长度 (未达到最小重叠时返回 0)"""
+    max_len = min(len(left), len(right), MERGE_MAX_OVERLAP_CHARS)
+    for length in range(max_len, MERGE_MIN_OVERLAP_CHARS - 1, -1):
+        if left.endswith(right[:length]):
+            return length
+    return 0
+
+
+def _follows(first: Document, second: Document) -> bool:
+    """second 是否紧接在 first 之后 (同一文件中 chunk_index 连续，或内容首尾重叠)"""
+    first_meta, second_meta = first.metadata or {}, second.metadata or {}
+    file_md5 = first_meta.get("source_file_md5")
+    if file_md5 is None or second_meta.get("source_file_md5") != file_md5:
+        return False
+    end, start = first_meta.get("chunk_index_end"), second_meta.get("chunk_index_start")
+    if end is not None and start is not None:
+        return start == end + 1
+    return _overlap_length(first.page_content, second.page_content) > 0
+
+
+def _concat(first: Document, second: Document) -> Document:
+    """拼接两个相邻块 (去掉重叠部分)，保留更高的分数与排名靠前者的 ID"""
+    first_meta, second_meta = first.metadata or {}, second.metadata or {}
+    overlap = _overlap_length(first.page_content, second.page_content)
+    metadata = {
+        **first_meta,
+        "merged_chunk_ids": first_meta.get("merged_chunk_ids", [get_chunk_id(first)])
+        + second_meta.get("merged_chunk_ids", [get_chunk_id(second)]),
+    }
+    if second_meta.get("chunk_index_end") is not None:
+        metadata["chunk_index_end"] = second_meta["chunk_index_end"]
+    scores = [s for s in (_score_of(first), _score_of(second)) if s is not None]
+    if scores:
+        metadata["pack_score"] = max(scores)
+    return Document(
+        id=first.id,
+        page_content=first.page_content + second.page_content[overlap:],
+        metadata=metadata,
+    )
+
+
+def _merge_adjacent(docs: List[Document]) -> List[Document]:
+    """
+    合并同一文件中相邻的块，合并结果占据其中排名靠前者的位置。
+    """
+    merged: List[Document] = []
+    for doc in docs:
+        metadata = {**(doc.metadata or {})}
+        if metadata.get("chunk_index") is not None:
+            metadata["chunk_index_start"] = metadata["chunk_index"]
+            metadata["chunk_index_end"] = metadata["chunk_index"]
+        current = Document(id=doc.id, page_content=doc.page_content, metadata=metadata)
+        for i, existing in enumerate(merged):
+            if _follows(existing, current):
+                combined = _concat(existing, current)
+            elif _follows(current, existing):
+                combined = _concat(current, existing)
+                combined.id = existing.id
+            else:
+                continue
+            merged[i] = combined
+            break
+        else:
+            merged.append(current)
+    return merged
+
+
+def _drop_near_duplicates(docs: List[Document]) -> List[Document]:
+    """按排名顺序保留文档，与已保留文档的 SimHash 汉明距离过小者视为近似重复并丢弃"""
+    kept: List[Document] = []
+    fingerprints: List[int] = []
+    for doc in docs:
+        fingerprint = simhash(doc.page_content)
+        if any(
+            bin(fingerprint ^ other).count("1") <= CONTEXT_DEDUP_MAX_HAMMING
+            for other in fingerprints
+        ):
+            continue
+        kept.append(doc)
+        fingerprints.append(fingerprint)
+    return kept
+
+
+def pack_context(
+    docs: List[Document], token_budget: int = CONTEXT_TOKEN_BUDGET
+) -> List[Document]:
+    """
+    上下文打包：去除近似重复块 → 合并同一文件的相邻块 → 按分数在 token 预算内填充。
+    输入按检索排名排序；输出保持排名顺序。
+    """
+    if not CONTEXT_PACKING_ENABLED or not docs:
+        return docs
+    tokens_before = sum(count_tokens(doc.page_content) for doc in docs)
+
+    packed = _merge_adjacent(_drop_near_duplicates(docs))
+    ranked = sorted(
+        enumerate(packed),
+        key=lambda item: (-(_score_of(item[1]) or 0.0), item[0]),
+    )
+    selected: Dict[int, Document] = {}
+    used = 0
+    for position, doc in ranked:
+        tokens = count_tokens(doc.page_content)
+        if used + tokens > token_budget and selected:
+            continue  # 放不下则尝试下一个 (更短的) 块；至少保留排名第一的块
+        selected[position] = doc
+        used += tokens
+    result = [selected[position] for position in sorted(selected)]
+
+    metrics.observe("context_tokens_before_packing", tokens_before)
+    metrics.observe("context_tokens_after_packing", used)
+    metrics.incr("context_chunks_dropped_total", len(docs) - len(result))
+    logger.debug(
+        f"上下文打包: {len(docs)} 块/{tokens_before} tokens -> {len(result)} 块/{used} tokens"
+    )
+    return result
+
+
+def packing_stats() -> Dict[str, Any]:
+    info = count_tokens.cache_info()
+    simhash_info = simhash.cache_info()
+    return {
+        "enabled": CONTEXT_PACKING_ENABLED,
+        "token_budget": CONTEXT_TOKEN_BUDGET,
+        "tokenizer": TOKENIZER_ENCODING if _get_encoding() is not None else "estimate",
+        "token_cache_hits": info.hits,
+        "token_cache_misses": info.misses,
+        "simhash_cache_hits": simhash_info.hits,
+        "simhash_cache_misses": simhash_info.misses,
+    }
+
+
+metrics.register_provider("context_packing", packing_stats)
@@ -1,21 +1,121 @@
+import logging
 import os
+import threading
+from collections import OrderedDict
+from typing import List, Optional
 
+from langchain_core.embeddings import Embeddings
 from langchain_ollama import OllamaEmbeddings  # ollama本地模型
 from langchain_openai import OpenAIEmbeddings
 
+from src.utils.resilience import ResilientCaller, get_resilient_caller
+
+logger = logging.getLogger(__name__)
+
 ONEAPI_BASE_URL = os.getenv("ONEAPI_BASE_URL")
+# 查询向量缓存的最大条目数 (远程服务熔断或失败时的降级来源)
+QUERY_EMBEDDING_CACHE_SIZE = int(os.getenv("QUERY_EMBEDDING_CACHE_SIZE", 1024))
+# 复用的远程嵌入包装实例数量上限 (按模型与 API Key 区分)
+EMBEDDING_CLIENT_CACHE_SIZE = int(os.getenv("EMBEDDING_CLIENT_CACHE_SIZE", 16))
+
+
+class ResilientEmbeddings(Embeddings):
+    """
+    远程嵌入服务的弹性包装：查询调用经过对冲请求与熔断器 (见 resilience.py)，
+    查询向量按文本做 LRU 缓存，命中时无需访问远程服务；
+    远程服务熔断或失败时，已缓存的查询仍可正常检索。
+    文档批量嵌入使用单独的调用器 (batch_caller)：不对冲 (重复发送整批只会加重远程负载)，
+    其延迟与失败也不计入查询的 p95 与熔断器，入库失败不会让查询熔断。
+    """
+
+    def __init__(
+        self,
+        inner: Embeddings,
+        caller: ResilientCaller,
+        batch_caller: ResilientCaller,
+        cache_size: int = QUERY_EMBEDDING_CACHE_SIZE,
+    ):
+        self.inner = inner
+        self.caller = caller
+        self.batch_caller = batch_caller
+        self.cache_size = cache_size
+        self._query_cache: "OrderedDict[str, List[float]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _get_cached(self, text: str) -> Optional[List[float]]:
+        with self._lock:
+            vector = self._query_cache.get(text)
+            if vector is not None:
+                self._query_cache.move_to_end(text)
+            return vector
+
+    def _set_cached(self, text: str, vector: List[float]) -> None:
+        with self._lock:
+            self._query_cache[text] = vector
+            self._query_cache.move_to_end(text)
+            while len(self._query_cache) > self.cache_size:
+                self._query_cache.popitem(last=False)
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self.batch_caller.call_sync(lambda: self.inner.embed_documents(texts))
+
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        return await self.batch_caller.call(lambda: self.inner.aembed_documents(texts))
+
+    def embed_query(self, text: str) -> List[float]:
+        vector = self._get_cached(text)
+        if vector is None:
+            vector = self.caller.call_sync(lambda: self.inner.embed_query(text))
+            self._set_cached(text, vector)
+        return vector
+
+    async def aembed_query(self, text: str) -> List[float]:
+        vector = self._get_cached(text)
+        if vector is None:
+            vector = await self.caller.call(lambda: self.inner.aembed_query(text))
+            self._set_cached(text, vector)
+        return vector
+
+
+_resilient_embeddings: "OrderedDict[tuple, ResilientEmbeddings]" = OrderedDict()
+_resilient_embeddings_lock = threading.Lock()
 
 
 def get_embedding(supplier: str, model_name: str, inference_api_key: str = None):
     if supplier == "ollama":
         embeddings = OllamaEmbeddings(model=model_name)
     elif supplier == "oneapi":
-        embeddings = OpenAIEmbeddings(
-            base_url=ONEAPI_BASE_URL, model=model_name, api_key=inference_api_key
-        )
+        embeddings = _get_resilient_oneapi_embedding(model_name, inference_api_key)
     # elif supplier == "openai":
     #     # OpenAI embedding模型，会自动从环境变量OPENAI_API_KEY获取密钥
     #     embeddings = OpenAIEmbeddings(model=model_name)
     else:
         raise ValueError("Invalid supplier or model name")
     return embeddings
+
+
+def _get_resilient_oneapi_embedding(
+    model_name: str, inference_api_key: str = None
+) -> ResilientEmbeddings:
+    """OneAPI 远程嵌入：按 (模型, API Key) 复用包装实例，使查询向量缓存跨请求生效"""
+    key = (ONEAPI_BASE_URL, model_name, inference_api_key)
+    with _resilient_embeddings_lock:
+        embeddings = _resilient_embeddings.get(key)
+        if embeddings is None:
+            embeddings = ResilientEmbeddings(
+                OpenAIEmbeddings(
+                    base_url=ONEAPI_BASE_URL,
+                    model=model_name,
+                    api_key=inference_api_key,
+                ),
+                get_resilient_caller(f"embedding:oneapi:{model_name}"),
+                get_resilient_caller(
+                    f"embedding-batch:oneapi:{model_name}", hedge=False
+                ),
+            )
+            _resilient_embeddings[key] = embeddings
+            while len(_resilient_embeddings) > EMBEDDING_CLIENT_CACHE_SIZE:
+                _resilient_embeddings.popitem(last=False)
+        else:
+            _resilient_embeddings.move_to_end(key)
+        return embeddings
@@ -0,0 +1,136 @@
+import asyncio
+import logging
+import os
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, List, Optional, Sequence
+
+from langchain_core.documents import Document
+
+from src.utils.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# --- 多知识库联合检索配置 ---
+# 各知识库的向量检索在共享的向量执行器中并发执行 (见 vector_executor)
+# 结果融合方式: rrf (倒数排名融合) 或 score (按知识库做 min-max 归一化后比较分数)
+FEDERATED_FUSION = os.getenv("FEDERATED_FUSION", "rrf")
+FUSION_METHODS = ("rrf", "score")
+RRF_K = int(os.getenv("RRF_K", 60))  # RRF 平滑常数
+
+
+class FederatedSource:
+    """
+    参与联合检索的一个知识库。
+    embedding_key 标识所用嵌入模型 (supplier, model, API Key 哈希)，
+    相同 embedding_key 的知识库共享一次查询向量计算。
+    """
+
+    def __init__(self, kb_id: str, knowledge: Any, embedding_key: Hashable):
+        self.kb_id = str(kb_id)
+        self.knowledge = knowledge  # 该知识库的 Knowledge 实例 (持有其嵌入模型)
+        self.embedding_key = embedding_key
+
+
+def fuse_results(
+    result_lists: Sequence[List[Document]],
+    method: str = FEDERATED_FUSION,
+    limit: Optional[int] = None,
+) -> List[Document]:
+    """
+    融合多个知识库的检索结果 (各自按相似度降序)，融合分数写入 metadata["fusion_score"]。
+    rrf: score = Σ 1 / (RRF_K + 排名)，不依赖各知识库分数的量纲；
+    score: 每个知识库内将 vector_score 做 min-max 归一化后统一排序。
+    """
+    if method not in FUSION_METHODS:
+        raise ValueError(f"不支持的融合方式: {method}")
+    scored = []
+    for list_index, docs in enumerate(result_lists):
+        if method == "score":
+            values = [float((d.metadata or {}).get("vector_score", 0.0)) for d in docs]
+            low, high = (min(values), max(values)) if values else (0.0, 0.0)
+            span = high - low
+            fusion = [(v - low) / span if span > 0 else 1.0 for v in values]
+        else:
+            fusion = [1.0 / (RRF_K + rank + 1) for rank in range(len(docs))]
+        for rank, (doc, score) in enumerate(zip(docs, fusion)):
+            scored.append((score, rank, list_index, doc))
+    scored.sort(key=lambda item: (-item[0], item[1], item[2]))
+
+    fused = []
+    for score, _, _, doc in scored[:limit]:
+        doc.metadata = {**(doc.metadata or {}), "fusion_score": round(score, 6)}
+        fused.append(doc)
+    return fused
+
+
+async def afederated_retrieve(
+    sources: Sequence[FederatedSource],
+    query: str,
+    reranker: Any,
+    filter_dict: Optional[dict] = None,
+    search_k: int = 3,
+    budget_ms: Optional[int] = None,
+    fusion: str = FEDERATED_FUSION,
+) -> List[Document]:
+    """
+    多知识库联合检索：
+    1. 按嵌入模型分组，每组只计算一次查询向量；
+    2. 各知识库的向量检索在有界的向量执行器中并发执行 (各组在拿到查询向量后立即开始)，
+       总延迟取决于最慢的知识库而非各知识库之和；
+    3. 融合各知识库结果 (RRF 或归一化分数)，保留 search_k 个候选；
+    4. 用 reranker (主知识库的 Knowledge 实例) 在剩余预算内统一重排序一次。
+    单个知识库检索失败时跳过该知识库，其余结果照常返回。
+    """
+    started_at = time.monotonic()
+    groups: "OrderedDict[Hashable, List[FederatedSource]]" = OrderedDict()
+    for source in sources:
+        groups.setdefault(source.embedding_key, []).append(source)
+
+    async def search(source: FederatedSource, vector: List[float]) -> List[Document]:
+        search_started = time.perf_counter()
+        try:
+            return await source.knowledge.asearch_by_vector(
+                source.kb_id, vector, search_k, filter_dict
+            )
+        except Exception as e:
+            logger.error(f"联合检索中知识库 {source.kb_id} 检索失败，已跳过: {e}")
+            metrics.incr("federated_kb_errors_total")
+            return []
+        finally:
+            metrics.observe(
+                "federated_kb_search_seconds", time.perf_counter() - search_started
+            )
+
+    async def run_group(group: List[FederatedSource]) -> List[List[Document]]:
+        try:
+            vector = await group[0].knowledge.aembed_query(query)
+        except Exception as e:
+            logger.error(
+                f"联合检索中计算查询向量失败，跳过知识库 {[s.kb_id for s in group]}: {e}"
+            )
+            metrics.incr("federated_kb_errors_total", len(group))
+            return [[] for _ in group]
+        return list(await asyncio.gather(*(search(s, vector) for s in group)))
+
+    grouped_results = await asyncio.gather(*(run_group(g) for g in groups.values()))
+    result_lists = [docs for group in grouped_results for docs in group]
+    fused = fuse_results(result_lists, method=fusion, limit=search_k)
+    metrics.observe("federated_embedding_groups", len(groups))
+    logger.info(
+        f"联合检索 {len(sources)} 个知识库 ({len(groups)} 个嵌入模型)，"
+        f"融合后 {len(fused)} 个候选 ({fusion})"
+    )
+    return await reranker.arerank_within_budget(
+        query, fused, started_at=started_at, budget_ms=budget_ms
+    )
+
+
+def federated_stats() -> Dict[str, Any]:
+    return {
+        "fusion": FEDERATED_FUSION,
+        "rrf_k": RRF_K,
+    }
+
+
+metrics.register_provider("federated_retrieval", federated_stats)
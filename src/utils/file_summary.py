@@ -0,0 +1,164 @@
+import logging
+import os
+import shutil
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+from langchain_core.vectorstores import VectorStore
+
+from src.utils.flat_index import FlatIndexStore, _normalize_rows
+from src.utils.metrics import metrics
+from src.utils.segmented_store import SegmentedChromaStore
+from src.utils.sharded_store import ShardedVectorStore
+
+logger = logging.getLogger(__name__)
+
+# --- 文件级摘要向量 (两阶段由粗到细检索) 配置 ---
+file_summary_dir = os.getenv("FILE_SUMMARY_DIR", "file_summaries/")  # 摘要索引根目录
+# 粗筛阶段默认选取的文件数
+COARSE_TOP_FILES = int(os.getenv("COARSE_TOP_FILES", 20))
+
+
+def file_vector_sum(
+    vectorstore: VectorStore, file_md5: str
+) -> Tuple[Optional[np.ndarray], int]:
+    """返回指定文件全部块的归一化向量之和与块数 (各后端直接读取已存储的向量)"""
+    if isinstance(vectorstore, (ShardedVectorStore, SegmentedChromaStore)):
+        parts = (
+            vectorstore.shards
+            if isinstance(vectorstore, ShardedVectorStore)
+            else vectorstore.segment_stores()
+        )
+        total, count = None, 0
+        for part in parts:
+            part_sum, part_count = file_vector_sum(part, file_md5)
+            if part_count:
+                total = part_sum if total is None else total + part_sum
+                count += part_count
+        return total, count
+    if isinstance(vectorstore, FlatIndexStore):
+        snapshot = vectorstore.snapshot()
+        if snapshot is None:
+            return None, 0
+        rows = snapshot.file_rows(file_md5)
+        if not len(rows):
+            return None, 0
+        vectors = np.asarray(snapshot.float_vectors[rows], dtype=np.float32)
+    else:
+        result = vectorstore.get(
+            where={"source_file_md5": file_md5}, include=["embeddings"]
+        )
+        if not result["ids"]:
+            return None, 0
+        vectors = _normalize_rows(np.asarray(result["embeddings"], dtype=np.float32))
+    return vectors.sum(axis=0), len(vectors)
+
+
+class FileSummaryIndex:
+    """
+    知识库的文件级摘要索引：每个文件一行，向量为该文件所有块向量的质心 (归一化均值)。
+    存储复用平铺索引 (file_summaries/<kb_id>/)，与知识库的向量存储后端无关；
+    粗筛阶段在这里选出与查询最相近的若干文件，细检索只在这些文件的块中进行。
+    """
+
+    def __init__(self, kb_id: str):
+        self.kb_id = str(kb_id)
+        self.store = FlatIndexStore(
+            self.kb_id,
+            None,
+            persist_directory=os.path.join(file_summary_dir, self.kb_id),
+            dtype="float32",
+        )
+
+    def exists(self) -> bool:
+        return self.store.snapshot() is not None
+
+    def file_count(self) -> int:
+        snapshot = self.store.snapshot()
+        return snapshot.count if snapshot is not None else 0
+
+    @staticmethod
+    def destroy(kb_id: str) -> None:
+        path = os.path.join(file_summary_dir, str(kb_id))
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+
+    def update_file(
+        self, vectorstore: VectorStore, file_md5: str, file_name: Optional[str]
+    ) -> bool:
+        """由已存储的块向量 (重新) 计算文件质心；文件没有块时删除其摘要"""
+        total, count = file_vector_sum(vectorstore, file_md5)
+        self.remove_file(file_md5)
+        if not count:
+            return False
+        centroid = _normalize_rows(total[None, :])
+        self.store.add_vectors(
+            centroid,
+            [file_name or file_md5],
+            [
+                {
+                    "source_file_md5": file_md5,
+                    "source_file_name": file_name,
+                    "chunk_count": count,
+                }
+            ],
+            [file_md5],
+        )
+        return True
+
+    def remove_file(self, file_md5: str) -> None:
+        if self.exists():
+            self.store.delete(where={"source_file_md5": file_md5})
+
+    def rebuild(self, vectorstore: VectorStore, files: List[dict]) -> Dict[str, Any]:
+        """为 filesList 中的全部文件重新计算摘要 (用于已有知识库的回填)"""
+        started_at = time.perf_counter()
+        updated = sum(
+            1
+            for file_info in files
+            if self.update_file(
+                vectorstore, file_info.get("file_md5"), file_info.get("file_name")
+            )
+        )
+        return {
+            "files": len(files),
+            "summarized": updated,
+            "seconds": round(time.perf_counter() - started_at, 3),
+        }
+
+    def top_files(
+        self, query_vector: List[float], m: int, filter: Optional[dict] = None
+    ) -> List[str]:
+        """粗筛：返回与查询向量最相近的 m 个文件的 MD5 (可限定在过滤条件内)"""
+        hits = self.store.similarity_search_by_vector_with_score(
+            query_vector, k=m, filter=filter, nprobe=0
+        )
+        return [doc.metadata["source_file_md5"] for doc, _ in hits]
+
+
+def coarse_file_filter(
+    kb_id: str,
+    query_vector: List[float],
+    top_files: int,
+    filter_dict: Optional[dict] = None,
+) -> Optional[dict]:
+    """
+    两阶段检索的粗筛：把过滤条件收窄为最相近的 top_files 个文件。
+    摘要索引不存在或文件数不多于 top_files 时原样返回 filter_dict。
+    """
+    summaries = FileSummaryIndex(kb_id)
+    file_count = summaries.file_count()
+    if file_count <= top_files:
+        metrics.incr(
+            "coarse_retrieval_total", path="skipped" if file_count else "no_summaries"
+        )
+        return filter_dict
+    started_at = time.perf_counter()
+    file_md5s = summaries.top_files(query_vector, top_files, filter_dict)
+    metrics.observe("coarse_retrieval_seconds", time.perf_counter() - started_at)
+    if not file_md5s:
+        metrics.incr("coarse_retrieval_total", path="empty")
+        return filter_dict
+    metrics.incr("coarse_retrieval_total", path="narrowed")
+    return {"source_file_md5": {"$in": file_md5s}}
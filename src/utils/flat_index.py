@@ -0,0 +1,1174 @@
+import hashlib
+import json
+import logging
+import mmap
+import os
+import shutil
+import threading
+import time
+import uuid
+from typing import Any, Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.vectorstores import VectorStore
+
+from src.utils.ivf_index import (
+    IVF_ASSIGN_FILE,
+    IVF_CENTROIDS_FILE,
+    IVF_DEFAULT_NPROBE,
+    IVF_OFFSETS_FILE,
+    IVF_ROWS_FILE,
+    assign_lists,
+    default_n_lists,
+    ivf_arrays,
+    nearest_lists,
+    train_kmeans,
+)
+from src.utils.metrics import metrics
+
+try:  # 跨进程的写锁 (Windows 上没有 fcntl，只有进程内的写锁)
+    import fcntl
+except ImportError:
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+# --- NumPy 平铺索引配置 ---
+flat_index_dir = os.getenv("FLAT_INDEX_DIR", "flat_index/")  # 索引根目录
+FLAT_INDEX_DTYPE = os.getenv("FLAT_INDEX_DTYPE", "float32")  # float32、float16 或 int8
+FLAT_INDEX_DTYPES = ("float32", "float16", "int8")
+# int8 量化模式下，先在量化向量上取 k * 该倍数个候选，再用原始浮点向量重新打分
+SQ_RESCORE_FACTOR = int(os.getenv("SQ_RESCORE_FACTOR", 4))
+# 分块计算相似度的行数 (float16 时先转换为 float32 再做矩阵乘法)
+SEARCH_BLOCK_ROWS = int(os.getenv("FLAT_INDEX_SEARCH_BLOCK_ROWS", 65536))
+# 带文件过滤时，过滤后行数不超过该值则直接精确检索 (避免 IVF 探查的列表中该文件的行过少)
+IVF_FILTER_EXACT_MAX_ROWS = int(os.getenv("IVF_FILTER_EXACT_MAX_ROWS", 50000))
+# 原地追加的行数超过已建索引行数的该比例 (且超过 FLAT_INDEX_COMPACT_MIN_ROWS) 时，
+# 下一次写入重写为新版本 (重建按文件分组的行索引与 IVF 倒排列表，int8 重新量化)
+FLAT_INDEX_COMPACT_RATIO = float(os.getenv("FLAT_INDEX_COMPACT_RATIO", 0.2))
+FLAT_INDEX_COMPACT_MIN_ROWS = int(os.getenv("FLAT_INDEX_COMPACT_MIN_ROWS", 10000))
+# 被替换的版本目录与清单保留的时间 (秒)，让刚读到旧指针的读请求 (含其他 worker 进程) 完成打开
+FLAT_INDEX_GC_GRACE_SECONDS = int(os.getenv("FLAT_INDEX_GC_GRACE_SECONDS", 300))
+
+CURRENT_FILE = "CURRENT"  # 当前已发布的 "<版本目录>/<清单文件>" (旧版本只有版本目录名)
+MANIFEST_FILE = "manifest.json"  # 旧版本布局的清单
+MANIFEST_PREFIX = "manifest-"  # 追加布局的清单：每次追加发布一个新清单，行数之外的字节对读请求不可见
+LAYOUT_APPEND = "append"
+ROWS_FILE = "rows.jsonl"  # 每行一个 {"id", "text", "metadata"}
+# --- 追加布局：逐行数组为原始二进制文件，按清单中的行数内存映射，追加时原地扩展 ---
+VECTORS_BIN = "vectors.bin"  # (n, d) 归一化向量 (int8 模式下为量化编码)
+FLOAT_VECTORS_BIN = "vectors_float.bin"  # int8 模式: (n, d) float32 原始向量，仅重新打分时按行读取
+OFFSETS_BIN = "offsets.bin"  # (n + 1,) int64 rows.jsonl 中每行的字节偏移
+FILE_CODES_BIN = "file_codes.bin"  # (n,) int32 每行所属文件在清单 files 中的下标
+ID_HASHES_BIN = "id_hashes.bin"  # (n,) uint64 每行 ID 的哈希，按 ID 查找时向量化比较
+IVF_ASSIGN_BIN = "ivf_assign.bin"  # (n,) int32 每行所属的倒排列表
+# --- 旧版本布局 (.npy，写入后不再变化)，仅用于读取 ---
+VECTORS_FILE = "vectors.npy"
+FLOAT_VECTORS_FILE = "vectors_float.npy"
+OFFSETS_FILE = "offsets.npy"
+FILE_CODES_FILE = "file_codes.npy"
+FILES_FILE = "files.json"  # 文件 MD5 列表
+SQ_OFFSET_FILE = "sq_offset"  # int8 模式: (d,) 每维偏移 (最小值)
+SQ_SCALE_FILE = "sq_scale"  # int8 模式: (d,) 每维量化步长
+# 按文件分组的行索引 (CSR)：file_rows[file_row_offsets[c]:file_row_offsets[c + 1]] 为文件 c 的行号 (升序)
+# 只覆盖写入版本时的前 indexed_count 行，之后原地追加的行检索时单独扫描
+FILE_ROWS_FILE = "file_rows"
+FILE_ROW_OFFSETS_FILE = "file_row_offsets"
+WRITE_LOCK_FILE = ".lock"
+RETIRED_FILE = "RETIRED"  # 版本目录被替换的时间 (文件修改时间)，宽限期过后删除
+
+# 每个知识库一把写锁，保证同一索引的写入串行
+_write_locks: Dict[str, threading.Lock] = {}
+_write_locks_guard = threading.Lock()
+
+
+class _IndexWriteLock:
+    """索引的写锁：进程内的线程锁 + (支持时) 索引目录下锁文件上的跨进程 flock"""
+
+    def __init__(self, path: str):
+        self.path = path
+        with _write_locks_guard:
+            self._lock = _write_locks.setdefault(path, threading.Lock())
+        self._file = None
+
+    def __enter__(self) -> "_IndexWriteLock":
+        self._lock.acquire()
+        try:
+            if fcntl is not None:
+                os.makedirs(self.path, exist_ok=True)
+                self._file = open(os.path.join(self.path, WRITE_LOCK_FILE), "a")
+                fcntl.flock(self._file, fcntl.LOCK_EX)
+        except BaseException:
+            self._lock.release()
+            raise
+        return self
+
+    def __exit__(self, *exc: Any) -> None:
+        try:
+            if self._file is not None:
+                self._file.close()  # 关闭文件即释放 flock
+                self._file = None
+        finally:
+            self._lock.release()
+
+
+def _write_lock(path: str) -> _IndexWriteLock:
+    return _IndexWriteLock(path)
+
+
+def id_hash(doc_id: str) -> int:
+    """块 ID 的 64 位哈希 (写入 id_hashes.bin)"""
+    return int.from_bytes(
+        hashlib.blake2b(doc_id.encode("utf-8"), digest_size=8).digest(), "little"
+    )
+
+
+def _map_rows(
+    path: str, dtype: Any, count: int, width: Optional[int] = None
+) -> np.ndarray:
+    """只读内存映射逐行数组文件的前 count 行 (之后原地追加的行对该快照不可见)"""
+    shape = (count,) if width is None else (count, width)
+    if not count:
+        return np.zeros(shape, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode="r", shape=shape)
+
+
+def _append_raw(path: str, data: bytes, committed_bytes: int) -> None:
+    """在已发布的 committed_bytes 之后写入数据 (先截掉上次未发布就中断的写入残留)"""
+    with open(path, "r+b" if os.path.exists(path) else "w+b") as f:
+        f.truncate(committed_bytes)
+        f.seek(committed_bytes)
+        f.write(data)
+
+
+def quantize(
+    vectors: np.ndarray, offset: np.ndarray, scale: np.ndarray
+) -> np.ndarray:
+    """按维度标量量化为 int8: x ≈ offset + scale * (code + 128)"""
+    codes = np.rint((np.asarray(vectors, dtype=np.float32) - offset) / scale)
+    return (np.clip(codes, 0, 255) - 128).astype(np.int8)
+
+
+def _write_quantized(version_path: str, floats: np.ndarray) -> None:
+    """由已写入的浮点向量计算每维 offset/scale，并写入 int8 编码"""
+    count, dim = floats.shape
+    low = np.full(dim, np.inf, dtype=np.float32)
+    high = np.full(dim, -np.inf, dtype=np.float32)
+    for start in range(0, count, SEARCH_BLOCK_ROWS):
+        block = floats[start : start + SEARCH_BLOCK_ROWS]
+        low = np.minimum(low, block.min(axis=0))
+        high = np.maximum(high, block.max(axis=0))
+    scale = (high - low) / 255.0
+    scale[scale == 0] = 1.0
+    codes = np.memmap(
+        os.path.join(version_path, VECTORS_BIN),
+        mode="w+",
+        dtype=np.int8,
+        shape=(count, dim),
+    )
+    for start in range(0, count, SEARCH_BLOCK_ROWS):
+        block = floats[start : start + SEARCH_BLOCK_ROWS]
+        codes[start : start + len(block)] = quantize(block, low, scale)
+    codes.flush()
+    del codes
+    np.save(os.path.join(version_path, f"{SQ_OFFSET_FILE}.npy"), low)
+    np.save(os.path.join(version_path, f"{SQ_SCALE_FILE}.npy"), scale)
+
+
+def file_row_arrays(file_codes: np.ndarray, n_files: int) -> Dict[str, np.ndarray]:
+    """由每行的文件编码构建按文件分组的行索引 (稳定排序，组内行号升序)"""
+    counts = np.bincount(file_codes, minlength=n_files)
+    offsets = np.zeros(n_files + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    return {
+        FILE_ROWS_FILE: np.argsort(file_codes, kind="stable").astype(np.int64),
+        FILE_ROW_OFFSETS_FILE: offsets,
+    }
+
+
+def _normalize_rows(vectors: np.ndarray) -> np.ndarray:
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+class FlatIndexSnapshot:
+    """
+    一个已发布的只读索引版本 (版本目录 + 清单)。
+    向量以内存映射方式打开，多个 worker 进程共享同一份操作系统页缓存；
+    文本与元数据按需从 rows.jsonl 中按偏移读取。
+    int8 模式下常驻页缓存的只有量化编码 (约为 float32 的 1/4)，
+    浮点向量仅在对少量候选重新打分时按行读取。
+    追加布局的版本目录会被后续写入原地扩展，快照只读取清单中的前 count 行；
+    前 indexed_count 行有按文件分组的行索引与 IVF 倒排列表，之后追加的行检索时单独扫描。
+    """
+
+    def __init__(self, index_path: str, pointer: str):
+        version, _, manifest_name = pointer.partition("/")
+        self.path = os.path.join(index_path, version)
+        self.version = pointer
+        with open(
+            os.path.join(self.path, manifest_name or MANIFEST_FILE), "r", encoding="utf-8"
+        ) as f:
+            self.manifest: Dict[str, Any] = json.load(f)
+        self.count = int(self.manifest["count"])
+        self.dim = self.manifest.get("dim")
+        self.dtype = self.manifest.get("dtype", FLAT_INDEX_DTYPE)
+        self.quantized = self.dtype == "int8" and self.count > 0
+        self.appendable = self.manifest.get("layout") == LAYOUT_APPEND
+        self.indexed_count = int(self.manifest.get("indexed_count", self.count))
+        self._id_hashes: Optional[np.ndarray] = None
+        if self.appendable:
+            self._open_append_layout()
+        else:
+            self._open_legacy_layout()
+        self._file_index = {md5: code for code, md5 in enumerate(self.files)}
+        if self.count:
+            self._rows_file = open(os.path.join(self.path, ROWS_FILE), "rb")
+            self._rows = mmap.mmap(self._rows_file.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            self._rows_file = None
+            self._rows = b""
+        if self.quantized:
+            self.sq_offset = self._load(SQ_OFFSET_FILE)
+            self.sq_scale = self._load(SQ_SCALE_FILE)
+        # IVF 近似索引 (可选)：聚类中心常驻内存，倒排列表以内存映射方式打开
+        self.ivf_lists = int(self.manifest.get("ivf_lists") or 0) if self.count else 0
+        if self.ivf_lists:
+            self.ivf_centroids = self._load(IVF_CENTROIDS_FILE)
+            self.ivf_offsets = self._load(IVF_OFFSETS_FILE)
+            self.ivf_rows = self._load(IVF_ROWS_FILE, mmap_mode="r")
+            self.ivf_assign = (
+                _map_rows(os.path.join(self.path, IVF_ASSIGN_BIN), np.int32, self.count)
+                if self.appendable
+                else self._load(IVF_ASSIGN_FILE, mmap_mode="r")
+            )
+        self._lock = threading.Lock()
+
+    def _open_append_layout(self) -> None:
+        path, count, dim = self.path, self.count, self.dim
+        vector_dtype = np.int8 if self.dtype == "int8" else np.dtype(self.dtype)
+        self.vectors = _map_rows(os.path.join(path, VECTORS_BIN), vector_dtype, count, dim or 0)
+        # 浮点向量：int8 模式下为单独的内存映射文件，其余模式即 vectors 本身
+        self.float_vectors = self.vectors
+        if self.quantized:
+            self.float_vectors = _map_rows(
+                os.path.join(path, FLOAT_VECTORS_BIN), np.float32, count, dim
+            )
+        self.offsets = (
+            _map_rows(os.path.join(path, OFFSETS_BIN), np.int64, count + 1)
+            if count
+            else np.zeros(1, dtype=np.int64)
+        )
+        self.file_codes = _map_rows(os.path.join(path, FILE_CODES_BIN), np.int32, count)
+        self._id_hashes = _map_rows(os.path.join(path, ID_HASHES_BIN), np.uint64, count)
+        self.files: List[Optional[str]] = list(self.manifest.get("files", []))
+        self.file_rows_index = self._load(FILE_ROWS_FILE, mmap_mode="r")
+        self.file_row_offsets = self._load(FILE_ROW_OFFSETS_FILE)
+
+    def _open_legacy_layout(self) -> None:
+        """旧版本布局 (.npy)：只读，第一次追加时整体重写为追加布局"""
+        path = self.path
+        if self.count:
+            self.vectors = np.load(os.path.join(path, VECTORS_FILE), mmap_mode="r")
+            self.offsets = np.load(os.path.join(path, OFFSETS_FILE))
+            self.file_codes = np.load(os.path.join(path, FILE_CODES_FILE))
+        else:
+            self.vectors = np.zeros((0, self.dim or 0), dtype=np.float32)
+            self.offsets = np.zeros(1, dtype=np.int64)
+            self.file_codes = np.zeros(0, dtype=np.int32)
+        self.float_vectors = self.vectors
+        if self.quantized:
+            self.float_vectors = np.load(
+                os.path.join(path, FLOAT_VECTORS_FILE), mmap_mode="r"
+            )
+        with open(os.path.join(path, FILES_FILE), "r", encoding="utf-8") as f:
+            self.files = json.load(f)
+        # 按文件分组的行索引：文件范围的检索只读取该文件的行，无需扫描全部行
+        if os.path.exists(os.path.join(path, f"{FILE_ROWS_FILE}.npy")):
+            self.file_rows_index = self._load(FILE_ROWS_FILE, mmap_mode="r")
+            self.file_row_offsets = self._load(FILE_ROW_OFFSETS_FILE)
+        else:
+            # 更早的版本未写入分组索引，打开时计算一次
+            arrays = file_row_arrays(self.file_codes, len(self.files))
+            self.file_rows_index = arrays[FILE_ROWS_FILE]
+            self.file_row_offsets = arrays[FILE_ROW_OFFSETS_FILE]
+
+    def _load(self, name: str, mmap_mode: Optional[str] = None) -> np.ndarray:
+        return np.load(os.path.join(self.path, f"{name}.npy"), mmap_mode=mmap_mode)
+
+    @property
+    def default_nprobe(self) -> int:
+        """未指定 nprobe 时使用的探查列表数 (构建 IVF 时可按知识库设定)"""
+        return int(self.manifest.get("ivf_nprobe") or IVF_DEFAULT_NPROBE)
+
+    def ivf_manifest(self) -> Dict[str, Any]:
+        """需要随新版本保留的 IVF 清单字段"""
+        keys = ("ivf_lists", "ivf_nprobe", "ivf_trained_count")
+        return {key: self.manifest[key] for key in keys if key in self.manifest}
+
+    # --- 行读取 ---
+    def raw_row(self, row: int) -> bytes:
+        return self._rows[int(self.offsets[row]) : int(self.offsets[row + 1])]
+
+    def row(self, row: int) -> Dict[str, Any]:
+        return json.loads(self.raw_row(row))
+
+    def document(self, row: int) -> Document:
+        record = self.row(row)
+        return Document(
+            id=record["id"], page_content=record["text"], metadata=record["metadata"]
+        )
+
+    @property
+    def id_hashes(self) -> np.ndarray:
+        """每行 ID 的哈希；旧版本布局没有该文件，第一次使用时由各行计算"""
+        if self._id_hashes is None:
+            with self._lock:
+                if self._id_hashes is None:
+                    self._id_hashes = np.fromiter(
+                        (id_hash(self.row(i)["id"]) for i in range(self.count)),
+                        dtype=np.uint64,
+                        count=self.count,
+                    )
+        return self._id_hashes
+
+    def rows_of(self, doc_ids: Iterable[str]) -> Dict[str, int]:
+        """按 ID 查找行号：在 ID 哈希数组上向量化比较，再读取候选行核对 ID"""
+        wanted = set(doc_ids)
+        if not wanted or not self.count:
+            return {}
+        hashes = np.fromiter((id_hash(d) for d in wanted), dtype=np.uint64)
+        candidates = np.flatnonzero(np.isin(self.id_hashes, hashes))
+        found: Dict[str, int] = {}
+        for row in candidates:
+            doc_id = self.row(int(row))["id"]
+            if doc_id in wanted:
+                found[doc_id] = int(row)
+        return found
+
+    def row_of(self, doc_id: str) -> Optional[int]:
+        return self.rows_of([doc_id]).get(doc_id)
+
+    # --- 过滤 ---
+    def file_rows(self, file_md5: str) -> np.ndarray:
+        """
+        指定文件的行号 (升序)：已建索引的行直接取自按文件分组的行索引，
+        之后原地追加的行 (行号都更大) 扫描其文件编码。
+        """
+        code = self._file_index.get(file_md5)
+        if code is None:
+            return np.zeros(0, dtype=np.int64)
+        rows = np.zeros(0, dtype=np.int64)
+        if code + 1 < len(self.file_row_offsets):
+            start, end = self.file_row_offsets[code], self.file_row_offsets[code + 1]
+            rows = np.asarray(self.file_rows_index[start:end], dtype=np.int64)
+        if self.indexed_count < self.count:
+            tail = np.flatnonzero(self.file_codes[self.indexed_count :] == code)
+            rows = np.concatenate([rows, tail + self.indexed_count])
+        return rows
+
+    def rows_for_filter(self, filter: Optional[dict]) -> Optional[np.ndarray]:
+        """
+        将元数据过滤条件转换为行号数组 (升序)；None 表示不过滤。
+        支持 {"source_file_md5": md5} 与 {"source_file_md5": {"$in": [...]}}，
+        knowledge_base_id 条件在单个知识库索引内恒为真，直接忽略。
+        """
+        if not filter:
+            return None
+        conditions = dict(filter)
+        conditions.pop("knowledge_base_id", None)
+        if not conditions:
+            return None
+        if set(conditions) != {"source_file_md5"}:
+            raise ValueError(f"平铺索引不支持的过滤条件: {filter}")
+        condition = conditions["source_file_md5"]
+        if isinstance(condition, dict):
+            if set(condition) != {"$in"}:
+                raise ValueError(f"平铺索引不支持的过滤条件: {filter}")
+            file_md5s = list(condition["$in"])
+        else:
+            file_md5s = [condition]
+        parts = [self.file_rows(str(file_md5)) for file_md5 in set(file_md5s)]
+        if len(parts) == 1:
+            return parts[0]
+        # 多个文件：合并后排序，保证按行顺序读取
+        return np.sort(np.concatenate(parts)) if parts else np.zeros(0, dtype=np.int64)
+
+    # --- 检索 ---
+    def score_rows(
+        self,
+        query: np.ndarray,
+        rows: Optional[np.ndarray] = None,
+        exact: bool = False,
+    ) -> np.ndarray:
+        """
+        计算查询向量与指定行 (None 为全部行) 的余弦相似度。
+        int8 模式下默认返回基于量化编码的近似分数；exact=True 时使用浮点向量。
+        """
+        if self.quantized and not exact:
+            # q·x ≈ q·offset + (q*scale)·code + 128 * sum(q*scale)
+            weights = query * self.sq_scale
+            bias = float(query @ self.sq_offset) + 128.0 * float(weights.sum())
+            return self._dot(self.vectors, weights, rows) + bias
+        return self._dot(self.float_vectors, query, rows)
+
+    def _dot(
+        self, matrix: np.ndarray, vector: np.ndarray, rows: Optional[np.ndarray]
+    ) -> np.ndarray:
+        if rows is not None:
+            return np.asarray(matrix[rows], dtype=np.float32) @ vector
+        if matrix.dtype == np.float32:
+            return matrix @ vector  # 单次 BLAS 矩阵乘法
+        scores = np.empty(self.count, dtype=np.float32)
+        for start in range(0, self.count, SEARCH_BLOCK_ROWS):
+            block = np.asarray(
+                matrix[start : start + SEARCH_BLOCK_ROWS], dtype=np.float32
+            )
+            scores[start : start + len(block)] = block @ vector
+        return scores
+
+    def candidate_rows(
+        self, query: np.ndarray, filter: Optional[dict], nprobe: Optional[int]
+    ) -> Optional[np.ndarray]:
+        """
+        需要计算相似度的候选行 (None 为全部行)。
+        存在 IVF 索引且 0 < nprobe < 列表数时只取最接近的 nprobe 个倒排列表中的行；
+        nprobe 为 0 或不小于列表数时退化为精确检索。
+        """
+        filtered = self.rows_for_filter(filter)
+        nprobe = self.default_nprobe if nprobe is None else nprobe
+        use_ivf = self.ivf_lists and 0 < nprobe < self.ivf_lists
+        if use_ivf and filtered is not None:
+            use_ivf = len(filtered) > IVF_FILTER_EXACT_MAX_ROWS
+        if not use_ivf:
+            return filtered
+        lists = nearest_lists(self.ivf_centroids, query, nprobe)
+        parts = [self.ivf_rows[self.ivf_offsets[l] : self.ivf_offsets[l + 1]] for l in lists]
+        if self.indexed_count < self.count:
+            # 原地追加的行不在倒排列表中，按其所属列表筛选
+            tail = np.flatnonzero(np.isin(self.ivf_assign[self.indexed_count :], lists))
+            parts.append(tail + self.indexed_count)
+        rows = np.concatenate(parts).astype(np.int64, copy=False)
+        if filtered is None:
+            return rows
+        return rows[np.isin(rows, filtered, assume_unique=True)]
+
+    def search(
+        self,
+        query: np.ndarray,
+        k: int,
+        filter: Optional[dict] = None,
+        nprobe: Optional[int] = None,
+        exact: bool = False,
+    ) -> List[Tuple[int, float]]:
+        """
+        top-k 检索 (精确或 IVF 近似)，返回 [(行号, 余弦相似度)]，按相似度降序。
+        int8 模式下先在量化编码上取 k * SQ_RESCORE_FACTOR 个候选，再用浮点向量重新打分；
+        exact=True 时跳过量化编码，直接在浮点向量上检索 (用于基准对比)。
+        """
+        if not self.count or k <= 0:
+            return []
+        rows = self.candidate_rows(query, filter, nprobe)
+        if rows is not None and not len(rows):
+            return []
+        scores = self.score_rows(query, rows, exact=exact)
+        if self.quantized and not exact:
+            shortlist = min(len(scores), k * max(1, SQ_RESCORE_FACTOR))
+            top = np.argpartition(-scores, shortlist - 1)[:shortlist]
+            rows = np.sort(rows[top] if rows is not None else top)  # 顺序读取
+            scores = self.score_rows(query, rows, exact=True)
+        k = min(k, len(scores))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        candidates = rows[top] if rows is not None else top
+        return [(int(row), float(scores[i])) for row, i in zip(candidates, top)]
+
+    def close(self) -> None:
+        if self._rows_file is not None:
+            try:
+                self._rows.close()
+                self._rows_file.close()
+            except (BufferError, ValueError):
+                pass  # 仍有读取中的切片引用，交给垃圾回收
+
+
+# 进程内已打开的快照 (按索引目录缓存)，同一版本只打开一次
+_snapshots: Dict[str, FlatIndexSnapshot] = {}
+_snapshots_lock = threading.Lock()
+
+
+def _read_current(index_path: str) -> Optional[str]:
+    try:
+        with open(os.path.join(index_path, CURRENT_FILE), "r", encoding="utf-8") as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+
+def open_snapshot(index_path: str) -> Optional[FlatIndexSnapshot]:
+    """打开索引的当前版本 (版本与清单未变化时复用已打开的快照)"""
+    pointer = _read_current(index_path)
+    if pointer is None:
+        return None
+    with _snapshots_lock:
+        snapshot = _snapshots.get(index_path)
+        if snapshot is not None and snapshot.version == pointer:
+            return snapshot
+        snapshot = FlatIndexSnapshot(index_path, pointer)
+        _snapshots[index_path] = snapshot
+        return snapshot
+
+
+def _publish_manifest(
+    index_path: str, version: str, manifest: Dict[str, Any]
+) -> str:
+    """
+    在版本目录中写入新清单并原子替换 CURRENT 指针，返回新指针。
+    被替换的清单保留 FLAT_INDEX_GC_GRACE_SECONDS 秒 (供刚读到旧指针的读请求使用)。
+    """
+    version_path = os.path.join(index_path, version)
+    previous_version, _, previous = (_read_current(index_path) or "").partition("/")
+    name = f"{MANIFEST_PREFIX}{int(time.time() * 1000)}-{uuid.uuid4().hex[:6]}.json"
+    with open(os.path.join(version_path, name), "w", encoding="utf-8") as f:
+        json.dump(manifest, f)
+    pointer = f"{version}/{name}"
+    tmp_pointer = os.path.join(index_path, f"{CURRENT_FILE}.{version}.tmp")
+    with open(tmp_pointer, "w", encoding="utf-8") as f:
+        f.write(pointer)
+    os.replace(tmp_pointer, os.path.join(index_path, CURRENT_FILE))
+    if previous_version == version and previous:
+        # 以修改时间记录上一份清单被替换的时间
+        try:
+            os.utime(os.path.join(version_path, previous))
+        except FileNotFoundError:
+            pass
+    expire_before = time.time() - FLAT_INDEX_GC_GRACE_SECONDS
+    for old in os.listdir(version_path):
+        old_path = os.path.join(version_path, old)
+        if (
+            old.startswith(MANIFEST_PREFIX)
+            and old != name
+            and _modified_before(old_path, expire_before)
+        ):
+            os.remove(old_path)
+    return pointer
+
+
+def _modified_before(path: str, timestamp: float) -> bool:
+    try:
+        return os.path.getmtime(path) < timestamp
+    except FileNotFoundError:
+        return False
+
+
+def write_snapshot(
+    index_path: str,
+    dim: int,
+    rows: Iterable[Tuple[np.ndarray, bytes, Optional[str], int]],
+    count: int,
+    dtype: str = FLAT_INDEX_DTYPE,
+    extra_manifest: Optional[Dict[str, Any]] = None,
+    extra_arrays: Optional[Dict[str, np.ndarray]] = None,
+) -> str:
+    """
+    写入一个新版本 (追加布局) 并原子发布：先在新版本目录中写完全部文件，
+    再以 os.replace 替换 CURRENT 指针。正在读取旧版本的请求不受影响。
+    rows 逐行产出 (归一化向量, rows.jsonl 中的一行字节, 文件 MD5, ID 哈希)；
+    extra_arrays 为随版本写入的附加数组 (如 IVF 倒排列表)，保存为 <名称>.npy，
+    其中每行的倒排列表分配保存为可原地追加的 ivf_assign.bin。
+    返回新的 CURRENT 指针 ("<版本目录>/<清单文件>")。
+    """
+    os.makedirs(index_path, exist_ok=True)
+    version = f"v{int(time.time() * 1000)}-{uuid.uuid4().hex[:6]}"
+    version_path = os.path.join(index_path, version)
+    os.makedirs(version_path)
+
+    files: List[Optional[str]] = []
+    file_index: Dict[Optional[str], int] = {}
+    offsets = np.zeros(count + 1, dtype=np.int64)
+    file_codes = np.zeros(count, dtype=np.int32)
+    id_hashes = np.zeros(count, dtype=np.uint64)
+    vectors = None
+    if count:
+        # int8 模式先写浮点向量，全部写完后再计算量化参数并生成编码
+        vectors = np.memmap(
+            os.path.join(
+                version_path, FLOAT_VECTORS_BIN if dtype == "int8" else VECTORS_BIN
+            ),
+            mode="w+",
+            dtype=np.float32 if dtype == "int8" else np.dtype(dtype),
+            shape=(count, dim),
+        )
+    written = 0
+    with open(os.path.join(version_path, ROWS_FILE), "wb") as rows_file:
+        for i, (vector, raw, file_md5, row_id_hash) in enumerate(rows):
+            vectors[i] = vector
+            rows_file.write(raw)
+            written += len(raw)
+            offsets[i + 1] = written
+            if file_md5 not in file_index:
+                file_index[file_md5] = len(files)
+                files.append(file_md5)
+            file_codes[i] = file_index[file_md5]
+            id_hashes[i] = row_id_hash
+    if vectors is not None:
+        vectors.flush()
+        if dtype == "int8":
+            _write_quantized(version_path, vectors)
+        del vectors
+    offsets.tofile(os.path.join(version_path, OFFSETS_BIN))
+    file_codes.tofile(os.path.join(version_path, FILE_CODES_BIN))
+    id_hashes.tofile(os.path.join(version_path, ID_HASHES_BIN))
+    for name, array in file_row_arrays(file_codes, len(files)).items():
+        np.save(os.path.join(version_path, f"{name}.npy"), array)
+    for name, array in (extra_arrays or {}).items():
+        if name == IVF_ASSIGN_FILE:
+            np.asarray(array, dtype=np.int32).tofile(
+                os.path.join(version_path, IVF_ASSIGN_BIN)
+            )
+        else:
+            np.save(os.path.join(version_path, f"{name}.npy"), array)
+    manifest = {
+        "layout": LAYOUT_APPEND,
+        "count": count,
+        "indexed_count": count,
+        "dim": dim,
+        "dtype": dtype,
+        "files": files,
+        **(extra_manifest or {}),
+    }
+
+    # 原子发布
+    pointer = _publish_manifest(index_path, version, manifest)
+    _remove_old_versions(index_path, keep=version)
+    return pointer
+
+
+def append_rows(
+    index_path: str,
+    snapshot: FlatIndexSnapshot,
+    vectors: np.ndarray,
+    raws: Sequence[bytes],
+    file_md5s: Sequence[Optional[str]],
+    row_id_hashes: Sequence[int],
+) -> str:
+    """
+    把新行原地追加到当前版本目录的逐行文件末尾，再发布行数更大的新清单。
+    已发布的行不被改写，持有旧清单的读请求只读取旧的前 count 行，不受影响。
+    只用于追加布局的非空版本；返回新的 CURRENT 指针。
+    """
+    path, count, dim = snapshot.path, snapshot.count, snapshot.dim
+    n = len(raws)
+    files = list(snapshot.files)
+    file_index = dict(snapshot._file_index)
+    codes = np.empty(n, dtype=np.int32)
+    for i, file_md5 in enumerate(file_md5s):
+        if file_md5 not in file_index:
+            file_index[file_md5] = len(files)
+            files.append(file_md5)
+        codes[i] = file_index[file_md5]
+    rows_end = int(snapshot.offsets[count])
+    new_offsets = rows_end + np.cumsum([len(raw) for raw in raws], dtype=np.int64)
+
+    vectors = np.asarray(vectors, dtype=np.float32)
+    if snapshot.quantized:
+        # 新行沿用当前的量化参数 (超出范围的分量被截断)，压缩重写时重新量化
+        _append_raw(
+            os.path.join(path, FLOAT_VECTORS_BIN), vectors.tobytes(), count * dim * 4
+        )
+        codes_int8 = quantize(vectors, snapshot.sq_offset, snapshot.sq_scale)
+        _append_raw(os.path.join(path, VECTORS_BIN), codes_int8.tobytes(), count * dim)
+    else:
+        vector_dtype = np.dtype(snapshot.dtype)
+        _append_raw(
+            os.path.join(path, VECTORS_BIN),
+            vectors.astype(vector_dtype).tobytes(),
+            count * dim * vector_dtype.itemsize,
+        )
+    _append_raw(os.path.join(path, ROWS_FILE), b"".join(raws), rows_end)
+    _append_raw(os.path.join(path, OFFSETS_BIN), new_offsets.tobytes(), (count + 1) * 8)
+    _append_raw(os.path.join(path, FILE_CODES_BIN), codes.tobytes(), count * 4)
+    _append_raw(
+        os.path.join(path, ID_HASHES_BIN),
+        np.asarray(row_id_hashes, dtype=np.uint64).tobytes(),
+        count * 8,
+    )
+    if snapshot.ivf_lists:
+        # 新行分配到最近的倒排列表，聚类中心保持不变
+        assign = assign_lists(snapshot.ivf_centroids, vectors).astype(np.int32)
+        _append_raw(os.path.join(path, IVF_ASSIGN_BIN), assign.tobytes(), count * 4)
+    manifest = {**snapshot.manifest, "count": count + n, "files": files}
+    return _publish_manifest(index_path, os.path.basename(path), manifest)
+
+
+def _remove_old_versions(index_path: str, keep: str) -> None:
+    """
+    回收旧版本目录：被替换时先写入 RETIRED 标记，标记超过 FLAT_INDEX_GC_GRACE_SECONDS 秒后
+    才删除，刚读到旧指针、尚未打开快照的读请求 (含其他 worker 进程) 仍能打开旧版本。
+    已打开的快照不受删除影响 (POSIX 上已被内存映射的文件在删除后仍可被读取)。
+    """
+    expire_before = time.time() - FLAT_INDEX_GC_GRACE_SECONDS
+    for name in os.listdir(index_path):
+        path = os.path.join(index_path, name)
+        if name == keep or not name.startswith("v") or not os.path.isdir(path):
+            continue
+        marker = os.path.join(path, RETIRED_FILE)
+        if not os.path.exists(marker):
+            with open(marker, "w", encoding="utf-8") as f:
+                f.write(keep)
+        elif _modified_before(marker, expire_before):
+            shutil.rmtree(path, ignore_errors=True)
+
+
+def _copy_rows(
+    snapshot: FlatIndexSnapshot, indices: Iterable[int]
+) -> Iterable[Tuple[np.ndarray, bytes, Optional[str], int]]:
+    """逐行复制已发布版本中的行 (供 write_snapshot 使用)"""
+    id_hashes = snapshot.id_hashes
+    for i in indices:
+        yield (
+            snapshot.float_vectors[i],
+            snapshot.raw_row(i),
+            snapshot.files[snapshot.file_codes[i]],
+            int(id_hashes[i]),
+        )
+
+
+def _latency_summary(latencies: List[float]) -> Dict[str, float]:
+    ordered = sorted(latencies)
+    pick = lambda q: ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+    return {
+        "latency_ms_p50": round(pick(0.5) * 1000, 3),
+        "latency_ms_p95": round(pick(0.95) * 1000, 3),
+    }
+
+
+def encode_row(doc_id: str, text: str, metadata: Optional[dict]) -> bytes:
+    return (
+        json.dumps(
+            {"id": doc_id, "text": text, "metadata": metadata or {}},
+            ensure_ascii=False,
+        )
+        + "\n"
+    ).encode("utf-8")
+
+
+class FlatIndexStore(VectorStore):
+    """
+    基于内存映射 NumPy 数组的平铺向量存储，可作为 Chroma 之外的知识库后端。
+    - vectors.bin 存放归一化后的 float32/float16 向量，检索为一次矩阵乘法 + argpartition 的精确 top-k；
+    - 每个版本写入按文件分组的行索引，按 source_file_md5 过滤时只计算该文件 (或文件列表) 的行；
+    - 可选 IVF 近似索引 (build_ivf)，按请求的 nprobe 只检索最接近的若干倒排列表；
+    - 可选 int8 标量量化 (dtype="int8")，量化编码上筛选候选后用浮点向量重新打分；
+    - 追加写入原地扩展当前版本目录并原子发布新清单，删除、重建 IVF 与压缩生成新版本目录；
+      读请求始终只读取已发布清单中的行。
+    相似度 (relevance score) 为余弦相似度。
+    """
+
+    def __init__(
+        self,
+        collection_name: str,
+        embedding_function: Embeddings,
+        persist_directory: Optional[str] = None,
+        dtype: str = FLAT_INDEX_DTYPE,
+    ):
+        self.collection_name = collection_name
+        self._embedding_function = embedding_function
+        self.index_path = persist_directory or os.path.join(
+            flat_index_dir, collection_name
+        )
+        if dtype not in FLAT_INDEX_DTYPES:
+            raise ValueError(f"不支持的平铺索引存储类型: {dtype}")
+        self.dtype = dtype
+
+    @staticmethod
+    def exists(collection_name: str) -> bool:
+        return _read_current(os.path.join(flat_index_dir, collection_name)) is not None
+
+    @staticmethod
+    def destroy(collection_name: str) -> None:
+        """删除整个索引目录"""
+        index_path = os.path.join(flat_index_dir, collection_name)
+        with _snapshots_lock:
+            snapshot = _snapshots.pop(index_path, None)
+        if snapshot is not None:
+            snapshot.close()
+        if os.path.isdir(index_path):
+            shutil.rmtree(index_path)
+
+    @property
+    def embeddings(self) -> Embeddings:
+        return self._embedding_function
+
+    def snapshot(self) -> Optional[FlatIndexSnapshot]:
+        return open_snapshot(self.index_path)
+
+    # --- 写入 ---
+    def add_texts(
+        self,
+        texts: Iterable[str],
+        metadatas: Optional[List[dict]] = None,
+        *,
+        ids: Optional[List[str]] = None,
+        **kwargs: Any,
+    ) -> List[str]:
+        texts = list(texts)
+        if not texts:
+            return []
+        metadatas = metadatas or [{} for _ in texts]
+        ids = [doc_id or str(uuid.uuid4()) for doc_id in (ids or [None] * len(texts))]
+        vectors = _normalize_rows(self._embedding_function.embed_documents(texts))
+        self.add_vectors(vectors, texts, metadatas, ids)
+        return ids
+
+    def add_vectors(
+        self,
+        vectors: np.ndarray,
+        texts: Sequence[str],
+        metadatas: Sequence[dict],
+        ids: Sequence[str],
+    ) -> None:
+        """
+        追加已计算好的 (归一化) 向量。当前版本为追加布局时，新行原地写入版本目录的
+        逐行文件末尾并发布新清单，不复制已有的行；原地追加的行数超过压缩阈值
+        (或当前为旧版本布局) 时，复制全部行重写为新版本，重建行索引与倒排列表。
+        已有索引沿用其存储类型，self.dtype 只决定新建索引的类型。
+        """
+        with _write_lock(self.index_path):
+            snapshot = self.snapshot()
+            dim = vectors.shape[1]
+            if snapshot is not None and snapshot.count and snapshot.dim != dim:
+                raise ValueError(
+                    f"向量维度 {dim} 与索引 '{self.collection_name}' 的维度 {snapshot.dim} 不一致"
+                )
+            old_count = snapshot.count if snapshot is not None else 0
+            raws = [
+                encode_row(doc_id, text, metadata)
+                for doc_id, text, metadata in zip(ids, texts, metadatas)
+            ]
+            file_md5s = [(metadata or {}).get("source_file_md5") for metadata in metadatas]
+            row_id_hashes = [id_hash(doc_id) for doc_id in ids]
+
+            if old_count and snapshot.appendable:
+                unindexed = old_count + len(ids) - snapshot.indexed_count
+                compact_at = max(
+                    FLAT_INDEX_COMPACT_MIN_ROWS,
+                    FLAT_INDEX_COMPACT_RATIO * snapshot.indexed_count,
+                )
+                if unindexed <= compact_at:
+                    version = append_rows(
+                        self.index_path, snapshot, vectors, raws, file_md5s, row_id_hashes
+                    )
+                    logger.info(
+                        f"平铺索引 '{self.collection_name}' 原地追加 {len(ids)} 行 ({version})，"
+                        f"共 {old_count + len(ids)} 行。"
+                    )
+                    return
+
+            extra_arrays, extra_manifest = None, None
+            if old_count and snapshot.ivf_lists:
+                # 增量追加：新行分配到最近的倒排列表，聚类中心保持不变
+                assign = np.concatenate(
+                    [
+                        np.asarray(snapshot.ivf_assign),
+                        assign_lists(snapshot.ivf_centroids, vectors),
+                    ]
+                )
+                extra_arrays = ivf_arrays(snapshot.ivf_centroids, assign)
+                extra_manifest = snapshot.ivf_manifest()
+
+            def rows():
+                if old_count:
+                    yield from _copy_rows(snapshot, range(old_count))
+                yield from zip(vectors, raws, file_md5s, row_id_hashes)
+
+            version = write_snapshot(
+                self.index_path,
+                dim,
+                rows(),
+                old_count + len(ids),
+                dtype=snapshot.dtype if old_count else self.dtype,
+                extra_manifest=extra_manifest,
+                extra_arrays=extra_arrays,
+            )
+        logger.info(
+            f"平铺索引 '{self.collection_name}' 已发布版本 {version}，共 {old_count + len(ids)} 行。"
+        )
+
+    def delete(
+        self,
+        ids: Optional[List[str]] = None,
+        where: Optional[dict] = None,
+        **kwargs: Any,
+    ) -> Optional[bool]:
+        """按 ID 或过滤条件 (同检索过滤) 删除行，发布为新版本"""
+        with _write_lock(self.index_path):
+            snapshot = self.snapshot()
+            if snapshot is None or not snapshot.count:
+                return True
+            remove = np.zeros(snapshot.count, dtype=bool)
+            if ids:
+                remove[list(snapshot.rows_of(ids).values())] = True
+            if where:
+                rows = snapshot.rows_for_filter(where)
+                if rows is None:
+                    remove[:] = True  # 仅含 knowledge_base_id 的条件匹配全部行
+                else:
+                    remove[rows] = True
+            if not remove.any():
+                return True
+            keep = np.flatnonzero(~remove)
+            extra_arrays, extra_manifest = None, None
+            if snapshot.ivf_lists and len(keep):
+                assign = np.asarray(snapshot.ivf_assign)[keep]
+                extra_arrays = ivf_arrays(snapshot.ivf_centroids, assign)
+                extra_manifest = snapshot.ivf_manifest()
+
+            write_snapshot(
+                self.index_path,
+                snapshot.dim,
+                _copy_rows(snapshot, keep),
+                len(keep),
+                dtype=snapshot.dtype,
+                extra_manifest=extra_manifest,
+                extra_arrays=extra_arrays,
+            )
+        logger.info(
+            f"平铺索引 '{self.collection_name}' 删除 {int(remove.sum())} 行，剩余 {len(keep)} 行。"
+        )
+        return True
+
+    # --- 读取 ---
+    def get_by_ids(self, ids: Sequence[str], /) -> List[Document]:
+        snapshot = self.snapshot()
+        if snapshot is None:
+            return []
+        rows = snapshot.rows_of(ids)
+        return [snapshot.document(rows[doc_id]) for doc_id in ids if doc_id in rows]
+
+    def similarity_search_by_vector_with_score(
+        self,
+        embedding: List[float],
+        k: int = 4,
+        filter: Optional[dict] = None,
+        nprobe: Optional[int] = None,
+    ) -> List[Tuple[Document, float]]:
+        snapshot = self.snapshot()
+        if snapshot is None:
+            return []
+        start = time.perf_counter()
+        query = _normalize_rows(np.asarray([embedding]))[0]
+        hits = snapshot.search(query, k, filter, nprobe=nprobe)
+        effective_nprobe = snapshot.default_nprobe if nprobe is None else nprobe
+        metrics.observe(
+            "flat_index_search_seconds",
+            time.perf_counter() - start,
+            # nprobe 为 0 或不小于列表数时 search 退化为精确检索
+            mode="ivf" if 0 < effective_nprobe < snapshot.ivf_lists else "exact",
+        )
+        return [(snapshot.document(row), score) for row, score in hits]
+
+    def similarity_search_with_score(
+        self,
+        query: str,
+        k: int = 4,
+        filter: Optional[dict] = None,
+        nprobe: Optional[int] = None,
+        **kwargs: Any,
+    ) -> List[Tuple[Document, float]]:
+        embedding = self._embedding_function.embed_query(query)
+        return self.similarity_search_by_vector_with_score(embedding, k, filter, nprobe)
+
+    def similarity_search(
+        self, query: str, k: int = 4, filter: Optional[dict] = None, **kwargs: Any
+    ) -> List[Document]:
+        return [doc for doc, _ in self.similarity_search_with_score(query, k, filter)]
+
+    def similarity_search_by_vector(
+        self,
+        embedding: List[float],
+        k: int = 4,
+        filter: Optional[dict] = None,
+        **kwargs: Any,
+    ) -> List[Document]:
+        return [
+            doc
+            for doc, _ in self.similarity_search_by_vector_with_score(
+                embedding, k, filter
+            )
+        ]
+
+    # --- IVF 维护 ---
+    def build_ivf(
+        self, n_lists: Optional[int] = None, default_nprobe: Optional[int] = None
+    ) -> Dict[str, Any]:
+        """
+        (重新) 构建 IVF 索引：用当前全部向量训练 k-means 聚类中心并重新分配所有行，
+        发布为新版本。增量追加的行只会分配到已有中心，数据分布变化较大时应重新构建。
+        """
+        with _write_lock(self.index_path):
+            snapshot = self.snapshot()
+            if snapshot is None or not snapshot.count:
+                raise ValueError(f"平铺索引 '{self.collection_name}' 为空，无法构建 IVF。")
+            n_lists = n_lists or default_n_lists(snapshot.count)
+            start = time.perf_counter()
+            centroids = train_kmeans(snapshot.float_vectors, n_lists)
+            assign = assign_lists(centroids, snapshot.float_vectors)
+            train_seconds = time.perf_counter() - start
+            version = write_snapshot(
+                self.index_path,
+                snapshot.dim,
+                _copy_rows(snapshot, range(snapshot.count)),
+                snapshot.count,
+                dtype=snapshot.dtype,
+                extra_manifest={
+                    "ivf_lists": len(centroids),
+                    "ivf_nprobe": default_nprobe or IVF_DEFAULT_NPROBE,
+                    "ivf_trained_count": snapshot.count,
+                },
+                extra_arrays=ivf_arrays(centroids, assign),
+            )
+        list_sizes = np.bincount(assign, minlength=len(centroids))
+        logger.info(
+            f"平铺索引 '{self.collection_name}' 已构建 IVF: {len(centroids)} 个列表，"
+            f"训练耗时 {train_seconds:.2f}s，版本 {version}。"
+        )
+        return {
+            "version": version,
+            "count": snapshot.count,
+            "n_lists": len(centroids),
+            "default_nprobe": default_nprobe or IVF_DEFAULT_NPROBE,
+            "train_seconds": round(train_seconds, 3),
+            "max_list_size": int(list_sizes.max()),
+            "empty_lists": int((list_sizes == 0).sum()),
+        }
+
+    def ivf_recall_report(
+        self,
+        k: int = 10,
+        nprobes: Sequence[int] = (1, 2, 4, 8, 16, 32, 64),
+        n_queries: int = 100,
+        seed: int = 0,
+    ) -> Dict[str, Any]:
+        """
+        IVF 的 recall@k 与延迟报告：以索引中随机抽取的向量为查询 (结果中排除查询自身)，
+        以浮点向量上的精确检索结果为基准 (int8 模式下也不经过量化编码)，
+        逐个 nprobe 统计召回率与 p50/p95 延迟，用于为知识库选择工作点。
+        """
+        snapshot = self.snapshot()
+        if snapshot is None or not snapshot.ivf_lists:
+            raise ValueError(f"平铺索引 '{self.collection_name}' 尚未构建 IVF。")
+        rng = np.random.default_rng(seed)
+        query_rows = np.sort(
+            rng.choice(snapshot.count, size=min(n_queries, snapshot.count), replace=False)
+        )
+        queries = np.asarray(snapshot.float_vectors[query_rows], dtype=np.float32)
+
+        def run(nprobe: int, exact: bool = False):
+            results, latencies = [], []
+            for query_row, query in zip(query_rows, queries):
+                start = time.perf_counter()
+                hits = snapshot.search(query, k + 1, nprobe=nprobe, exact=exact)
+                latencies.append(time.perf_counter() - start)
+                results.append({row for row, _ in hits if row != query_row})
+            return results, latencies
+
+        exact, exact_latencies = run(0, exact=True)
+        report: Dict[str, Any] = {
+            "count": snapshot.count,
+            "n_lists": snapshot.ivf_lists,
+            "appended_since_training": snapshot.count
+            - int(snapshot.manifest.get("ivf_trained_count", snapshot.count)),
+            "default_nprobe": snapshot.default_nprobe,
+            "k": k,
+            "queries": len(queries),
+            "exact": _latency_summary(exact_latencies),
+            "operating_points": [],
+        }
+        for nprobe in sorted({n for n in nprobes if 0 < n <= snapshot.ivf_lists}):
+            approx, latencies = run(nprobe)
+            recall = np.mean(
+                [
+                    len(a & e) / len(e) if e else 1.0
+                    for a, e in zip(approx, exact)
+                ]
+            )
+            report["operating_points"].append(
+                {
+                    "nprobe": nprobe,
+                    "recall_at_k": round(float(recall), 4),
+                    **_latency_summary(latencies),
+                }
+            )
+        return report
+
+    def quantization_report(
+        self, k: int = 10, n_queries: int = 100, seed: int = 0
+    ) -> Dict[str, Any]:
+        """
+        int8 量化基准：对比 “量化编码筛选 + 浮点重新打分” 与浮点精确检索的
+        recall@k、p50/p95 延迟，以及常驻向量的内存占用 (查询取自索引中的随机向量，排除自身)。
+        """
+        snapshot = self.snapshot()
+        if snapshot is None or not snapshot.quantized:
+            raise ValueError(f"平铺索引 '{self.collection_name}' 未使用 int8 量化。")
+        rng = np.random.default_rng(seed)
+        query_rows = np.sort(
+            rng.choice(snapshot.count, size=min(n_queries, snapshot.count), replace=False)
+        )
+        queries = np.asarray(snapshot.float_vectors[query_rows], dtype=np.float32)
+
+        def run(exact: bool):
+            results, latencies = [], []
+            for query_row, query in zip(query_rows, queries):
+                start = time.perf_counter()
+                hits = snapshot.search(query, k + 1, nprobe=0, exact=exact)
+                latencies.append(time.perf_counter() - start)
+                results.append({row for row, _ in hits if row != query_row})
+            return results, latencies
+
+        exact, exact_latencies = run(True)
+        approx, approx_latencies = run(False)
+        recall = np.mean(
+            [len(a & e) / len(e) if e else 1.0 for a, e in zip(approx, exact)]
+        )
+        float_bytes = snapshot.count * snapshot.dim * 4
+        int8_bytes = snapshot.count * snapshot.dim
+        return {
+            "count": snapshot.count,
+            "dim": snapshot.dim,
+            "k": k,
+            "queries": len(queries),
+            "rescore_factor": SQ_RESCORE_FACTOR,
+            "recall_at_k": round(float(recall), 4),
+            "float32": {"vector_bytes": float_bytes, **_latency_summary(exact_latencies)},
+            "int8": {"vector_bytes": int8_bytes, **_latency_summary(approx_latencies)},
+            "memory_reduction": round(float_bytes / max(1, int8_bytes), 2),
+        }
+
+    def _select_relevance_score_fn(self) -> Callable[[float], float]:
+        # 分数已是余弦相似度
+        return lambda score: score
+
+    @classmethod
+    def from_texts(
+        cls,
+        texts: List[str],
+        embedding: Embeddings,
+        metadatas: Optional[List[dict]] = None,
+        *,
+        ids: Optional[List[str]] = None,
+        collection_name: str = "default",
+        persist_directory: Optional[str] = None,
+        dtype: str = FLAT_INDEX_DTYPE,
+        **kwargs: Any,
+    ) -> "FlatIndexStore":
+        store = cls(
+            collection_name, embedding, persist_directory=persist_directory, dtype=dtype
+        )
+        store.add_texts(texts, metadatas, ids=ids)
+        return store
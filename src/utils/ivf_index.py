@@ -0,0 +1,114 @@
+import logging
+import math
+import os
+from typing import Dict, Tuple
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# --- IVF (倒排文件) 近似索引配置 ---
+# 默认探查的倒排列表数 (未在请求或索引中指定时)
+IVF_DEFAULT_NPROBE = int(os.getenv("IVF_DEFAULT_NPROBE", 8))
+# k-means 迭代次数与训练采样行数 (大知识库只用采样训练聚类中心)
+IVF_KMEANS_ITERATIONS = int(os.getenv("IVF_KMEANS_ITERATIONS", 20))
+IVF_TRAIN_SAMPLE = int(os.getenv("IVF_TRAIN_SAMPLE", 100000))
+# 分块分配向量到最近中心时每块的行数
+IVF_ASSIGN_BLOCK_ROWS = int(os.getenv("IVF_ASSIGN_BLOCK_ROWS", 16384))
+
+IVF_CENTROIDS_FILE = "ivf_centroids"  # (L, d) 归一化聚类中心
+IVF_ASSIGN_FILE = "ivf_assign"  # (n,) 每行所属的倒排列表
+IVF_OFFSETS_FILE = "ivf_offsets"  # (L + 1,) 每个倒排列表在 ivf_rows 中的起止位置
+IVF_ROWS_FILE = "ivf_rows"  # (n,) 按倒排列表排列的行号
+
+
+def default_n_lists(count: int) -> int:
+    """默认倒排列表数：约 4 * sqrt(n)"""
+    return max(1, min(count, int(4 * math.sqrt(count))))
+
+
+def assign_lists(centroids: np.ndarray, vectors: np.ndarray) -> np.ndarray:
+    """将 (归一化) 向量分配到内积最大的聚类中心，分块计算以限制内存"""
+    assign = np.empty(len(vectors), dtype=np.int32)
+    for start in range(0, len(vectors), IVF_ASSIGN_BLOCK_ROWS):
+        block = np.asarray(
+            vectors[start : start + IVF_ASSIGN_BLOCK_ROWS], dtype=np.float32
+        )
+        assign[start : start + len(block)] = np.argmax(block @ centroids.T, axis=1)
+    return assign
+
+
+def train_kmeans(
+    vectors: np.ndarray,
+    n_lists: int,
+    iterations: int = IVF_KMEANS_ITERATIONS,
+    sample_size: int = IVF_TRAIN_SAMPLE,
+    seed: int = 0,
+) -> np.ndarray:
+    """
+    球面 k-means (向量已归一化，按内积聚类)，全部步骤为向量化 NumPy 运算。
+    返回 (n_lists, d) 的归一化聚类中心。
+    """
+    rng = np.random.default_rng(seed)
+    count = len(vectors)
+    n_lists = max(1, min(n_lists, count))
+    sample = np.sort(
+        rng.choice(count, size=min(count, max(sample_size, n_lists)), replace=False)
+    )
+    data = np.asarray(vectors[sample], dtype=np.float32)
+    centroids = data[rng.choice(len(data), size=n_lists, replace=False)].copy()
+
+    for _ in range(iterations):
+        assign = assign_lists(centroids, data)
+        order = np.argsort(assign, kind="stable")
+        counts = np.bincount(assign, minlength=n_lists)
+        nonempty = np.flatnonzero(counts)
+        starts = np.concatenate(([0], np.cumsum(counts)[:-1]))[nonempty]
+        sums = np.zeros_like(centroids)
+        sums[nonempty] = np.add.reduceat(data[order], starts, axis=0)
+        empty = counts == 0
+        if empty.any():
+            # 空簇用随机样本重新初始化
+            sums[empty] = data[rng.choice(len(data), size=int(empty.sum()))]
+        norms = np.linalg.norm(sums, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        centroids = sums / norms
+    return centroids
+
+
+def build_list_arrays(assign: np.ndarray, n_lists: int) -> Tuple[np.ndarray, np.ndarray]:
+    """由每行的列表分配生成 (offsets, rows)，每个列表内行号升序"""
+    rows = np.argsort(assign, kind="stable").astype(np.int64)
+    counts = np.bincount(assign, minlength=n_lists)
+    offsets = np.concatenate(([0], np.cumsum(counts))).astype(np.int64)
+    return offsets, rows
+
+
+def ivf_arrays(centroids: np.ndarray, assign: np.ndarray) -> Dict[str, np.ndarray]:
+    """生成写入索引版本目录的全部 IVF 数组"""
+    offsets, rows = build_list_arrays(assign, len(centroids))
+    return {
+        IVF_CENTROIDS_FILE: centroids.astype(np.float32),
+        IVF_ASSIGN_FILE: assign.astype(np.int32),
+        IVF_OFFSETS_FILE: offsets,
+        IVF_ROWS_FILE: rows,
+    }
+
+
+def nearest_lists(centroids: np.ndarray, query: np.ndarray, nprobe: int) -> np.ndarray:
+    """与查询最接近的 nprobe 个倒排列表"""
+    nprobe = min(nprobe, len(centroids))
+    centroid_scores = centroids @ query
+    return np.argpartition(-centroid_scores, nprobe - 1)[:nprobe]
+
+
+def probe_rows(
+    centroids: np.ndarray,
+    offsets: np.ndarray,
+    rows: np.ndarray,
+    query: np.ndarray,
+    nprobe: int,
+) -> np.ndarray:
+    """返回与查询最接近的 nprobe 个倒排列表中的全部行号"""
+    lists = nearest_lists(centroids, query, nprobe)
+    return np.concatenate([rows[offsets[l] : offsets[l + 1]] for l in lists])
@@ -1,13 +1,135 @@
+import hashlib
+import logging
 import os
+import threading
+from collections import OrderedDict
+from typing import Any, Optional, Tuple
 
+import httpx
+from langchain_core.language_models import BaseChatModel
+from langchain_core.runnables import Runnable
 from langchain_ollama import ChatOllama
 
 # llm
 from langchain_openai import ChatOpenAI
 from langchain_openai.chat_models.base import BaseChatOpenAI
 
+logger = logging.getLogger(__name__)
+
 ONEAPI_BASE_URL = os.getenv("ONEAPI_BASE_URL")
 
+# --- LLM 客户端注册表配置 ---
+LLM_CLIENT_CACHE_SIZE = int(os.getenv("LLM_CLIENT_CACHE_SIZE", 32))  # 最多缓存的客户端数
+LLM_HTTP_MAX_CONNECTIONS = int(os.getenv("LLM_HTTP_MAX_CONNECTIONS", 100))
+LLM_HTTP_MAX_KEEPALIVE = int(os.getenv("LLM_HTTP_MAX_KEEPALIVE", 20))
+LLM_HTTP_TIMEOUT = float(os.getenv("LLM_HTTP_TIMEOUT", 120))
+
+# 缓存键: (supplier, base_url, model, api_key 哈希) -> 客户端实例
+_llm_clients: "OrderedDict[Tuple[str, str, str, str], BaseChatModel]" = OrderedDict()
+_llm_clients_lock = threading.Lock()
+
+# 所有 OpenAI 兼容客户端共享的 httpx 连接池 (懒加载)
+_shared_http_client: Optional[httpx.Client] = None
+_shared_async_http_client: Optional[httpx.AsyncClient] = None
+
+
+def _hash_api_key(api_key: Optional[str]) -> str:
+    """对 API Key 取哈希，避免明文出现在缓存键和日志中"""
+    if not api_key:
+        return ""
+    return hashlib.sha256(api_key.encode("utf-8")).hexdigest()[:16]
+
+
+def _get_shared_http_clients() -> Tuple[httpx.Client, httpx.AsyncClient]:
+    """获取共享的同步/异步 httpx 客户端，使各模型实例复用同一个连接池"""
+    global _shared_http_client, _shared_async_http_client
+    limits = httpx.Limits(
+        max_connections=LLM_HTTP_MAX_CONNECTIONS,
+        max_keepalive_connections=LLM_HTTP_MAX_KEEPALIVE,
+    )
+    timeout = httpx.Timeout(LLM_HTTP_TIMEOUT, connect=10.0)
+    if _shared_http_client is None or _shared_http_client.is_closed:
+        _shared_http_client = httpx.Client(limits=limits, timeout=timeout)
+    if _shared_async_http_client is None or _shared_async_http_client.is_closed:
+        _shared_async_http_client = httpx.AsyncClient(limits=limits, timeout=timeout)
+    return _shared_http_client, _shared_async_http_client
+
+
+def _create_llm_client(
+    supplier: str, model: str, api_key: Optional[str]
+) -> BaseChatModel:
+    """创建新的 LLM 客户端实例 (仅在注册表未命中时调用)"""
+    if supplier == "openai":
+        http_client, http_async_client = _get_shared_http_clients()
+        return ChatOpenAI(
+            model=model,
+            http_client=http_client,
+            http_async_client=http_async_client,
+        )
+    elif supplier == "siliconflow":
+        http_client, http_async_client = _get_shared_http_clients()
+        return BaseChatOpenAI(
+            model=os.getenv("SILICONFLOW_MODEL"),  # 使用DeepSeek聊天模型
+            openai_api_key=os.getenv("SILICONFLOW_API_KEY"),
+            openai_api_base=os.getenv("SILICONFLOW_URL"),
+            # max_tokens=int(os.getenv("MAX_TOKENS")),
+            http_client=http_client,
+            http_async_client=http_async_client,
+        )
+    elif supplier == "ollama":
+        return ChatOllama(model=model)
+    elif supplier == "oneapi":
+        http_client, http_async_client = _get_shared_http_clients()
+        return ChatOpenAI(
+            api_key=api_key,
+            base_url=ONEAPI_BASE_URL,
+            model=model,
+            http_client=http_client,
+            http_async_client=http_async_client,
+        )
+    else:
+        raise ValueError(f"Unsupported supplier: {supplier}")
+
+
+def _get_base_url(supplier: str) -> str:
+    if supplier == "oneapi":
+        return ONEAPI_BASE_URL or ""
+    if supplier == "siliconflow":
+        return os.getenv("SILICONFLOW_URL", "")
+    return ""
+
+
+def get_llm_client(
+    supplier: str, model: str, api_key: Optional[str] = None
+) -> BaseChatModel:
+    """
+    从注册表获取 (或创建) 可复用的 LLM 客户端实例。
+    以 (supplier, base_url, model, api_key 哈希) 为键，LRU 淘汰超出上限的实例。
+    """
+    key = (supplier, _get_base_url(supplier), model, _hash_api_key(api_key))
+    with _llm_clients_lock:
+        client = _llm_clients.get(key)
+        if client is not None:
+            _llm_clients.move_to_end(key)
+            return client
+
+    client = _create_llm_client(supplier, model, api_key)
+    with _llm_clients_lock:
+        # 并发创建时以先写入的实例为准
+        existing = _llm_clients.get(key)
+        if existing is not None:
+            _llm_clients.move_to_end(key)
+            return existing
+        _llm_clients[key] = client
+        while len(_llm_clients) > LLM_CLIENT_CACHE_SIZE:
+            evicted_key, _ = _llm_clients.popitem(last=False)
+            # 共享连接池由注册表统一管理，淘汰实例时无需单独关闭
+            logger.debug(
+                f"LLM 客户端注册表已满，淘汰: supplier={evicted_key[0]}, model={evicted_key[2]}"
+            )
+    logger.info(f"创建并缓存 LLM 客户端: supplier={supplier}, model={model}")
+    return client
+
 
 def get_llms(
     supplier: str,
@@ -15,37 +137,44 @@ def get_llms(
     api_key: str = None,
     max_length: int = 10,
     temperature: float = 0.8,
-):
+) -> Runnable[Any, Any]:
     try:
         """
         获取LLM模型
+        客户端实例从注册表复用，temperature 等每次请求的参数通过 .bind 绑定。
         """
-        if supplier == "openai":
-            return ChatOpenAI(model=model, temperature=temperature)
-        elif supplier == "siliconflow":
-            return BaseChatOpenAI(
-                model=os.getenv("SILICONFLOW_MODEL"),  # 使用DeepSeek聊天模型
-                openai_api_key=os.getenv("SILICONFLOW_API_KEY"),
-                openai_api_base=os.getenv("SILICONFLOW_URL"),
-                # max_tokens=int(os.getenv("MAX_TOKENS")),
-            )
-
-        elif supplier == "ollama":
-            return ChatOllama(model=model)
-        elif supplier == "oneapi":
-            return ChatOpenAI(
-                api_key=api_key,
-                base_url=ONEAPI_BASE_URL,
-                model=model,
-                temperature=temperature,
-            )
-        else:
-            raise ValueError(f"Unsupported supplier: {supplier}")
+        client = get_llm_client(supplier=supplier, model=model, api_key=api_key)
+        if supplier in ("openai", "oneapi") and temperature is not None:
+            return client.bind(temperature=temperature)
+        return client
     except Exception as e:
         print(f"Error: {e}")
         raise ConnectionError(f"Error: {e}")
 
 
+async def close_llm_clients() -> None:
+    """
+    清空 LLM 客户端注册表并关闭共享的 HTTP 连接池。
+    应在 FastAPI 应用关闭时调用。
+    """
+    global _shared_http_client, _shared_async_http_client
+    with _llm_clients_lock:
+        _llm_clients.clear()
+    if _shared_async_http_client is not None:
+        try:
+            await _shared_async_http_client.aclose()
+        except Exception as e:
+            logger.error(f"关闭 LLM 异步 HTTP 客户端时出错: {e}")
+    if _shared_http_client is not None:
+        try:
+            _shared_http_client.close()
+        except Exception as e:
+            logger.error(f"关闭 LLM 同步 HTTP 客户端时出错: {e}")
+    _shared_http_client = None
+    _shared_async_http_client = None
+    logger.info("LLM 客户端注册表已清空，共享连接池已关闭。")
+
+
 if __name__ == "__main__":
     model = "deepseek-r1:latest"  # 使用DeepSeek聊天模型
     llm = get_llms(supplier="ollama", model=model, max_length=10086)
@@ -0,0 +1,190 @@
+import asyncio
+import logging
+import os
+import time
+from collections import OrderedDict, deque
+from typing import Any, Deque, Dict, Optional, Tuple
+
+from src.utils.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# --- 并发调度配置 ---
+# 每个 (supplier, model) 的默认并发上限
+LLM_CONCURRENCY_LIMIT = int(os.getenv("LLM_CONCURRENCY_LIMIT", 8))
+# 针对特定 supplier 或 supplier:model 的上限覆盖，例如 "oneapi=16,ollama:qwen2.5=2"
+LLM_CONCURRENCY_LIMITS = os.getenv("LLM_CONCURRENCY_LIMITS", "")
+# 最长排队等待时间 (秒)
+LLM_QUEUE_MAX_WAIT_SECONDS = float(os.getenv("LLM_QUEUE_MAX_WAIT_SECONDS", 30))
+# 排队期间向客户端汇报队列位置的间隔 (秒)
+LLM_QUEUE_REPORT_INTERVAL_SECONDS = float(
+    os.getenv("LLM_QUEUE_REPORT_INTERVAL_SECONDS", 1)
+)
+
+
+class QueueTimeoutError(Exception):
+    """排队等待超过最长等待时间"""
+
+
+def _parse_limit_overrides(raw: str) -> Dict[str, int]:
+    overrides: Dict[str, int] = {}
+    for item in raw.split(","):
+        if "=" not in item:
+            continue
+        name, value = item.rsplit("=", 1)
+        try:
+            overrides[name.strip()] = int(value)
+        except ValueError:
+            logger.warning(f"忽略无效的并发上限配置: {item}")
+    return overrides
+
+
+class SchedulerTicket:
+    """一次 LLM 调用的排队凭证"""
+
+    def __init__(self, lane: "_SupplierLane", user_key: str):
+        self.lane = lane
+        self.user_key = user_key
+        self.future: asyncio.Future = asyncio.get_running_loop().create_future()
+        self.enqueued_at = time.monotonic()
+        self.released = False
+
+    @property
+    def granted(self) -> bool:
+        return self.future.done()
+
+    def position(self) -> int:
+        """当前在公平队列中的位置 (1 表示下一个获得执行槽)，已获得时返回 0"""
+        if self.granted:
+            return 0
+        return self.lane.position_of(self)
+
+    async def wait(self, timeout: float) -> bool:
+        """等待获得执行槽，最多 timeout 秒；返回是否已获得"""
+        try:
+            await asyncio.wait_for(asyncio.shield(self.future), timeout=timeout)
+        except asyncio.TimeoutError:
+            pass
+        return self.granted
+
+    def release(self) -> None:
+        """释放执行槽 (或在未获得时退出队列)，可重复调用"""
+        if self.released:
+            return
+        self.released = True
+        self.lane.release(self)
+
+
+class _SupplierLane:
+    """单个 (supplier, model) 的并发槽与按用户轮转的公平队列"""
+
+    def __init__(self, name: str, limit: int):
+        self.name = name
+        self.limit = max(1, limit)
+        self.active = 0
+        # user_key -> 该用户的等待凭证队列；字典顺序即轮转顺序
+        self.waiters: "OrderedDict[str, Deque[SchedulerTicket]]" = OrderedDict()
+
+    def queued(self) -> int:
+        return sum(len(q) for q in self.waiters.values())
+
+    def submit(self, ticket: SchedulerTicket) -> None:
+        self.waiters.setdefault(ticket.user_key, deque()).append(ticket)
+        self._dispatch()
+
+    def position_of(self, ticket: SchedulerTicket) -> int:
+        user_queue = self.waiters.get(ticket.user_key)
+        if not user_queue or ticket not in user_queue:
+            return 0
+        depth = user_queue.index(ticket)
+        ahead = 0
+        before_me = True  # 轮转顺序中排在本用户之前的用户，本轮会先获得一次
+        for user_key, queue in self.waiters.items():
+            if user_key == ticket.user_key:
+                before_me = False
+                ahead += depth
+                continue
+            ahead += min(len(queue), depth + 1 if before_me else depth)
+        return ahead + 1
+
+    def _dispatch(self) -> None:
+        while self.active < self.limit and self.waiters:
+            user_key, queue = next(iter(self.waiters.items()))
+            ticket = queue.popleft()
+            if queue:
+                self.waiters.move_to_end(user_key)  # 轮到下一个用户
+            else:
+                del self.waiters[user_key]
+            if ticket.future.done():
+                continue
+            self.active += 1
+            ticket.future.set_result(True)
+            wait_seconds = time.monotonic() - ticket.enqueued_at
+            metrics.observe("llm_queue_wait_seconds", wait_seconds, lane=self.name)
+
+    def release(self, ticket: SchedulerTicket) -> None:
+        if ticket.granted and not ticket.future.cancelled():
+            self.active -= 1
+        else:
+            # 尚未获得执行槽：从队列中移除
+            queue = self.waiters.get(ticket.user_key)
+            if queue and ticket in queue:
+                queue.remove(ticket)
+                if not queue:
+                    del self.waiters[ticket.user_key]
+            if not ticket.future.done():
+                ticket.future.cancel()
+        self._dispatch()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "limit": self.limit,
+            "active": self.active,
+            "queued": self.queued(),
+            "queued_users": len(self.waiters),
+        }
+
+
+class LLMScheduler:
+    """
+    LLM 调用的准入控制：按 (supplier, model) 限制并发，
+    超出上限的请求进入按用户/会话轮转的公平队列。
+    """
+
+    def __init__(
+        self,
+        default_limit: int = LLM_CONCURRENCY_LIMIT,
+        limit_overrides: Optional[Dict[str, int]] = None,
+        max_wait_seconds: float = LLM_QUEUE_MAX_WAIT_SECONDS,
+    ):
+        self.default_limit = default_limit
+        self.limit_overrides = limit_overrides or {}
+        self.max_wait_seconds = max_wait_seconds
+        self._lanes: Dict[Tuple[str, str], _SupplierLane] = {}
+
+    def _limit_for(self, supplier: str, model: str) -> int:
+        return self.limit_overrides.get(
+            f"{supplier}:{model}",
+            self.limit_overrides.get(supplier, self.default_limit),
+        )
+
+    def submit(self, supplier: str, model: str, user_key: str) -> SchedulerTicket:
+        """提交一次调用请求，返回排队凭证 (可能已立即获得执行槽)"""
+        key = (supplier, model)
+        lane = self._lanes.get(key)
+        if lane is None:
+            lane = _SupplierLane(f"{supplier}:{model}", self._limit_for(supplier, model))
+            self._lanes[key] = lane
+        ticket = SchedulerTicket(lane, user_key or "")
+        lane.submit(ticket)
+        return ticket
+
+    def stats(self) -> Dict[str, Any]:
+        return {lane.name: lane.stats() for lane in self._lanes.values()}
+
+
+# 进程内全局调度器
+llm_scheduler = LLMScheduler(
+    limit_overrides=_parse_limit_overrides(LLM_CONCURRENCY_LIMITS)
+)
+metrics.register_provider("llm_scheduler", llm_scheduler.stats)
@@ -0,0 +1,73 @@
+import logging
+import threading
+from typing import Any, Callable, Dict
+
+logger = logging.getLogger(__name__)
+
+
+def _metric_key(name: str, labels: Dict[str, Any]) -> str:
+    """将指标名与标签拼接为 name{k="v",...} 形式的键"""
+    if not labels:
+        return name
+    label_str = ",".join(f'{k}="{v}"' for k, v in sorted(labels.items()))
+    return f"{name}{{{label_str}}}"
+
+
+class Metrics:
+    """
+    进程内的轻量指标注册表。
+    - counter: 单调递增计数 (incr)
+    - summary: 观测值的 count/sum/max (observe)，常用于耗时统计
+    - provider: 由各模块注册的统计函数 (如缓存命中率)，在 snapshot 时调用
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters: Dict[str, float] = {}
+        self._summaries: Dict[str, Dict[str, float]] = {}
+        self._providers: Dict[str, Callable[[], Dict[str, Any]]] = {}
+
+    def incr(self, name: str, value: float = 1, **labels: Any) -> None:
+        key = _metric_key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels: Any) -> None:
+        key = _metric_key(name, labels)
+        with self._lock:
+            summary = self._summaries.get(key)
+            if summary is None:
+                summary = {"count": 0, "sum": 0.0, "max": 0.0}
+                self._summaries[key] = summary
+            summary["count"] += 1
+            summary["sum"] += value
+            summary["max"] = max(summary["max"], value)
+
+    def register_provider(
+        self, name: str, provider: Callable[[], Dict[str, Any]]
+    ) -> None:
+        """注册一个统计函数，snapshot 时以 name 为键输出其返回值"""
+        with self._lock:
+            self._providers[name] = provider
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            counters = dict(self._counters)
+            summaries = {
+                k: {**v, "avg": v["sum"] / v["count"] if v["count"] else 0.0}
+                for k, v in self._summaries.items()
+            }
+            providers = dict(self._providers)
+
+        stats: Dict[str, Any] = {}
+        for name, provider in providers.items():
+            try:
+                stats[name] = provider()
+            except Exception as e:
+                logger.error(f"获取指标 {name} 时出错: {e}")
+                stats[name] = {"error": str(e)}
+        return {"counters": counters, "summaries": summaries, "stats": stats}
+
+
+# 进程内全局指标注册表
+metrics = Metrics()
@@ -6,6 +6,8 @@ from typing import Any, Dict, List, Optional
 import httpx
 from dotenv import load_dotenv
 
+from src.utils.resilience import CircuitOpenError, get_resilient_caller
+
 # 配置日志记录器
 logger = logging.getLogger(__name__)
 
@@ -37,6 +39,9 @@ async def call_siliconflow_rerank(
                                          如果 API 调用失败或返回非预期格式，则返回 None。
                                          每个字典形如: {'index': int, 'relevance_score': float}
                                          其中 'index' 是原始 documents 列表中的索引。
+
+    调用经过弹性包装 (按模型共享)：超过 p95 延迟时发送对冲请求，连续失败后熔断，
+    熔断期间直接返回 None，调用方使用向量检索顺序。
     """
     if not api_key:
         logger.error("SiliconFlow API key 未提供，无法调用 Rerank 服务。")
@@ -60,42 +65,12 @@ async def call_siliconflow_rerank(
         f"向 SiliconFlow Rerank API 发送请求: URL={SILICONFLOW_API_URL}, Model={model}, Query='{query[:50]}...', Docs Count={len(documents)}"
     )
 
+    caller = get_resilient_caller(f"rerank:siliconflow:{model}")
     try:
-        async with httpx.AsyncClient() as client:
-            response = await client.post(
-                SILICONFLOW_API_URL,
-                headers=headers,
-                json=payload,
-                timeout=30.0,  # 设置超时时间 (秒)
-            )
-
-            response.raise_for_status()  # 如果状态码不是 2xx，则抛出 HTTPStatusError
-
-            result = response.json()
-            logger.debug(f"收到 SiliconFlow Rerank API 响应: {result}")
-
-            # 验证响应结构并提取所需信息
-            if "results" in result and isinstance(result["results"], list):
-                ranked_results = []
-                for item in result["results"]:
-                    index = item.get("index")
-                    score = item.get("relevance_score")
-                    if index is not None and score is not None:
-                        ranked_results.append(
-                            {"index": index, "relevance_score": score}
-                        )
-                    else:
-                        logger.warning(
-                            f"SiliconFlow 响应中的项目缺少 index 或 relevance_score: {item}"
-                        )
-
-                # 根据 relevance_score 降序排序 (API 可能已经排序，但最好确认)
-                ranked_results.sort(key=lambda x: x["relevance_score"], reverse=True)
-                return ranked_results
-            else:
-                logger.error(f"SiliconFlow Rerank API 响应格式不符合预期: {result}")
-                return None
-
+        return await caller.call(lambda: _post_rerank(headers, payload))
+    except CircuitOpenError as e:
+        logger.warning(f"{e}，返回 None 以使用原始顺序。")
+        return None
     except httpx.HTTPStatusError as e:
         logger.error(
             f"调用 SiliconFlow Rerank API 时发生 HTTP 错误: {e.response.status_code} - {e.response.text}"
@@ -109,6 +84,43 @@ async def call_siliconflow_rerank(
         return None
 
 
+async def _post_rerank(
+    headers: Dict[str, str], payload: Dict[str, Any]
+) -> List[Dict[str, Any]]:
+    """发送一次 Rerank 请求；任何失败 (含响应格式不符) 都以异常抛出，供熔断器计数"""
+    async with httpx.AsyncClient() as client:
+        response = await client.post(
+            SILICONFLOW_API_URL,
+            headers=headers,
+            json=payload,
+            timeout=30.0,  # 设置超时时间 (秒)
+        )
+
+        response.raise_for_status()  # 如果状态码不是 2xx，则抛出 HTTPStatusError
+
+        result = response.json()
+        logger.debug(f"收到 SiliconFlow Rerank API 响应: {result}")
+
+        # 验证响应结构并提取所需信息
+        if "results" in result and isinstance(result["results"], list):
+            ranked_results = []
+            for item in result["results"]:
+                index = item.get("index")
+                score = item.get("relevance_score")
+                if index is not None and score is not None:
+                    ranked_results.append({"index": index, "relevance_score": score})
+                else:
+                    logger.warning(
+                        f"SiliconFlow 响应中的项目缺少 index 或 relevance_score: {item}"
+                    )
+
+            # 根据 relevance_score 降序排序 (API 可能已经排序，但最好确认)
+            ranked_results.sort(key=lambda x: x["relevance_score"], reverse=True)
+            return ranked_results
+        else:
+            raise ValueError(f"SiliconFlow Rerank API 响应格式不符合预期: {result}")
+
+
 # --- 测试代码 --- #
 
 
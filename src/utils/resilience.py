@@ -0,0 +1,341 @@
+import asyncio
+import concurrent.futures
+import logging
+import os
+import threading
+import time
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, Dict, Optional, TypeVar
+
+from src.utils.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+# --- 远程调用弹性配置 ---
+# 连续失败多少次后熔断
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv("CIRCUIT_FAILURE_THRESHOLD", 5))
+# 熔断后的冷却时间 (秒)，期满后放行一次试探请求 (半开)
+CIRCUIT_COOLDOWN_SECONDS = float(os.getenv("CIRCUIT_COOLDOWN_SECONDS", 30))
+# 是否启用对冲请求
+HEDGE_ENABLED = os.getenv("HEDGE_ENABLED", "true").lower() == "true"
+# 统计 p95 延迟所需的最少样本数，样本不足时不发送对冲请求
+HEDGE_MIN_SAMPLES = int(os.getenv("HEDGE_MIN_SAMPLES", 20))
+# 对冲延迟的下限 (秒)，避免延迟极低时几乎每次都发送重复请求
+HEDGE_MIN_DELAY_SECONDS = float(os.getenv("HEDGE_MIN_DELAY_SECONDS", 0.05))
+# 延迟统计的滑动窗口大小
+LATENCY_WINDOW_SIZE = int(os.getenv("LATENCY_WINDOW_SIZE", 200))
+
+# 同步调用 (如在线程池中执行的 embed_query) 的对冲请求所用线程池
+_hedge_executor = concurrent.futures.ThreadPoolExecutor(
+    max_workers=int(os.getenv("HEDGE_EXECUTOR_WORKERS", 8)),
+    thread_name_prefix="hedge",
+)
+
+
+class CircuitOpenError(Exception):
+    """熔断器处于打开状态，调用被直接拒绝"""
+
+
+def status_code_of(error: BaseException) -> Optional[int]:
+    """
+    异常携带的 HTTP 状态码：httpx.HTTPStatusError 为 error.response.status_code，
+    openai.APIStatusError 为 error.status_code；其他异常返回 None
+    """
+    status = getattr(error, "status_code", None)
+    if status is None:
+        status = getattr(getattr(error, "response", None), "status_code", None)
+    return status if isinstance(status, int) else None
+
+
+def is_upstream_failure(error: BaseException) -> bool:
+    """
+    是否为远程服务本身的故障 (计入熔断)：传输错误、超时、429 与 5xx。
+    其他 4xx (如 API Key 无效的 401/403、请求参数错误的 400) 由调用方的参数导致，
+    与共用同一熔断器的其他调用方无关，不计入熔断。
+    """
+    status = status_code_of(error)
+    if status is None:
+        return True
+    return not 400 <= status < 500 or status in (408, 429)
+
+
+class CircuitBreaker:
+    """
+    连续失败计数熔断器。
+    closed: 正常放行；连续失败达到阈值后转为 open。
+    open: 直接拒绝，冷却期满后转为 half_open。
+    half_open: 只放行一次试探请求，成功则关闭，失败则重新打开。
+    """
+
+    def __init__(
+        self,
+        failure_threshold: int = CIRCUIT_FAILURE_THRESHOLD,
+        cooldown_seconds: float = CIRCUIT_COOLDOWN_SECONDS,
+    ):
+        self.failure_threshold = max(1, failure_threshold)
+        self.cooldown_seconds = cooldown_seconds
+        self.state = "closed"
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self._probe_in_flight = False
+        self._lock = threading.Lock()
+
+    def admit(self) -> Optional[str]:
+        """放行时返回 "normal"，半开状态下放行的试探请求返回 "probe"，拒绝时返回 None"""
+        with self._lock:
+            if self.state == "closed":
+                return "normal"
+            if self.state == "open":
+                if time.monotonic() - self.opened_at < self.cooldown_seconds:
+                    return None
+                self.state = "half_open"
+                self._probe_in_flight = False
+            if self._probe_in_flight:
+                return None
+            self._probe_in_flight = True
+            return "probe"
+
+    def allow(self) -> bool:
+        return self.admit() is not None
+
+    def release_probe(self) -> None:
+        """试探请求没有结果就结束 (如被取消) 时释放试探名额，保持半开，下一次调用重新试探"""
+        with self._lock:
+            if self.state == "half_open":
+                self._probe_in_flight = False
+
+    def record_success(self) -> None:
+        with self._lock:
+            self.state = "closed"
+            self.consecutive_failures = 0
+            self._probe_in_flight = False
+
+    def record_failure(self) -> bool:
+        """记录一次失败，返回本次是否导致熔断器打开"""
+        with self._lock:
+            self.consecutive_failures += 1
+            self._probe_in_flight = False
+            if self.state == "half_open" or (
+                self.state == "closed"
+                and self.consecutive_failures >= self.failure_threshold
+            ):
+                self.state = "open"
+                self.opened_at = time.monotonic()
+                return True
+            return False
+
+
+class LatencyTracker:
+    """成功调用延迟的滑动窗口，用于估计 p95"""
+
+    def __init__(self, window_size: int = LATENCY_WINDOW_SIZE):
+        self._samples: Deque[float] = deque(maxlen=window_size)
+        self._lock = threading.Lock()
+
+    def add(self, seconds: float) -> None:
+        with self._lock:
+            self._samples.append(seconds)
+
+    def percentile(self, q: float, min_samples: int = 1) -> Optional[float]:
+        with self._lock:
+            if len(self._samples) < max(1, min_samples):
+                return None
+            ordered = sorted(self._samples)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+class ResilientCaller:
+    """
+    远程调用的弹性包装：超过观测到的 p95 延迟仍未返回时发送一次对冲请求，
+    取先成功的结果；连续失败后熔断，冷却期内直接抛出 CircuitOpenError，
+    由调用方走降级路径。只有远程服务本身的故障计入熔断 (见 is_upstream_failure)。
+    """
+
+    def __init__(
+        self,
+        name: str,
+        failure_threshold: int = CIRCUIT_FAILURE_THRESHOLD,
+        cooldown_seconds: float = CIRCUIT_COOLDOWN_SECONDS,
+        hedge_enabled: bool = HEDGE_ENABLED,
+    ):
+        self.name = name
+        self.breaker = CircuitBreaker(failure_threshold, cooldown_seconds)
+        self.latency = LatencyTracker()
+        self.hedge_enabled = hedge_enabled
+        self._lock = threading.Lock()
+        self.counters: Dict[str, int] = {
+            "calls": 0,
+            "successes": 0,
+            "failures": 0,
+            "short_circuits": 0,
+            "hedges": 0,
+            "hedge_wins": 0,
+            "circuit_opens": 0,
+            "caller_errors": 0,
+        }
+
+    def _count(self, name: str) -> None:
+        with self._lock:
+            self.counters[name] += 1
+        metrics.incr(f"resilience_{name}_total", target=self.name)
+
+    def _hedge_delay(self) -> Optional[float]:
+        if not self.hedge_enabled:
+            return None
+        p95 = self.latency.percentile(0.95, min_samples=HEDGE_MIN_SAMPLES)
+        return None if p95 is None else max(p95, HEDGE_MIN_DELAY_SECONDS)
+
+    def _before_call(self) -> bool:
+        """放行则返回本次调用是否为半开状态下的试探请求，熔断中抛出 CircuitOpenError"""
+        self._count("calls")
+        admission = self.breaker.admit()
+        if admission is None:
+            self._count("short_circuits")
+            raise CircuitOpenError(f"{self.name} 熔断中，跳过远程调用")
+        return admission == "probe"
+
+    def _on_success(self, started_at: float, hedge_won: bool) -> None:
+        self.latency.add(time.monotonic() - started_at)
+        self.breaker.record_success()
+        self._count("successes")
+        if hedge_won:
+            self._count("hedge_wins")
+
+    def _on_error(self, error: BaseException) -> bool:
+        """
+        记录一次失败的调用，返回是否计入了熔断器。
+        调用方错误 (见 is_upstream_failure) 既不算失败也不算成功，只单独计数。
+        """
+        if not is_upstream_failure(error):
+            self._count("caller_errors")
+            return False
+        self._on_failure(error)
+        return True
+
+    def _on_failure(self, error: BaseException) -> None:
+        self._count("failures")
+        if self.breaker.record_failure():
+            self._count("circuit_opens")
+            logger.warning(
+                f"{self.name} 连续失败 {self.breaker.consecutive_failures} 次，"
+                f"熔断 {self.breaker.cooldown_seconds} 秒: {error}"
+            )
+
+    async def call(self, fn: Callable[[], Awaitable[T]]) -> T:
+        """执行异步调用；fn 每次被调用都应发起一次独立的请求"""
+        is_probe = self._before_call()
+        settled = False  # 是否已在熔断器上记录成功或失败
+        started_at = time.monotonic()
+        tasks = set()
+        try:
+            primary = asyncio.ensure_future(fn())
+            tasks.add(primary)
+            delay = self._hedge_delay()
+            if delay is not None:
+                done, _ = await asyncio.wait(tasks, timeout=delay)
+                if not done:
+                    self._count("hedges")
+                    tasks.add(asyncio.ensure_future(fn()))
+
+            last_error: Optional[BaseException] = None
+            while tasks:
+                done, tasks = await asyncio.wait(
+                    tasks, return_when=asyncio.FIRST_COMPLETED
+                )
+                for task in done:
+                    if task.exception() is None:
+                        settled = True
+                        self._on_success(started_at, hedge_won=task is not primary)
+                        return task.result()
+                    last_error = task.exception()
+            settled = self._on_error(last_error)
+            raise last_error
+        finally:
+            for task in tasks:
+                task.cancel()
+            if is_probe and not settled:
+                # 试探请求被取消 (外层超时、客户端断开等)，不能让熔断器一直停在半开
+                self.breaker.release_probe()
+
+    def call_sync(self, fn: Callable[[], T]) -> T:
+        """执行同步调用；对冲请求在线程池中执行 (落后的请求无法中断，其结果被丢弃)"""
+        is_probe = self._before_call()
+        try:
+            return self._call_sync(fn)
+        except BaseException:
+            if is_probe:
+                # 已记录失败时熔断器已重新打开，release_probe 不改变状态；
+                # 未记录结果 (如 KeyboardInterrupt、调用方错误) 时释放试探名额
+                self.breaker.release_probe()
+            raise
+
+    def _call_sync(self, fn: Callable[[], T]) -> T:
+        started_at = time.monotonic()
+        delay = self._hedge_delay()
+        if delay is None:
+            try:
+                result = fn()
+            except Exception as e:
+                self._on_error(e)
+                raise
+            self._on_success(started_at, hedge_won=False)
+            return result
+
+        primary = _hedge_executor.submit(fn)
+        futures = {primary}
+        done, _ = concurrent.futures.wait(futures, timeout=delay)
+        if not done:
+            self._count("hedges")
+            futures.add(_hedge_executor.submit(fn))
+
+        last_error: Optional[BaseException] = None
+        while futures:
+            done, futures = concurrent.futures.wait(
+                futures, return_when=concurrent.futures.FIRST_COMPLETED
+            )
+            for future in done:
+                if future.exception() is None:
+                    self._on_success(started_at, hedge_won=future is not primary)
+                    return future.result()
+                last_error = future.exception()
+        self._on_error(last_error)
+        raise last_error
+
+    def stats(self) -> Dict[str, Any]:
+        p95 = self.latency.percentile(0.95)
+        with self._lock:
+            counters = dict(self.counters)
+        return {
+            "state": self.breaker.state,
+            "consecutive_failures": self.breaker.consecutive_failures,
+            "p95_seconds": round(p95, 4) if p95 is not None else None,
+            **counters,
+        }
+
+
+_callers: Dict[str, ResilientCaller] = {}
+_callers_lock = threading.Lock()
+
+
+def get_resilient_caller(name: str, hedge: bool = HEDGE_ENABLED) -> ResilientCaller:
+    """
+    获取 (或创建) 指定远程服务的弹性调用器，同名服务在进程内共享熔断与延迟统计。
+    hedge 只在第一次创建时生效；批量等耗时随负载变化大的调用应传 hedge=False。
+    """
+    with _callers_lock:
+        caller = _callers.get(name)
+        if caller is None:
+            caller = ResilientCaller(name, hedge_enabled=hedge)
+            _callers[name] = caller
+        return caller
+
+
+def resilience_stats() -> Dict[str, Any]:
+    with _callers_lock:
+        callers = list(_callers.values())
+    return {caller.name: caller.stats() for caller in callers}
+
+
+metrics.register_provider("resilience", resilience_stats)
@@ -0,0 +1,147 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+from datetime import timedelta
+from typing import Any, Dict, List, Optional, Sequence
+
+import redis.asyncio as aioredis
+from langchain_core.documents import Document
+
+from src.config.Redis import get_redis_client
+from src.utils.answer_cache import get_chunk_id
+from src.utils.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# --- 检索结果缓存相关常量 ---
+RETRIEVAL_CACHE_PREFIX = "retrieval:"  # 检索结果缓存键前缀
+RETRIEVAL_CACHE_TTL_SECONDS = int(
+    os.getenv("RETRIEVAL_CACHE_TTL_SECONDS", timedelta(hours=6).total_seconds())
+)
+# 随块 ID 一起缓存的分数字段 (向量相似度与重排序分数)
+SCORE_METADATA_KEYS = ("vector_score", "relevance_score")
+
+
+def build_retrieval_cache_key(
+    kb_id: str,
+    kb_version: int,
+    filter_by_file_md5: Optional[str],
+    question: str,
+    search_k: int,
+    config_signature: Sequence[Any],
+) -> str:
+    """
+    构造检索结果缓存键。知识库版本号包含在键中，文件增删后旧条目无需扫描即自然失效。
+    """
+    digest = hashlib.sha256(
+        "\x1f".join(
+            [
+                filter_by_file_md5 or "",
+                question,
+                str(search_k),
+                repr(tuple(config_signature)),
+            ]
+        ).encode("utf-8")
+    ).hexdigest()
+    return f"{RETRIEVAL_CACHE_PREFIX}{kb_id}:{kb_version}:{digest}"
+
+
+def _entries_of(docs: List[Document]) -> List[Dict[str, Any]]:
+    entries = []
+    for doc in docs:
+        metadata = doc.metadata or {}
+        entries.append(
+            {
+                "id": get_chunk_id(doc),
+                "scores": {
+                    k: metadata[k] for k in SCORE_METADATA_KEYS if k in metadata
+                },
+            }
+        )
+    return entries
+
+
+class RetrievalCache:
+    """
+    检索结果缓存：Redis 中只保存命中文档块的 ID 与分数，
+    命中时按 ID 从向量库取回文档内容，跳过向量检索与重排序。
+    """
+
+    def __init__(self, ttl_seconds: int = RETRIEVAL_CACHE_TTL_SECONDS):
+        self.ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0  # 缓存的块 ID 已无法从向量库取回
+
+    def _count(self, result: str) -> None:
+        with self._lock:
+            if result == "hit":
+                self.hits += 1
+            elif result == "stale":
+                self.stale += 1
+            else:
+                self.misses += 1
+        metrics.incr("retrieval_cache_requests_total", result=result)
+
+    async def get(
+        self, cache_key: str, knowledge: Any, kb_id: str
+    ) -> Optional[List[Document]]:
+        """读取缓存的检索结果并取回文档；未命中、Redis 不可用或块已被删除时返回 None"""
+        try:
+            redis = get_redis_client()
+            raw = await redis.get(cache_key)
+        except (RuntimeError, aioredis.RedisError) as e:
+            logger.warning(f"读取检索缓存失败，按未命中处理: {e}")
+            raw = None
+        if not raw:
+            self._count("miss")
+            return None
+
+        try:
+            entries = json.loads(raw)
+            docs = await knowledge.aget_documents_by_ids(
+                kb_id, [entry["id"] for entry in entries]
+            )
+        except Exception as e:
+            logger.warning(f"按缓存的块 ID 取回文档失败，按未命中处理: {e}")
+            docs = None
+        if docs is None or len(docs) != len(entries):
+            self._count("stale")
+            return None
+
+        for doc, entry in zip(docs, entries):
+            doc.metadata = {**(doc.metadata or {}), **entry.get("scores", {})}
+        self._count("hit")
+        return docs
+
+    async def set(self, cache_key: str, docs: List[Document]) -> None:
+        """写入检索结果 (块 ID 与分数)"""
+        try:
+            redis = get_redis_client()
+            await redis.set(
+                cache_key,
+                json.dumps(_entries_of(docs), ensure_ascii=False),
+                ex=self.ttl_seconds,
+            )
+            logger.debug(f"检索缓存已设置: {cache_key}")
+        except (RuntimeError, aioredis.RedisError) as e:
+            logger.warning(f"写入检索缓存失败: {e}")
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            total = self.hits + self.misses + self.stale
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "stale": self.stale,
+                "hit_rate": self.hits / total if total else 0.0,
+                "ttl_seconds": self.ttl_seconds,
+            }
+
+
+# 进程内全局检索结果缓存
+retrieval_cache = RetrievalCache()
+metrics.register_provider("retrieval_cache", retrieval_cache.stats)
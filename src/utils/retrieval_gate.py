@@ -0,0 +1,294 @@
+import logging
+import math
+import os
+import re
+import threading
+import time
+from collections import Counter, OrderedDict
+from typing import Any, Dict, Hashable, List, Optional, Tuple
+
+from langchain_core.documents import Document
+
+from src.utils.metrics import metrics
+from src.utils.single_flight import normalize_question
+
+logger = logging.getLogger(__name__)
+
+# --- 检索门控配置 ---
+RETRIEVAL_GATE_ENABLED = os.getenv("RETRIEVAL_GATE_ENABLED", "true").lower() == "true"
+# 分类器仅对不超过该长度的短消息生效，更长的消息一律检索
+GATE_CLASSIFIER_MAX_CHARS = int(os.getenv("GATE_CLASSIFIER_MAX_CHARS", 24))
+# 分类器判定为闲聊所需的最低后验概率
+GATE_CLASSIFIER_CONFIDENCE = float(os.getenv("GATE_CLASSIFIER_CONFIDENCE", 0.8))
+# 分类器判定为追问所需的最低后验概率 (误判会复用上一轮的旧上下文，因此要求更高)
+GATE_FOLLOWUP_CONFIDENCE = float(os.getenv("GATE_FOLLOWUP_CONFIDENCE", 0.95))
+# 上一轮检索上下文的保留时间 (秒) 与会话数上限
+GATE_CONTEXT_TTL_SECONDS = float(os.getenv("GATE_CONTEXT_TTL_SECONDS", 1800))
+GATE_CONTEXT_MAX_SESSIONS = int(os.getenv("GATE_CONTEXT_MAX_SESSIONS", 2048))
+
+SMALLTALK = "smalltalk"  # 寒暄、致谢等，无需知识库
+FOLLOWUP = "followup"  # 针对上一轮回答的改写/追问，复用上一轮的检索上下文
+QUESTION = "question"  # 需要检索的新问题
+
+# --- 规则 (高精度) ---
+_SMALLTALK_RULES = re.compile(
+    r"^(你好|您好|hi|hello|hey|嗨|哈喽|早上好|晚上好|下午好|在吗|在不在|"
+    r"谢谢|谢谢你|多谢|感谢|thanks|thank you|thx|好的|好|ok|okay|嗯|嗯嗯|"
+    r"收到|明白|明白了|知道了|懂了|再见|拜拜|bye|goodbye|👍|不错|很好|太棒了)"
+    r"[呀啊哦哈吧啦了!！~～。.，, ]*$"
+)
+# 消息开头的寒暄/致谢 (后面还有内容时，后面的内容才是真正的消息)
+_GREETING_PREFIX = re.compile(
+    r"^(你好|您好|hi|hello|hey|嗨|哈喽|早上好|晚上好|下午好|"
+    r"谢谢|谢谢你|多谢|感谢|thanks|thank you|thx|好的|ok|okay|嗯|嗯嗯|"
+    r"收到|明白|明白了|知道了|懂了)[呀啊哦哈吧啦了]*[!！~～。.，,、 ]+"
+)
+# 追问规则匹配整条消息：只有不带自身对象的改写/追问指令才复用上一轮上下文
+_FOLLOWUP_RULES = re.compile(
+    r"^(?:"
+    r"(能|可以)?(请)?(再|更)?(简短|简洁|精简|短|详细|具体|通俗|简单)(一)?(点|些)|"
+    r"(请)?(换|用)(个|一个|一种)?(说法|方式|语气)(说|讲)?(一下|一遍)?|"
+    r"(请)?(总结|概括|归纳)(一下)?((上面|以上|刚才)(的)?(内容|回答)?)?|"
+    r"(请)?(翻译|译)(成|为)(中文|英文|英语|日文|日语|韩文|韩语|法语|德语)|"
+    r"继续|接着说|还有呢|还有吗|然后呢|展开说说|展开讲讲|(举个|举一个)例子|"
+    r"(请)?(用|以)(表格|列表|要点)(的)?(形式)?(列出|列出来|展示|说明|回答)?|分点说明|"
+    r"(make it|be) (shorter|longer|simpler|more concise)|"
+    r"(rephrase|summarize|translate|continue|go on|elaborate)( it| that| this)?|"
+    r"explain (it|that) (again|simpler)"
+    r")[呀啊哦哈吧啦了吗呢!！~～。.，, ]*$"
+)
+# 改写/总结/翻译类指令：未整条匹配追问规则说明指令带有自己的对象 (如 “总结一下这份文件”)
+_INSTRUCTION_PREFIX = re.compile(
+    r"^(请)?(帮我)?(总结|概括|归纳|翻译|改写|summarize|summarise|translate|rephrase)"
+)
+
+# --- 本地小型分类器的种子样本 ---
+_SEED_EXAMPLES: Dict[str, List[str]] = {
+    SMALLTALK: [
+        "你好", "你好啊", "您好", "早上好", "在吗", "谢谢", "谢谢你的帮助", "非常感谢",
+        "好的谢谢", "辛苦了", "你真棒", "不错不错", "哈哈", "再见", "晚安", "你是谁",
+        "你叫什么名字", "hi there", "hello", "thanks a lot", "good job", "bye",
+        "ok thanks", "nice",
+    ],
+    FOLLOWUP: [
+        "简短一点", "说得简单点", "再详细一些", "能再具体点吗", "换个说法", "总结一下",
+        "概括一下上面的内容", "翻译成英文", "翻译成中文", "继续", "接着说", "还有吗",
+        "举个例子", "用表格列出来", "分点说明", "说得通俗一点", "为什么这么说",
+        "上面说的什么意思", "make it shorter", "rephrase that", "summarize it",
+        "continue", "more details please", "explain again",
+    ],
+    QUESTION: [
+        "报销流程是什么", "年假有几天", "如何申请加班", "合同到期怎么办", "公司地址在哪",
+        "请假需要哪些材料", "绩效考核标准", "入职需要准备什么", "差旅费标准是多少",
+        "这个产品的价格", "系统怎么登录", "密码忘了怎么办", "文件里提到的截止日期",
+        "项目负责人是谁", "培训安排", "社保缴纳比例", "what is the refund policy",
+        "how do i reset my password", "who approves expenses", "deadline for submission",
+        "介绍一下公司", "介绍一下这个产品", "说一下请假流程", "查一下发票要求",
+        "解释一下这个条款", "讲一下安全规范", "产品a的功能",
+    ],
+}
+
+
+def _features(text: str) -> List[str]:
+    """字符 unigram + bigram 特征 (中英文均无需分词)"""
+    chars = [c for c in text if not c.isspace()]
+    return chars + [a + b for a, b in zip(chars, chars[1:])]
+
+
+class _NaiveBayes:
+    """多项式朴素贝叶斯 (加一平滑)，在种子样本上于导入时训练，完全本地运行"""
+
+    def __init__(self, examples: Dict[str, List[str]]):
+        self.labels = list(examples)
+        self.counts: Dict[str, Counter] = {}
+        self.totals: Dict[str, int] = {}
+        vocab = set()
+        total_docs = sum(len(v) for v in examples.values())
+        self.priors = {}
+        for label, texts in examples.items():
+            counter: Counter = Counter()
+            for text in texts:
+                counter.update(_features(normalize_question(text)))
+            self.counts[label] = counter
+            self.totals[label] = sum(counter.values())
+            self.priors[label] = math.log(len(texts) / total_docs)
+            vocab.update(counter)
+        self.vocab_size = len(vocab)
+
+    def predict(self, text: str) -> Tuple[str, float]:
+        """返回 (最可能的类别, 后验概率)"""
+        features = _features(text)
+        scores = {}
+        for label in self.labels:
+            denominator = self.totals[label] + self.vocab_size
+            counter = self.counts[label]
+            scores[label] = self.priors[label] + sum(
+                math.log((counter[f] + 1) / denominator) for f in features
+            )
+        best = max(scores, key=scores.get)
+        norm = sum(math.exp(s - scores[best]) for s in scores.values())
+        return best, 1.0 / norm
+
+
+class GateDecision:
+    """门控结果：action 为 retrieve / skip / reuse；reuse 时 docs 为上一轮的检索上下文"""
+
+    def __init__(
+        self,
+        action: str,
+        intent: str,
+        reason: str,
+        docs: Optional[List[Document]] = None,
+    ):
+        self.action = action
+        self.intent = intent
+        self.reason = reason
+        self.docs = docs
+
+
+class RetrievalGate:
+    """
+    检索门控：在检索之前用规则 + 本地小型分类器判断消息意图 (无网络调用)。
+    - 闲聊 (smalltalk): 跳过检索，使用普通对话链；
+    - 追问 (followup): 同一会话存在上一轮的检索上下文时复用，否则正常检索；
+    - 其他: 正常检索。
+    保存的检索上下文记录知识库版本号，版本变化 (其他 worker 进程增删了文件) 后不再复用；
+    本进程内的变更由 invalidate_kb 立即清除。
+    """
+
+    def __init__(self, enabled: bool = RETRIEVAL_GATE_ENABLED):
+        self.enabled = enabled
+        self._classifier = _NaiveBayes(_SEED_EXAMPLES)
+        # 上下文键 -> (保存时间, 知识库版本号, 检索上下文)；键的第二个元素为知识库 ID
+        self._contexts: "OrderedDict[Hashable, Tuple[float, Optional[int], List[Document]]]" = (
+            OrderedDict()
+        )
+        self._lock = threading.Lock()
+        self._avg_retrieval_seconds: Optional[float] = None  # 检索耗时的指数滑动平均
+        self.counts: Counter = Counter()
+        self.latency_saved = 0.0
+
+    def classify(self, question: str) -> Tuple[str, str]:
+        """返回 (意图, 判定依据)"""
+        if not self.enabled:
+            return QUESTION, "disabled"
+        text = normalize_question(question)
+        if not text:
+            return SMALLTALK, "empty"
+        greeting = _GREETING_PREFIX.match(text)
+        if greeting and greeting.end() < len(text):
+            # “谢谢，那年假呢”：寒暄后面的内容决定意图，分类器不能整体判为闲聊
+            intent, reason = self._classify_content(
+                text[greeting.end() :], allow_smalltalk_classifier=False
+            )
+            return intent, f"{reason}:after_greeting"
+        return self._classify_content(text)
+
+    def _classify_content(
+        self, text: str, allow_smalltalk_classifier: bool = True
+    ) -> Tuple[str, str]:
+        if _SMALLTALK_RULES.match(text):
+            return SMALLTALK, "rule"
+        if _FOLLOWUP_RULES.match(text):
+            return FOLLOWUP, "rule"
+        if _INSTRUCTION_PREFIX.match(text):
+            return QUESTION, "rule:explicit_subject"
+        if len(text) <= GATE_CLASSIFIER_MAX_CHARS:
+            label, probability = self._classifier.predict(text)
+            if label == SMALLTALK and allow_smalltalk_classifier:
+                threshold = GATE_CLASSIFIER_CONFIDENCE
+            elif label == FOLLOWUP:
+                threshold = GATE_FOLLOWUP_CONFIDENCE
+            else:
+                threshold = None
+            if threshold is not None and probability >= threshold:
+                return label, f"classifier:{probability:.2f}"
+        return QUESTION, "default"
+
+    def decide(
+        self, question: str, context_key: Hashable, kb_version: Optional[int] = None
+    ) -> GateDecision:
+        intent, reason = self.classify(question)
+        if intent == SMALLTALK:
+            decision = GateDecision("skip", intent, reason)
+        elif intent == FOLLOWUP:
+            docs = self._get_context(context_key, kb_version)
+            if docs is not None:
+                decision = GateDecision("reuse", intent, reason, docs)
+            else:
+                decision = GateDecision("retrieve", intent, f"{reason}:no_context")
+        else:
+            decision = GateDecision("retrieve", intent, reason)
+
+        with self._lock:
+            self.counts[decision.action] += 1
+            if decision.action != "retrieve" and self._avg_retrieval_seconds:
+                self.latency_saved += self._avg_retrieval_seconds
+        metrics.incr("retrieval_gate_decisions_total", action=decision.action)
+        if decision.action != "retrieve":
+            logger.info(
+                f"检索门控: {decision.action} (意图: {intent}, 依据: {decision.reason})"
+            )
+        return decision
+
+    def record_retrieval(self, seconds: float) -> None:
+        """记录一次实际检索的耗时，用于估算跳过检索节省的时间"""
+        with self._lock:
+            if self._avg_retrieval_seconds is None:
+                self._avg_retrieval_seconds = seconds
+            else:
+                self._avg_retrieval_seconds = (
+                    0.9 * self._avg_retrieval_seconds + 0.1 * seconds
+                )
+
+    def remember(
+        self,
+        context_key: Hashable,
+        docs: List[Document],
+        kb_version: Optional[int] = None,
+    ) -> None:
+        """保存本轮的检索上下文 (及检索时的知识库版本号)，供同一会话的后续追问复用"""
+        with self._lock:
+            self._contexts[context_key] = (time.monotonic(), kb_version, docs)
+            self._contexts.move_to_end(context_key)
+            while len(self._contexts) > GATE_CONTEXT_MAX_SESSIONS:
+                self._contexts.popitem(last=False)
+
+    def _get_context(
+        self, context_key: Hashable, kb_version: Optional[int]
+    ) -> Optional[List[Document]]:
+        with self._lock:
+            entry = self._contexts.get(context_key)
+            if entry is None:
+                return None
+            saved_at, saved_version, docs = entry
+            if (
+                time.monotonic() - saved_at > GATE_CONTEXT_TTL_SECONDS
+                or saved_version != kb_version
+            ):
+                del self._contexts[context_key]
+                return None
+            return docs
+
+    def invalidate_kb(self, kb_id: str) -> None:
+        """清除指定知识库的全部检索上下文 (知识库内容变更后调用)"""
+        with self._lock:
+            for key in [k for k in self._contexts if k[1] == str(kb_id)]:
+                del self._contexts[key]
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "enabled": self.enabled,
+                "retrieved": self.counts["retrieve"],
+                "skipped": self.counts["skip"],
+                "reused": self.counts["reuse"],
+                "avg_retrieval_seconds": round(self._avg_retrieval_seconds or 0.0, 4),
+                "estimated_latency_saved_seconds": round(self.latency_saved, 3),
+                "remembered_sessions": len(self._contexts),
+            }
+
+
+# 进程内全局检索门控
+retrieval_gate = RetrievalGate()
+metrics.register_provider("retrieval_gate", retrieval_gate.stats)
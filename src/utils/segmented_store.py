@@ -0,0 +1,334 @@
+import heapq
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+import uuid
+from typing import Any, Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+from langchain_chroma import Chroma
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.vectorstores import VectorStore
+
+from src.utils.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# --- 分段存储 (Chroma 后端的快照隔离) 配置 ---
+segment_dir = os.getenv("SEGMENT_DIR", "segments/")  # 分段知识库的根目录
+# 已发布分段数超过该值时，写入完成后把全部分段合并为一个
+SEGMENT_COMPACT_THRESHOLD = int(os.getenv("SEGMENT_COMPACT_THRESHOLD", 8))
+# 被合并/替换的分段目录保留的时间 (秒)，让仍在使用旧清单的读请求完成
+SEGMENT_GC_GRACE_SECONDS = int(os.getenv("SEGMENT_GC_GRACE_SECONDS", 300))
+SEGMENT_COMPACT_BATCH_SIZE = 1000
+
+CURRENT_FILE = "CURRENT"  # 记录当前已发布清单文件名的指针文件
+
+# 每个分段知识库一把发布锁，保证清单的读-改-写不交错
+_publish_locks: Dict[str, threading.Lock] = {}
+_publish_locks_guard = threading.Lock()
+
+
+def _publish_lock(root: str) -> threading.Lock:
+    with _publish_locks_guard:
+        return _publish_locks.setdefault(root, threading.Lock())
+
+
+def _read_current(root: str) -> Optional[str]:
+    try:
+        with open(os.path.join(root, CURRENT_FILE), "r", encoding="utf-8") as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+
+class SegmentedChromaStore(VectorStore):
+    """
+    分段 Chroma 存储：知识库由若干个只追加的分段组成，每个分段是一个独立的
+    Chroma 持久化目录 (独立的 sqlite 文件)。
+    - 写入总是在新分段中完成，写完后原子发布新的清单 (CURRENT 指针)，
+      读请求只看到已发布清单中的完整分段，不会读到写了一半的数据，也不与写入争用同一 sqlite 锁；
+    - 按文件删除先发布墓碑 (检索时排除这些文件)，再逐个分段物理删除，最后撤销墓碑，
+      对读请求而言删除是原子的；
+    - 分段数超过 SEGMENT_COMPACT_THRESHOLD 时合并为一个新分段 (复用已存储的向量)，
+      旧分段在宽限期后删除。
+    旧版本直接位于 chroma/<kb_id> 的集合在首次写入时作为基础分段纳入。
+    相似度 (relevance score) 由各分段的 Chroma 距离换算后合并。
+    """
+
+    def __init__(self, collection_name: str, embedding_function: Embeddings):
+        self.collection_name = collection_name
+        self._embedding_function = embedding_function
+        self.root = os.path.join(segment_dir, collection_name)
+        self._manifest_name: Optional[str] = None
+        self._manifest: Dict[str, Any] = {}
+        self._segments: Dict[str, Chroma] = {}  # 分段目录 -> 已打开的 Chroma 实例
+        self._lock = threading.Lock()
+
+    # --- 布局 ---
+    @staticmethod
+    def exists(collection_name: str) -> bool:
+        return _read_current(os.path.join(segment_dir, collection_name)) is not None
+
+    @staticmethod
+    def destroy(collection_name: str) -> None:
+        root = os.path.join(segment_dir, collection_name)
+        if os.path.isdir(root):
+            shutil.rmtree(root)
+
+    @classmethod
+    def create(
+        cls,
+        collection_name: str,
+        embedding_function: Embeddings,
+        base_directory: Optional[str] = None,
+    ) -> "SegmentedChromaStore":
+        """创建分段布局；base_directory 为已有的 Chroma 持久化目录时将其作为第一个分段"""
+        store = cls(collection_name, embedding_function)
+        os.makedirs(store.root, exist_ok=True)
+        segments = [base_directory] if base_directory else []
+        store._publish({"segments": segments, "tombstones": [], "retired": []})
+        return store
+
+    @property
+    def embeddings(self) -> Embeddings:
+        return self._embedding_function
+
+    def manifest(self) -> Dict[str, Any]:
+        """当前已发布的清单 (指针未变化时复用已解析的清单)"""
+        name = _read_current(self.root)
+        if name is None:
+            raise FileNotFoundError(f"分段知识库 '{self.collection_name}' 不存在。")
+        with self._lock:
+            if name != self._manifest_name:
+                with open(os.path.join(self.root, name), "r", encoding="utf-8") as f:
+                    self._manifest = json.load(f)
+                self._manifest_name = name
+                live = set(self._manifest["segments"])
+                self._segments = {
+                    path: store for path, store in self._segments.items() if path in live
+                }
+            return self._manifest
+
+    def _segment(self, path: str) -> Chroma:
+        store = self._segments.get(path)
+        if store is None:
+            store = Chroma(
+                collection_name=self.collection_name,
+                persist_directory=path,
+                embedding_function=self._embedding_function,
+            )
+            self._segments[path] = store
+        return store
+
+    def segment_stores(self) -> List[Chroma]:
+        """当前已发布的全部分段"""
+        return [self._segment(path) for path in self.manifest()["segments"]]
+
+    def _publish(self, manifest: Dict[str, Any]) -> None:
+        """写入新清单并原子替换 CURRENT 指针，保留上一份清单供刚读到旧指针的读请求使用"""
+        previous = _read_current(self.root)
+        name = f"manifest-{int(time.time() * 1000)}-{uuid.uuid4().hex[:6]}.json"
+        with open(os.path.join(self.root, name), "w", encoding="utf-8") as f:
+            json.dump(manifest, f)
+        tmp_pointer = os.path.join(self.root, f"{CURRENT_FILE}.{name}.tmp")
+        with open(tmp_pointer, "w", encoding="utf-8") as f:
+            f.write(name)
+        os.replace(tmp_pointer, os.path.join(self.root, CURRENT_FILE))
+        for old in os.listdir(self.root):
+            if old.startswith("manifest-") and old not in (name, previous):
+                os.remove(os.path.join(self.root, old))
+
+    def _update_manifest(self, change: Callable[[Dict[str, Any]], None]) -> None:
+        with _publish_lock(self.root):
+            manifest = json.loads(json.dumps(self.manifest()))
+            change(manifest)
+            # 清理宽限期已过的旧分段
+            now = time.time()
+            expired = [
+                entry
+                for entry in manifest["retired"]
+                if now - entry["at"] >= SEGMENT_GC_GRACE_SECONDS
+            ]
+            manifest["retired"] = [e for e in manifest["retired"] if e not in expired]
+            self._publish(manifest)
+        for entry in expired:
+            shutil.rmtree(entry["path"], ignore_errors=True)
+
+    def _new_segment_path(self) -> str:
+        return os.path.join(
+            self.root, f"seg-{int(time.time() * 1000)}-{uuid.uuid4().hex[:6]}"
+        )
+
+    # --- 写入 ---
+    def add_texts(
+        self,
+        texts: Iterable[str],
+        metadatas: Optional[List[dict]] = None,
+        *,
+        ids: Optional[List[str]] = None,
+        **kwargs: Any,
+    ) -> List[str]:
+        """写入一个新分段，写完后原子发布"""
+        texts = list(texts)
+        if not texts:
+            return []
+        ids = [doc_id or str(uuid.uuid4()) for doc_id in (ids or [None] * len(texts))]
+        path = self._new_segment_path()
+        started_at = time.perf_counter()
+        Chroma.from_texts(
+            texts=texts,
+            embedding=self._embedding_function,
+            metadatas=metadatas,
+            ids=ids,
+            collection_name=self.collection_name,
+            persist_directory=path,
+        )
+        self._update_manifest(lambda m: m["segments"].append(path))
+        metrics.observe("segment_write_seconds", time.perf_counter() - started_at)
+        logger.info(
+            f"分段知识库 '{self.collection_name}' 发布新分段 {os.path.basename(path)} ({len(ids)} 块)。"
+        )
+        if len(self.manifest()["segments"]) > SEGMENT_COMPACT_THRESHOLD:
+            self.compact()
+        return ids
+
+    def delete(
+        self, ids: Optional[List[str]] = None, where: Optional[dict] = None, **kwargs: Any
+    ) -> Optional[bool]:
+        """按 ID 或过滤条件删除；按文件删除期间以墓碑对读请求原子地隐藏该文件"""
+        file_md5 = (where or {}).get("source_file_md5")
+        tombstone = file_md5 if isinstance(file_md5, str) else None
+        if tombstone:
+            self._update_manifest(lambda m: m["tombstones"].append(tombstone))
+        try:
+            for store in self.segment_stores():
+                if ids:
+                    store.delete(ids=ids)
+                if where:
+                    store.delete(where=where)
+        finally:
+            if tombstone:
+                self._update_manifest(lambda m: m["tombstones"].remove(tombstone))
+        return True
+
+    def compact(self) -> Dict[str, Any]:
+        """把全部已发布分段合并为一个新分段 (复用已存储的向量)，旧分段在宽限期后删除"""
+        started_at = time.perf_counter()
+        old_segments = list(self.manifest()["segments"])
+        path = self._new_segment_path()
+        target = Chroma(
+            collection_name=self.collection_name,
+            persist_directory=path,
+            embedding_function=self._embedding_function,
+        )
+        rows = 0
+        for store in self.segment_stores():
+            offset = 0
+            while True:
+                result = store.get(
+                    limit=SEGMENT_COMPACT_BATCH_SIZE,
+                    offset=offset,
+                    include=["documents", "metadatas", "embeddings"],
+                )
+                if not result["ids"]:
+                    break
+                target._collection.upsert(
+                    ids=list(result["ids"]),
+                    embeddings=[list(map(float, e)) for e in result["embeddings"]],
+                    metadatas=[m or {} for m in result["metadatas"]],
+                    documents=list(result["documents"]),
+                )
+                offset += len(result["ids"])
+                rows += len(result["ids"])
+
+        def swap(manifest: Dict[str, Any]) -> None:
+            # 合并期间不会有其他写入 (写入经知识库写入队列串行执行)，这里仍只替换被合并的分段
+            now = time.time()
+            manifest["segments"] = [path] + [
+                s for s in manifest["segments"] if s not in old_segments
+            ]
+            manifest["retired"].extend({"path": s, "at": now} for s in old_segments)
+
+        self._update_manifest(swap)
+        elapsed = time.perf_counter() - started_at
+        metrics.observe("segment_compact_seconds", elapsed)
+        logger.info(
+            f"分段知识库 '{self.collection_name}' 合并 {len(old_segments)} 个分段 ({rows} 块)，耗时 {elapsed:.2f}s。"
+        )
+        return {"segments": len(old_segments), "rows": rows, "seconds": round(elapsed, 3)}
+
+    # --- 读取 ---
+    def _visible_filter(self, filter: Optional[dict]) -> Optional[dict]:
+        tombstones = self.manifest()["tombstones"]
+        if not tombstones:
+            return filter
+        exclusion = {"source_file_md5": {"$nin": list(tombstones)}}
+        return {"$and": [filter, exclusion]} if filter else exclusion
+
+    def get_by_ids(self, ids: Sequence[str], /) -> List[Document]:
+        hidden = set(self.manifest()["tombstones"])
+        docs = [doc for store in self.segment_stores() for doc in store.get_by_ids(ids)]
+        return [
+            doc for doc in docs if (doc.metadata or {}).get("source_file_md5") not in hidden
+        ]
+
+    def similarity_search_by_vector_with_score(
+        self,
+        embedding: List[float],
+        k: int = 4,
+        filter: Optional[dict] = None,
+        **kwargs: Any,
+    ) -> List[Tuple[Document, float]]:
+        """在已发布的各分段中检索后合并 top-k，分数为相关度"""
+        filter = self._visible_filter(filter)
+        search_kwargs: Dict[str, Any] = {"k": k}
+        if filter:
+            search_kwargs["filter"] = filter
+        results = []
+        for store in self.segment_stores():
+            relevance_fn = store._select_relevance_score_fn()
+            results.extend(
+                (doc, float(relevance_fn(distance)))
+                for doc, distance in store.similarity_search_by_vector_with_relevance_scores(
+                    embedding, **search_kwargs
+                )
+            )
+        return heapq.nlargest(k, results, key=lambda pair: pair[1])
+
+    def similarity_search_with_score(
+        self,
+        query: str,
+        k: int = 4,
+        filter: Optional[dict] = None,
+        **kwargs: Any,
+    ) -> List[Tuple[Document, float]]:
+        embedding = self._embedding_function.embed_query(query)
+        return self.similarity_search_by_vector_with_score(embedding, k, filter)
+
+    def similarity_search(
+        self, query: str, k: int = 4, filter: Optional[dict] = None, **kwargs: Any
+    ) -> List[Document]:
+        return [doc for doc, _ in self.similarity_search_with_score(query, k, filter)]
+
+    def _select_relevance_score_fn(self) -> Callable[[float], float]:
+        # 合并时已统一为相关度
+        return lambda score: score
+
+    @classmethod
+    def from_texts(
+        cls,
+        texts: List[str],
+        embedding: Embeddings,
+        metadatas: Optional[List[dict]] = None,
+        *,
+        ids: Optional[List[str]] = None,
+        collection_name: str = "default",
+        **kwargs: Any,
+    ) -> "SegmentedChromaStore":
+        store = cls.create(collection_name, embedding)
+        store.add_texts(texts, metadatas, ids=ids)
+        return store
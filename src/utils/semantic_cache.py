@@ -0,0 +1,200 @@
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, List, Optional, Sequence
+
+import numpy as np
+
+from src.utils.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# --- 语义缓存配置 ---
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", 0.92))
+SEMANTIC_CACHE_MAX_ENTRIES = int(os.getenv("SEMANTIC_CACHE_MAX_ENTRIES", 512))
+SEMANTIC_CACHE_TTL_SECONDS = float(os.getenv("SEMANTIC_CACHE_TTL_SECONDS", 3600))
+# 分区数上限 (每个分区最多 SEMANTIC_CACHE_MAX_ENTRIES 条)，超出时淘汰最久未使用的分区
+SEMANTIC_CACHE_MAX_PARTITIONS = int(os.getenv("SEMANTIC_CACHE_MAX_PARTITIONS", 256))
+
+
+class SemanticCacheHit:
+    """语义缓存命中结果"""
+
+    def __init__(
+        self,
+        answer: str,
+        chunk_ids: List[str],
+        similarity: float,
+        latency_saved: float,
+    ):
+        self.answer = answer
+        self.chunk_ids = chunk_ids
+        self.similarity = similarity
+        self.latency_saved = latency_saved  # 原始生成耗时，即本次命中节省的时间
+
+
+class _Partition:
+    """单个分区 (知识库及影响回答的全部请求参数，见 ChatSev) 内的缓存条目"""
+
+    def __init__(self, kb_version: int):
+        self.kb_version = kb_version
+        self.vectors: Optional[np.ndarray] = None  # (n, d) 归一化的查询向量
+        self.answers: List[str] = []
+        self.chunk_ids: List[List[str]] = []
+        self.latencies: List[float] = []
+        self.created_at: List[float] = []
+        self.last_used: List[float] = []
+
+    def __len__(self) -> int:
+        return len(self.answers)
+
+    def remove(self, indices: Sequence[int]) -> None:
+        if not indices:
+            return
+        removed = set(indices)
+        keep = [i for i in range(len(self)) if i not in removed]
+        self.vectors = self.vectors[keep] if keep else None
+        for attr in ("answers", "chunk_ids", "latencies", "created_at", "last_used"):
+            values = getattr(self, attr)
+            setattr(self, attr, [values[i] for i in keep])
+
+
+def _normalize(vector: Sequence[float]) -> np.ndarray:
+    arr = np.asarray(vector, dtype=np.float32)
+    norm = np.linalg.norm(arr)
+    return arr / norm if norm > 0 else arr
+
+
+class SemanticCache:
+    """
+    基于查询向量相似度的进程内答案缓存。
+    同一分区内，新问题与历史问题的余弦相似度超过阈值时直接返回历史答案。
+    条目受 LRU 数量上限与 TTL 约束，分区数也有 LRU 上限；知识库版本号变化时整个分区被清空。
+    """
+
+    def __init__(
+        self,
+        threshold: float = SEMANTIC_CACHE_THRESHOLD,
+        max_entries: int = SEMANTIC_CACHE_MAX_ENTRIES,
+        ttl_seconds: float = SEMANTIC_CACHE_TTL_SECONDS,
+        max_partitions: int = SEMANTIC_CACHE_MAX_PARTITIONS,
+    ):
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.max_partitions = max_partitions
+        self._partitions: "OrderedDict[Hashable, _Partition]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.latency_saved = 0.0
+
+    def _get_partition(self, key: Hashable, kb_version: int) -> _Partition:
+        partition = self._partitions.get(key)
+        if partition is None or partition.kb_version != kb_version:
+            # 知识库版本变化，旧答案全部失效
+            partition = _Partition(kb_version)
+            self._partitions[key] = partition
+        self._partitions.move_to_end(key)
+        while len(self._partitions) > self.max_partitions:
+            self._partitions.popitem(last=False)
+        return partition
+
+    def _expire(self, partition: _Partition, now: float) -> None:
+        expired = [
+            i
+            for i, created in enumerate(partition.created_at)
+            if now - created > self.ttl_seconds
+        ]
+        partition.remove(expired)
+
+    def lookup(
+        self, key: Hashable, kb_version: int, query_vector: Sequence[float]
+    ) -> Optional[SemanticCacheHit]:
+        """查找与查询向量最相似的缓存条目，相似度达到阈值时返回命中结果"""
+        start = time.perf_counter()
+        query = _normalize(query_vector)
+        now = time.time()
+        hit: Optional[SemanticCacheHit] = None
+        with self._lock:
+            partition = self._get_partition(key, kb_version)
+            self._expire(partition, now)
+            if len(partition) and partition.vectors.shape[1] == query.shape[0]:
+                scores = partition.vectors @ query
+                best = int(np.argmax(scores))
+                if scores[best] >= self.threshold:
+                    partition.last_used[best] = now
+                    hit = SemanticCacheHit(
+                        answer=partition.answers[best],
+                        chunk_ids=partition.chunk_ids[best],
+                        similarity=float(scores[best]),
+                        latency_saved=partition.latencies[best],
+                    )
+            if hit:
+                self.hits += 1
+                self.latency_saved += hit.latency_saved
+            else:
+                self.misses += 1
+        metrics.observe("semantic_cache_lookup_seconds", time.perf_counter() - start)
+        if hit:
+            metrics.observe("semantic_cache_latency_saved_seconds", hit.latency_saved)
+        return hit
+
+    def store(
+        self,
+        key: Hashable,
+        kb_version: int,
+        query_vector: Sequence[float],
+        answer: str,
+        chunk_ids: List[str],
+        latency: float,
+    ) -> None:
+        """写入一条缓存；超出上限时淘汰最久未使用的条目"""
+        if not answer:
+            return
+        query = _normalize(query_vector)
+        now = time.time()
+        with self._lock:
+            partition = self._get_partition(key, kb_version)
+            if len(partition) and partition.vectors.shape[1] != query.shape[0]:
+                # 向量维度变化 (更换了嵌入模型)，重建分区
+                partition = _Partition(kb_version)
+                self._partitions[key] = partition
+            if len(partition) >= self.max_entries:
+                partition.remove([int(np.argmin(partition.last_used))])
+            partition.vectors = (
+                query[np.newaxis, :]
+                if partition.vectors is None
+                else np.vstack([partition.vectors, query])
+            )
+            partition.answers.append(answer)
+            partition.chunk_ids.append(list(chunk_ids))
+            partition.latencies.append(latency)
+            partition.created_at.append(now)
+            partition.last_used.append(now)
+
+    def invalidate_kb(self, kb_id: str) -> None:
+        """清空指定知识库的全部分区 (分区键的第一个元素为知识库 ID)"""
+        with self._lock:
+            for key in [k for k in self._partitions if k[0] == str(kb_id)]:
+                del self._partitions[key]
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "partitions": len(self._partitions),
+                "entries": sum(len(p) for p in self._partitions.values()),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+                "latency_saved_seconds": round(self.latency_saved, 3),
+                "threshold": self.threshold,
+            }
+
+
+# 进程内全局语义缓存
+semantic_cache = SemanticCache()
+metrics.register_provider("semantic_cache", semantic_cache.stats)
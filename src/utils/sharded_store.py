@@ -0,0 +1,563 @@
+import concurrent.futures
+import hashlib
+import heapq
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+import uuid
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+)
+
+import numpy as np
+from langchain_chroma import Chroma
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.vectorstores import VectorStore
+
+from src.utils.flat_index import (
+    FLAT_INDEX_DTYPE,
+    FlatIndexStore,
+    _normalize_rows,
+    encode_row,
+    id_hash,
+    write_snapshot,
+)
+from src.utils.metrics import metrics
+from src.utils.segmented_store import SegmentedChromaStore
+
+logger = logging.getLogger(__name__)
+
+# --- 分片存储配置 ---
+shard_dir = os.getenv("SHARD_DIR", "shards/")  # 分片知识库的根目录
+MAX_SHARD_COUNT = 64
+# 分片读写所用线程池大小 (所有分片知识库共享)
+SHARD_MAX_WORKERS = int(os.getenv("SHARD_MAX_WORKERS", 8))
+RESHARD_BATCH_SIZE = int(os.getenv("RESHARD_BATCH_SIZE", 1000))  # 重新分片时每批迁移的行数
+# 被替换的分片代 (及重新分片前的未分片存储) 保留的时间 (秒)，让仍在使用旧布局的读请求完成
+SHARD_GC_GRACE_SECONDS = int(os.getenv("SHARD_GC_GRACE_SECONDS", 300))
+
+CURRENT_FILE = "CURRENT"  # 记录当前分片代 (generation) 目录名的指针文件
+SHARDS_MANIFEST = "shards.json"
+RETIRED_FILE = "RETIRED"  # 分片代被替换的时间 (文件修改时间)，宽限期过后删除
+
+_shard_executor = concurrent.futures.ThreadPoolExecutor(
+    max_workers=SHARD_MAX_WORKERS, thread_name_prefix="shard"
+)
+
+
+def shard_of(doc_key: str, shard_count: int) -> int:
+    """按块内容哈希决定所属分片"""
+    digest = hashlib.blake2b(doc_key.encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "big") % shard_count
+
+
+def _chunk_key(text: str, metadata: Optional[dict]) -> str:
+    metadata = metadata or {}
+    return "\x1f".join(
+        [
+            str(metadata.get("source_file_md5", "")),
+            str(metadata.get("chunk_index", "")),
+            text,
+        ]
+    )
+
+
+def _split_id(doc_id: str) -> Tuple[Optional[int], str]:
+    """分片知识库的块 ID 形如 "<分片号>:<原始 ID>"，返回 (分片号, 原始 ID)"""
+    shard, sep, base = doc_id.partition(":")
+    if sep and shard.isdigit():
+        return int(shard), base
+    return None, doc_id
+
+
+def search_by_vector_with_relevance(
+    vectorstore: VectorStore,
+    embedding: List[float],
+    k: int,
+    filter: Optional[dict] = None,
+    nprobe: Optional[int] = None,
+) -> List[Tuple[Document, float]]:
+    """按查询向量检索，返回 [(文档, 相关度)]；屏蔽各后端分数含义的差异"""
+    if isinstance(vectorstore, (FlatIndexStore, ShardedVectorStore, SegmentedChromaStore)):
+        # 这些存储返回的已是相关度
+        return vectorstore.similarity_search_by_vector_with_score(
+            embedding, k=k, filter=filter, nprobe=nprobe
+        )
+    # Chroma 按向量检索返回的是距离，需转换为相关度
+    kwargs: Dict[str, Any] = {"k": k}
+    if filter:
+        kwargs["filter"] = filter
+    relevance_fn = vectorstore._select_relevance_score_fn()
+    return [
+        (doc, float(relevance_fn(score)))
+        for doc, score in vectorstore.similarity_search_by_vector_with_relevance_scores(
+            embedding, **kwargs
+        )
+    ]
+
+
+# --- 各后端的批量导出/导入 (用于重新分片，迁移时不重新计算向量) ---
+def export_rows(
+    vectorstore: VectorStore, batch_size: int = RESHARD_BATCH_SIZE
+) -> Iterator[Tuple[List[str], List[str], List[dict], np.ndarray]]:
+    """分批导出 (ids, 文本, 元数据, 向量)"""
+    if isinstance(vectorstore, ShardedVectorStore):
+        for shard in vectorstore.shards:
+            yield from export_rows(shard, batch_size)
+    elif isinstance(vectorstore, SegmentedChromaStore):
+        for segment in vectorstore.segment_stores():
+            yield from export_rows(segment, batch_size)
+    elif isinstance(vectorstore, FlatIndexStore):
+        snapshot = vectorstore.snapshot()
+        if snapshot is None:
+            return
+        for start in range(0, snapshot.count, batch_size):
+            rows = [snapshot.row(i) for i in range(start, min(snapshot.count, start + batch_size))]
+            yield (
+                [row["id"] for row in rows],
+                [row["text"] for row in rows],
+                [row["metadata"] for row in rows],
+                np.asarray(
+                    snapshot.float_vectors[start : start + len(rows)], dtype=np.float32
+                ),
+            )
+    else:
+        offset = 0
+        while True:
+            result = vectorstore.get(
+                limit=batch_size,
+                offset=offset,
+                include=["documents", "metadatas", "embeddings"],
+            )
+            if not result["ids"]:
+                return
+            yield (
+                list(result["ids"]),
+                list(result["documents"]),
+                [m or {} for m in result["metadatas"]],
+                np.asarray(result["embeddings"], dtype=np.float32),
+            )
+            offset += len(result["ids"])
+
+
+def import_rows(
+    vectorstore: VectorStore,
+    ids: List[str],
+    texts: List[str],
+    metadatas: List[dict],
+    vectors: np.ndarray,
+) -> None:
+    """写入已有向量的行 (不重新计算向量)；平铺索引每次调用都会发布一个新版本"""
+    if isinstance(vectorstore, FlatIndexStore):
+        vectorstore.add_vectors(_normalize_rows(vectors), texts, metadatas, ids)
+    else:
+        vectorstore._collection.upsert(
+            ids=ids, embeddings=vectors.tolist(), metadatas=metadatas, documents=texts
+        )
+
+
+class ShardedVectorStore(VectorStore):
+    """
+    分片向量存储：一个知识库拆分为 N 个独立的子存储 (Chroma 集合或平铺索引)，
+    每个分片有自己的目录 (Chroma 为独立的 sqlite 文件)。
+    - 写入按块内容哈希分配到分片，各分片在线程池中并行写入；
+    - 检索只计算一次查询向量，各分片在线程池中并发检索后合并 top-k；
+    - 块 ID 带分片号前缀，按 ID 读取/删除时直接定位分片。
+    分片布局位于 shards/<kb_id>/<代>/，CURRENT 指针原子切换，重新分片期间读请求使用旧布局。
+    """
+
+    def __init__(self, collection_name: str, embedding_function: Embeddings):
+        self.collection_name = collection_name
+        self._embedding_function = embedding_function
+        self.root = os.path.join(shard_dir, collection_name)
+        generation = _read_current(self.root)
+        if generation is None:
+            raise FileNotFoundError(f"分片知识库 '{collection_name}' 不存在。")
+        self.generation_path = os.path.join(self.root, generation)
+        with open(
+            os.path.join(self.generation_path, SHARDS_MANIFEST), "r", encoding="utf-8"
+        ) as f:
+            self.manifest: Dict[str, Any] = json.load(f)
+        self.backend = self.manifest["backend"]
+        self.shard_count = int(self.manifest["shard_count"])
+        self.shards: List[VectorStore] = [
+            _open_shard(
+                self.generation_path,
+                collection_name,
+                i,
+                self.backend,
+                embedding_function,
+                self.manifest.get("dtype") or FLAT_INDEX_DTYPE,
+            )
+            for i in range(self.shard_count)
+        ]
+
+    # --- 布局 ---
+    @staticmethod
+    def exists(collection_name: str) -> bool:
+        return _read_current(os.path.join(shard_dir, collection_name)) is not None
+
+    @staticmethod
+    def destroy(collection_name: str) -> None:
+        root = os.path.join(shard_dir, collection_name)
+        if os.path.isdir(root):
+            shutil.rmtree(root)
+
+    @classmethod
+    def create(
+        cls,
+        collection_name: str,
+        embedding_function: Embeddings,
+        backend: str,
+        shard_count: int,
+        dtype: Optional[str] = None,
+    ) -> "ShardedVectorStore":
+        """创建空的分片布局并发布"""
+        _publish_generation(
+            os.path.join(shard_dir, collection_name), backend, shard_count, dtype
+        )
+        return cls(collection_name, embedding_function)
+
+    @property
+    def embeddings(self) -> Embeddings:
+        return self._embedding_function
+
+    def _fan_out(self, fn: Callable[[int, VectorStore], Any], shards: Iterable[int]) -> List[Any]:
+        futures = [
+            _shard_executor.submit(fn, i, self.shards[i]) for i in shards
+        ]
+        return [future.result() for future in futures]
+
+    # --- 写入 ---
+    def add_texts(
+        self,
+        texts: Iterable[str],
+        metadatas: Optional[List[dict]] = None,
+        *,
+        ids: Optional[List[str]] = None,
+        **kwargs: Any,
+    ) -> List[str]:
+        texts = list(texts)
+        if not texts:
+            return []
+        metadatas = metadatas or [{} for _ in texts]
+        final_ids: List[str] = []
+        partitions: Dict[int, Tuple[List[str], List[dict], List[str]]] = {}
+        for position, (text, metadata) in enumerate(zip(texts, metadatas)):
+            base_id = ids[position] if ids and ids[position] else str(uuid.uuid4())
+            shard = shard_of(_chunk_key(text, metadata), self.shard_count)
+            doc_id = f"{shard}:{_split_id(base_id)[1]}"
+            final_ids.append(doc_id)
+            part = partitions.setdefault(shard, ([], [], []))
+            part[0].append(text)
+            part[1].append(metadata)
+            part[2].append(doc_id)
+
+        started_at = time.perf_counter()
+        self._fan_out(
+            lambda i, store: store.add_texts(
+                partitions[i][0], partitions[i][1], ids=partitions[i][2]
+            ),
+            partitions,
+        )
+        metrics.observe("shard_write_seconds", time.perf_counter() - started_at)
+        _collect_generations(self.root)
+        return final_ids
+
+    def delete(
+        self, ids: Optional[List[str]] = None, where: Optional[dict] = None, **kwargs: Any
+    ) -> Optional[bool]:
+        """按 ID (直接定位分片) 或过滤条件 (所有分片并行) 删除"""
+        if ids:
+            by_shard: Dict[int, List[str]] = {}
+            for doc_id in ids:
+                shard, _ = _split_id(doc_id)
+                for i in [shard] if shard is not None else range(self.shard_count):
+                    by_shard.setdefault(i, []).append(doc_id)
+            self._fan_out(lambda i, store: store.delete(ids=by_shard[i]), by_shard)
+        if where:
+            self._fan_out(
+                lambda i, store: store.delete(where=where), range(self.shard_count)
+            )
+        _collect_generations(self.root)
+        return True
+
+    # --- 读取 ---
+    def get_by_ids(self, ids: Sequence[str], /) -> List[Document]:
+        by_shard: Dict[int, List[str]] = {}
+        for doc_id in ids:
+            shard, _ = _split_id(doc_id)
+            for i in [shard] if shard is not None else range(self.shard_count):
+                by_shard.setdefault(i, []).append(doc_id)
+        results = self._fan_out(
+            lambda i, store: store.get_by_ids(by_shard[i]), by_shard
+        )
+        return [doc for docs in results for doc in docs]
+
+    def similarity_search_by_vector_with_score(
+        self,
+        embedding: List[float],
+        k: int = 4,
+        filter: Optional[dict] = None,
+        nprobe: Optional[int] = None,
+    ) -> List[Tuple[Document, float]]:
+        """各分片并发检索后合并 top-k，分数为相关度"""
+        started_at = time.perf_counter()
+        results = self._fan_out(
+            lambda i, store: search_by_vector_with_relevance(
+                store, embedding, k, filter, nprobe
+            ),
+            range(self.shard_count),
+        )
+        merged = heapq.nlargest(
+            k, (pair for pairs in results for pair in pairs), key=lambda p: p[1]
+        )
+        metrics.observe("shard_search_seconds", time.perf_counter() - started_at)
+        return merged
+
+    def similarity_search_with_score(
+        self,
+        query: str,
+        k: int = 4,
+        filter: Optional[dict] = None,
+        nprobe: Optional[int] = None,
+        **kwargs: Any,
+    ) -> List[Tuple[Document, float]]:
+        embedding = self._embedding_function.embed_query(query)
+        return self.similarity_search_by_vector_with_score(embedding, k, filter, nprobe)
+
+    def similarity_search(
+        self, query: str, k: int = 4, filter: Optional[dict] = None, **kwargs: Any
+    ) -> List[Document]:
+        return [doc for doc, _ in self.similarity_search_with_score(query, k, filter)]
+
+    def _select_relevance_score_fn(self) -> Callable[[float], float]:
+        # 合并时已统一为相关度
+        return lambda score: score
+
+    @classmethod
+    def from_texts(
+        cls,
+        texts: List[str],
+        embedding: Embeddings,
+        metadatas: Optional[List[dict]] = None,
+        *,
+        ids: Optional[List[str]] = None,
+        collection_name: str = "default",
+        backend: str = "chroma",
+        shard_count: int = 2,
+        dtype: Optional[str] = None,
+        **kwargs: Any,
+    ) -> "ShardedVectorStore":
+        store = cls.create(collection_name, embedding, backend, shard_count, dtype)
+        store.add_texts(texts, metadatas, ids=ids)
+        return store
+
+
+def _read_current(root: str) -> Optional[str]:
+    try:
+        with open(os.path.join(root, CURRENT_FILE), "r", encoding="utf-8") as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+
+def _open_shard(
+    generation_path: str,
+    collection_name: str,
+    index: int,
+    backend: str,
+    embedding_function: Embeddings,
+    dtype: str,
+) -> VectorStore:
+    path = os.path.join(generation_path, f"shard_{index}")
+    name = f"{collection_name}_{index}"
+    if backend == "numpy":
+        return FlatIndexStore(name, embedding_function, persist_directory=path, dtype=dtype)
+    return Chroma(
+        collection_name=name, persist_directory=path, embedding_function=embedding_function
+    )
+
+
+def _new_generation(root: str, backend: str, shard_count: int, dtype: Optional[str]) -> str:
+    """创建新的分片代目录 (尚未发布)，返回目录名"""
+    if not 1 <= shard_count <= MAX_SHARD_COUNT:
+        raise ValueError(f"分片数必须在 1 到 {MAX_SHARD_COUNT} 之间: {shard_count}")
+    generation = f"g{int(time.time() * 1000)}-{uuid.uuid4().hex[:6]}"
+    os.makedirs(os.path.join(root, generation))
+    with open(
+        os.path.join(root, generation, SHARDS_MANIFEST), "w", encoding="utf-8"
+    ) as f:
+        json.dump({"backend": backend, "shard_count": shard_count, "dtype": dtype}, f)
+    return generation
+
+
+def _switch_generation(root: str, generation: str) -> None:
+    """原子切换 CURRENT 指针，旧的分片代在宽限期过后删除 (见 _collect_generations)"""
+    tmp_pointer = os.path.join(root, f"{CURRENT_FILE}.{generation}.tmp")
+    with open(tmp_pointer, "w", encoding="utf-8") as f:
+        f.write(generation)
+    os.replace(tmp_pointer, os.path.join(root, CURRENT_FILE))
+    _collect_generations(root)
+
+
+def _collect_generations(root: str) -> None:
+    """
+    回收旧的分片代：第一次发现时写入 RETIRED 标记，标记超过 SHARD_GC_GRACE_SECONDS 秒后删除。
+    进行中的请求与缓存中的旧实例可能仍在读旧分片 (Chroma 后端为打开中的 sqlite 文件)，
+    不能在切换时立即删除。在切换与之后的写入时执行。
+    """
+    current = _read_current(root)
+    if current is None:
+        return
+    expire_before = time.time() - SHARD_GC_GRACE_SECONDS
+    for name in os.listdir(root):
+        path = os.path.join(root, name)
+        if name == current or not name.startswith("g") or not os.path.isdir(path):
+            continue
+        marker = os.path.join(path, RETIRED_FILE)
+        try:
+            if os.path.getmtime(marker) < expire_before:
+                shutil.rmtree(path, ignore_errors=True)
+        except FileNotFoundError:
+            with open(marker, "w", encoding="utf-8") as f:
+                f.write(current)
+
+
+def _publish_generation(
+    root: str, backend: str, shard_count: int, dtype: Optional[str]
+) -> str:
+    generation = _new_generation(root, backend, shard_count, dtype)
+    _switch_generation(root, generation)
+    return generation
+
+
+_reshard_locks: Dict[str, threading.Lock] = {}
+_reshard_locks_guard = threading.Lock()
+
+
+def reshard(
+    source: VectorStore,
+    collection_name: str,
+    embedding_function: Embeddings,
+    backend: str,
+    shard_count: int,
+    dtype: Optional[str] = None,
+) -> Dict[str, Any]:
+    """
+    重新分片：把现有存储 (未分片或已分片) 的全部行按新的分片数迁移到新的分片代，
+    迁移时复用已存储的向量，不重新调用嵌入模型。新布局写完后原子切换，
+    切换前的读请求不受影响。调用方负责在切换后删除未分片的旧存储。
+    平铺索引后端先在内存中收集各分片的行，最后每个分片只写入一个版本
+    (逐批追加会让每批都重写整个分片，迁移耗时随知识库大小平方增长)。
+    """
+    with _reshard_locks_guard:
+        lock = _reshard_locks.setdefault(collection_name, threading.Lock())
+    if not lock.acquire(blocking=False):
+        raise ValueError(f"知识库 '{collection_name}' 正在重新分片。")
+    try:
+        started_at = time.perf_counter()
+        root = os.path.join(shard_dir, collection_name)
+        generation = _new_generation(root, backend, shard_count, dtype)
+        generation_path = os.path.join(root, generation)
+        targets = [
+            _open_shard(
+                generation_path,
+                collection_name,
+                i,
+                backend,
+                embedding_function,
+                dtype or FLAT_INDEX_DTYPE,
+            )
+            for i in range(shard_count)
+        ]
+        # 平铺索引：每个分片待写入的 (归一化向量, rows.jsonl 行, 文件 MD5, ID 哈希)
+        pending: List[List[Tuple[np.ndarray, bytes, Optional[str], int]]] = [
+            [] for _ in range(shard_count)
+        ]
+        dim = None
+        moved = 0
+        for ids, texts, metadatas, vectors in export_rows(source):
+            partitions: Dict[int, List[int]] = {}
+            for position, (text, metadata) in enumerate(zip(texts, metadatas)):
+                shard = shard_of(_chunk_key(text, metadata), shard_count)
+                partitions.setdefault(shard, []).append(position)
+
+            if backend == "numpy":
+                normalized = _normalize_rows(vectors)
+                dim = normalized.shape[1]
+                for i, positions in partitions.items():
+                    for p in positions:
+                        new_id = f"{i}:{_split_id(ids[p])[1]}"
+                        pending[i].append(
+                            (
+                                normalized[p],
+                                encode_row(new_id, texts[p], metadatas[p]),
+                                (metadatas[p] or {}).get("source_file_md5"),
+                                id_hash(new_id),
+                            )
+                        )
+                moved += len(ids)
+                continue
+
+            def write(i: int) -> None:
+                positions = partitions[i]
+                import_rows(
+                    targets[i],
+                    [f"{i}:{_split_id(ids[p])[1]}" for p in positions],
+                    [texts[p] for p in positions],
+                    [metadatas[p] for p in positions],
+                    vectors[positions],
+                )
+
+            for future in [_shard_executor.submit(write, i) for i in partitions]:
+                future.result()
+            moved += len(ids)
+
+        def write_shard(i: int) -> None:
+            write_snapshot(
+                targets[i].index_path,
+                dim,
+                pending[i],
+                len(pending[i]),
+                dtype=targets[i].dtype,
+            )
+
+        for future in [
+            _shard_executor.submit(write_shard, i)
+            for i in range(shard_count)
+            if pending[i]
+        ]:
+            future.result()
+        _switch_generation(root, generation)
+    finally:
+        lock.release()
+    elapsed = time.perf_counter() - started_at
+    logger.info(
+        f"知识库 '{collection_name}' 已重新分片为 {shard_count} 个分片，迁移 {moved} 行，耗时 {elapsed:.2f}s。"
+    )
+    return {
+        "generation": generation,
+        "shard_count": shard_count,
+        "rows": moved,
+        "seconds": round(elapsed, 3),
+    }
+
+
+def sharded_store_stats() -> Dict[str, Any]:
+    return {"max_workers": SHARD_MAX_WORKERS, "max_shard_count": MAX_SHARD_COUNT}
+
+
+metrics.register_provider("sharded_store", sharded_store_stats)
@@ -0,0 +1,122 @@
+import asyncio
+import logging
+import re
+from typing import Any, AsyncIterable, AsyncIterator, Callable, Dict, Hashable, List
+
+from src.utils.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+_TRAILING_PUNCTUATION = "?？。.!！~～ "
+
+
+def normalize_question(question: str) -> str:
+    """归一化问题文本：去除首尾空白与结尾标点，合并连续空白并转为小写"""
+    text = re.sub(r"\s+", " ", question or "").strip().lower()
+    return text.rstrip(_TRAILING_PUNCTUATION)
+
+
+class _Flight:
+    """一次进行中的共享调用：缓冲上游产生的全部事件，供多个订阅者按序读取"""
+
+    def __init__(self, key: Hashable):
+        self.key = key
+        self.events: List[Dict[str, Any]] = []
+        self.done = False
+        self.subscribers = 0
+        self.task: asyncio.Task = None
+        self._changed = asyncio.Event()
+
+    def publish(self, event: Dict[str, Any]) -> None:
+        self.events.append(event)
+        self._notify()
+
+    def finish(self) -> None:
+        self.done = True
+        self._notify()
+
+    def _notify(self) -> None:
+        # 唤醒当前所有等待者，并为下一次变更准备新的 Event
+        changed, self._changed = self._changed, asyncio.Event()
+        changed.set()
+
+    async def subscribe(self) -> AsyncIterator[Dict[str, Any]]:
+        """从头开始按序产出事件，直到上游结束"""
+        index = 0
+        while True:
+            if index < len(self.events):
+                event = self.events[index]
+                index += 1
+                yield event
+                continue
+            if self.done:
+                return
+            await self._changed.wait()
+
+
+class SingleFlight:
+    """
+    相同键的并发请求合并为一次上游调用 (single-flight)。
+    第一个请求 (leader) 启动上游事件流，其余请求 (follower) 订阅同一份缓冲，
+    收到与 leader 相同的事件序列。所有订阅者都离开后，上游调用会被取消。
+    """
+
+    def __init__(self):
+        self._flights: Dict[Hashable, _Flight] = {}
+
+    def join(
+        self,
+        key: Hashable,
+        source_factory: Callable[[], AsyncIterable[Dict[str, Any]]],
+    ) -> "tuple[_Flight, bool]":
+        """加入 (或发起) 一次共享调用，返回 (flight, 是否为 leader)"""
+        flight = self._flights.get(key)
+        if flight is not None and not flight.done:
+            flight.subscribers += 1
+            metrics.incr("single_flight_followers_total")
+            return flight, False
+
+        flight = _Flight(key)
+        flight.subscribers = 1
+        self._flights[key] = flight
+        flight.task = asyncio.create_task(self._run(flight, source_factory()))
+        metrics.incr("single_flight_leaders_total")
+        return flight, True
+
+    async def subscribe(self, flight: _Flight) -> AsyncIterator[Dict[str, Any]]:
+        """订阅共享调用的事件流 (需先 join)；最后一个订阅者离开时取消上游调用"""
+        try:
+            async for event in flight.subscribe():
+                yield event
+        finally:
+            flight.subscribers -= 1
+            if flight.subscribers <= 0 and not flight.done:
+                logger.info("single-flight 所有订阅者已离开，取消上游调用。")
+                flight.task.cancel()
+
+    async def _run(
+        self, flight: _Flight, source: AsyncIterable[Dict[str, Any]]
+    ) -> None:
+        try:
+            async for event in source:
+                flight.publish(event)
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            logger.error(f"single-flight 上游调用出错: {e}", exc_info=True)
+            flight.publish({"type": "error", "data": f"处理请求时发生错误: {e}"})
+        finally:
+            flight.finish()
+            if self._flights.get(flight.key) is flight:
+                del self._flights[flight.key]
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "in_flight": len(self._flights),
+            "subscribers": sum(f.subscribers for f in self._flights.values()),
+        }
+
+
+# 进程内全局 single-flight 实例
+single_flight = SingleFlight()
+metrics.register_provider("single_flight", single_flight.stats)
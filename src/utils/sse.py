@@ -0,0 +1,123 @@
+import asyncio
+import json
+import logging
+import os
+import time
+from typing import Any, AsyncIterable, AsyncIterator, Dict
+
+# 优先使用 orjson 进行快速 JSON 编码，缺失时回退到标准库
+try:
+    import orjson
+
+    ORJSON_AVAILABLE = True
+except ImportError:
+    ORJSON_AVAILABLE = False
+
+logger = logging.getLogger(__name__)
+
+# --- SSE 合帧配置 ---
+SSE_FLUSH_INTERVAL_MS = float(os.getenv("SSE_FLUSH_INTERVAL_MS", 30))  # 合帧时间窗口
+SSE_FLUSH_MAX_BYTES = int(os.getenv("SSE_FLUSH_MAX_BYTES", 1024))  # 合帧字节阈值
+
+# 预先格式化的 chunk 帧前后缀，避免每帧重复编码外层字典
+_CHUNK_FRAME_PREFIX = b'data: {"type":"chunk","data":'
+_CHUNK_FRAME_SUFFIX = b"}\n\n"
+_SOURCE_DONE = object()  # 上游流结束标记
+
+
+def _dumps(obj: Any) -> bytes:
+    if ORJSON_AVAILABLE:
+        return orjson.dumps(obj)
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def encode_sse_event(event: Dict[str, Any]) -> bytes:
+    """将单个事件字典编码为 SSE 帧"""
+    return b"data: " + _dumps(event) + b"\n\n"
+
+
+def encode_chunk_frame(text: str) -> bytes:
+    """将合并后的文本编码为 chunk 类型的 SSE 帧"""
+    return _CHUNK_FRAME_PREFIX + _dumps(text) + _CHUNK_FRAME_SUFFIX
+
+
+async def coalesce_sse_events(
+    events: AsyncIterable[Dict[str, Any]],
+    flush_interval_ms: float = SSE_FLUSH_INTERVAL_MS,
+    max_bytes: int = SSE_FLUSH_MAX_BYTES,
+) -> AsyncIterator[bytes]:
+    """
+    将 stream_chat 产生的事件流合并为 SSE 帧。
+
+    - 相邻的 chunk 事件按时间窗口 (flush_interval_ms) 或字节阈值 (max_bytes) 合并为一帧；
+    - 首个 chunk 立即发送，保证首字延迟不受影响；
+    - 其他类型的事件 (context、error 等) 会先冲刷已缓冲的文本，再原样发送。
+    """
+    queue: asyncio.Queue = asyncio.Queue()
+    flush_interval = flush_interval_ms / 1000
+
+    async def pump() -> None:
+        try:
+            async for event in events:
+                await queue.put(event)
+        except Exception as e:
+            await queue.put(e)
+        finally:
+            await queue.put(_SOURCE_DONE)
+
+    pump_task = asyncio.create_task(pump())
+    buffer: list = []
+    buffered_bytes = 0
+    first_chunk_sent = False
+    last_flush = time.monotonic()
+
+    try:
+        while True:
+            timeout = None
+            if buffer:
+                timeout = max(0.0, flush_interval - (time.monotonic() - last_flush))
+            try:
+                item = await asyncio.wait_for(queue.get(), timeout=timeout)
+            except asyncio.TimeoutError:
+                # 时间窗口到期，冲刷缓冲区
+                yield encode_chunk_frame("".join(buffer))
+                buffer, buffered_bytes = [], 0
+                last_flush = time.monotonic()
+                continue
+
+            if item is _SOURCE_DONE:
+                break
+            if isinstance(item, Exception):
+                raise item
+
+            if item.get("type") == "chunk":
+                text = item.get("data") or ""
+                if not first_chunk_sent:
+                    first_chunk_sent = True
+                    last_flush = time.monotonic()
+                    yield encode_chunk_frame(text)
+                    continue
+                if not buffer:
+                    last_flush = time.monotonic()
+                buffer.append(text)
+                buffered_bytes += len(text.encode("utf-8"))
+                if buffered_bytes >= max_bytes:
+                    yield encode_chunk_frame("".join(buffer))
+                    buffer, buffered_bytes = [], 0
+                    last_flush = time.monotonic()
+            else:
+                if buffer:
+                    yield encode_chunk_frame("".join(buffer))
+                    buffer, buffered_bytes = [], 0
+                    last_flush = time.monotonic()
+                yield encode_sse_event(item)
+
+        if buffer:
+            yield encode_chunk_frame("".join(buffer))
+    finally:
+        if not pump_task.done():
+            pump_task.cancel()
+            try:
+                await pump_task
+            except (asyncio.CancelledError, Exception):
+                pass
@@ -0,0 +1,135 @@
+import asyncio
+import concurrent.futures
+import logging
+import os
+import time
+from typing import Any, Callable, Dict, Optional
+
+from src.utils.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# --- 向量存储读写执行器配置 ---
+# 专用线程池大小：所有知识库的向量检索都在这里执行，不占用默认线程池 (写入见 VECTOR_WRITE_WORKERS)
+VECTOR_EXECUTOR_WORKERS = int(os.getenv("VECTOR_EXECUTOR_WORKERS", 16))
+# 单个知识库同时执行的向量操作上限，防止一个热点知识库占满线程池
+VECTOR_KB_MAX_CONCURRENCY = int(os.getenv("VECTOR_KB_MAX_CONCURRENCY", 4))
+# 写入 (含远程嵌入的入库) 使用的独立线程池大小：写入再多也不占用检索的线程
+VECTOR_WRITE_WORKERS = int(os.getenv("VECTOR_WRITE_WORKERS", 4))
+
+_vector_executor = concurrent.futures.ThreadPoolExecutor(
+    max_workers=VECTOR_EXECUTOR_WORKERS, thread_name_prefix="vector"
+)
+_vector_write_executor = concurrent.futures.ThreadPoolExecutor(
+    max_workers=VECTOR_WRITE_WORKERS, thread_name_prefix="vector-write"
+)
+_writes_pending = 0
+
+
+class _KbSlots:
+    """单个知识库的并发槽位与排队计数"""
+
+    def __init__(self, limit: int):
+        self.semaphore = asyncio.Semaphore(limit)
+        self.waiting = 0
+        self.running = 0
+
+
+_kb_slots: Dict[str, _KbSlots] = {}
+
+
+def _slots_of(kb_id: str) -> _KbSlots:
+    slots = _kb_slots.get(kb_id)
+    if slots is None:
+        slots = _kb_slots[kb_id] = _KbSlots(VECTOR_KB_MAX_CONCURRENCY)
+    return slots
+
+
+async def run_vector_op(
+    kb_id: Optional[str], op: str, fn: Callable[..., Any], *args: Any, **kwargs: Any
+) -> Any:
+    """
+    在专用线程池中执行一次同步的向量存储读操作 (检索、按 ID 读取等)。
+    同一知识库最多 VECTOR_KB_MAX_CONCURRENCY 个操作同时执行，其余在事件循环中排队等待，
+    不阻塞事件循环也不占用线程。
+    排队时间 (等待槽位 + 等待线程) 与执行时间分别记录为
+    vector_op_queue_seconds / vector_op_exec_seconds (按 op 区分)。
+    调用方被取消时，已开始的操作仍占用槽位直到线程中的调用真正结束。
+    """
+    loop = asyncio.get_running_loop()
+    slots = _slots_of(str(kb_id))
+    enqueued_at = time.perf_counter()
+    started: Dict[str, float] = {}
+
+    def call() -> Any:
+        started["at"] = time.perf_counter()
+        return fn(*args, **kwargs)
+
+    slots.waiting += 1
+    try:
+        await slots.semaphore.acquire()
+    finally:
+        slots.waiting -= 1
+    slots.running += 1
+
+    def release(_: "asyncio.Future") -> None:
+        slots.running -= 1
+        slots.semaphore.release()
+        finished_at = time.perf_counter()
+        started_at = started.get("at", finished_at)
+        metrics.observe("vector_op_queue_seconds", started_at - enqueued_at, op=op)
+        metrics.observe("vector_op_exec_seconds", finished_at - started_at, op=op)
+
+    future = loop.run_in_executor(_vector_executor, call)
+    future.add_done_callback(release)
+    return await asyncio.shield(future)
+
+
+async def run_vector_write(
+    kb_id: Optional[str], op: str, fn: Callable[..., Any], *args: Any, **kwargs: Any
+) -> Any:
+    """
+    在独立的写入线程池中执行一次同步的写入 (入库时的嵌入 + 插入、删除等)。
+    写入可能长时间等待远程嵌入服务，与检索共用线程池会挤占检索的线程；
+    写入池最多 VECTOR_WRITE_WORKERS 个线程，多余的写入在池中排队，检索线程始终可用。
+    同一知识库的写入已由写入队列串行化，不占用该知识库的检索并发槽位。
+    排队与执行时间同样记录为 vector_op_queue_seconds / vector_op_exec_seconds。
+    """
+    global _writes_pending
+    loop = asyncio.get_running_loop()
+    enqueued_at = time.perf_counter()
+    started: Dict[str, float] = {}
+
+    def call() -> Any:
+        started["at"] = time.perf_counter()
+        return fn(*args, **kwargs)
+
+    def release(_: "asyncio.Future") -> None:
+        global _writes_pending
+        _writes_pending -= 1
+        finished_at = time.perf_counter()
+        started_at = started.get("at", finished_at)
+        metrics.observe("vector_op_queue_seconds", started_at - enqueued_at, op=op)
+        metrics.observe("vector_op_exec_seconds", finished_at - started_at, op=op)
+
+    _writes_pending += 1
+    future = loop.run_in_executor(_vector_write_executor, call)
+    future.add_done_callback(release)
+    return await asyncio.shield(future)
+
+
+def vector_executor_stats() -> Dict[str, Any]:
+    return {
+        "workers": VECTOR_EXECUTOR_WORKERS,
+        "kb_max_concurrency": VECTOR_KB_MAX_CONCURRENCY,
+        "write_workers": VECTOR_WRITE_WORKERS,
+        "writes_pending": _writes_pending,
+        "kbs": {
+            kb_id: {"waiting": slots.waiting, "running": slots.running}
+            for kb_id, slots in _kb_slots.items()
+            if slots.waiting or slots.running
+        },
+    }
+
+
+metrics.register_provider("vector_executor", vector_executor_stats)
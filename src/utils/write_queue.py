@@ -0,0 +1,160 @@
+import asyncio
+import logging
+import os
+import time
+from collections import deque
+from typing import Any, Callable, Deque, Dict, List, Optional
+
+from langchain_core.documents import Document
+
+from src.utils.metrics import metrics
+from src.utils.vector_executor import run_vector_write
+
+logger = logging.getLogger(__name__)
+
+# --- 知识库写入队列配置 ---
+# 一次合并写入的最大文档块数 (多个排队中的小写入合并为一次批量插入)
+WRITE_COALESCE_MAX_DOCS = int(os.getenv("WRITE_COALESCE_MAX_DOCS", 2000))
+# 开始写入前等待更多写入请求到达的时间 (毫秒)，0 表示只合并已在排队的请求
+WRITE_COALESCE_WAIT_MS = int(os.getenv("WRITE_COALESCE_WAIT_MS", 20))
+
+
+class _WriteRequest:
+    """一次排队中的写入：add 携带文档块，可与相邻的 add 合并；其他写入单独执行"""
+
+    def __init__(
+        self,
+        kind: str,
+        apply: Callable[..., Any],
+        documents: Optional[List[Document]] = None,
+    ):
+        self.kind = kind
+        self.apply = apply  # add: apply(documents)；其他: apply()
+        self.documents = documents or []
+        self.future: asyncio.Future = asyncio.get_running_loop().create_future()
+        self.enqueued_at = time.perf_counter()
+
+
+class KbWriteQueue:
+    """
+    单个知识库的写入队列：同一知识库的写入由一个写入协程按提交顺序串行执行，
+    不同知识库的写入互不等待。连续排队的 add 请求合并为一次批量插入
+    (一次批量嵌入 + 一次写入)，删除等其他写入作为屏障单独执行。
+    """
+
+    def __init__(self, kb_id: str):
+        self.kb_id = kb_id
+        self.pending: Deque[_WriteRequest] = deque()
+        self._writer: Optional[asyncio.Task] = None
+
+    @property
+    def depth(self) -> int:
+        return len(self.pending)
+
+    @property
+    def pending_docs(self) -> int:
+        return sum(len(request.documents) for request in self.pending)
+
+    async def submit(self, request: _WriteRequest) -> Any:
+        self.pending.append(request)
+        metrics.observe("write_queue_depth", self.depth)
+        if self._writer is None or self._writer.done():
+            self._writer = asyncio.ensure_future(self._drain())
+        # 调用方被取消时写入仍会完成，不影响队列中的其他请求
+        return await asyncio.shield(request.future)
+
+    def _take_batch(self) -> List[_WriteRequest]:
+        first = self.pending.popleft()
+        batch = [first]
+        if first.kind != "add":
+            return batch
+        docs = len(first.documents)
+        while (
+            self.pending
+            and self.pending[0].kind == "add"
+            and docs + len(self.pending[0].documents) <= WRITE_COALESCE_MAX_DOCS
+        ):
+            request = self.pending.popleft()
+            docs += len(request.documents)
+            batch.append(request)
+        return batch
+
+    async def _drain(self) -> None:
+        while self.pending:
+            if WRITE_COALESCE_WAIT_MS and self.pending[0].kind == "add":
+                await asyncio.sleep(WRITE_COALESCE_WAIT_MS / 1000)
+            batch = self._take_batch()
+            started_at = time.perf_counter()
+            for request in batch:
+                metrics.observe(
+                    "write_queue_wait_seconds", started_at - request.enqueued_at
+                )
+            await self._execute(batch)
+
+    async def _execute(self, batch: List[_WriteRequest]) -> None:
+        first = batch[0]
+        try:
+            if first.kind == "add":
+                documents = [doc for request in batch for doc in request.documents]
+                metrics.observe("write_batch_requests", len(batch))
+                metrics.observe("write_batch_docs", len(documents))
+                result = await run_vector_write(
+                    self.kb_id, "add", first.apply, documents
+                )
+            else:
+                result = await run_vector_write(self.kb_id, first.kind, first.apply)
+        except Exception as e:
+            if len(batch) > 1:
+                # 合并写入失败时逐个重试，只让出错的请求失败
+                logger.warning(
+                    f"知识库 {self.kb_id} 合并写入 {len(batch)} 个请求失败，逐个重试: {e}"
+                )
+                for request in batch:
+                    await self._execute([request])
+                return
+            metrics.incr("write_queue_errors_total", kind=first.kind)
+            if not first.future.done():
+                first.future.set_exception(e)
+            return
+        if len(batch) > 1:
+            logger.info(f"知识库 {self.kb_id} 合并 {len(batch)} 个写入请求为一次批量插入。")
+        for request in batch:
+            if not request.future.done():
+                request.future.set_result(result)
+
+
+_queues: Dict[str, KbWriteQueue] = {}
+
+
+def _queue_of(kb_id: str) -> KbWriteQueue:
+    queue = _queues.get(kb_id)
+    if queue is None:
+        queue = _queues[kb_id] = KbWriteQueue(kb_id)
+    return queue
+
+
+async def submit_add(
+    kb_id: str, documents: List[Document], apply: Callable[[List[Document]], Any]
+) -> Any:
+    """提交一次文档块写入；apply(documents) 在写入线程池中执行，可能收到合并后的更多文档"""
+    return await _queue_of(str(kb_id)).submit(_WriteRequest("add", apply, documents))
+
+
+async def submit_write(kb_id: str, kind: str, apply: Callable[[], Any]) -> Any:
+    """提交一次不可合并的写入 (如删除)，与该知识库的其他写入按提交顺序串行执行"""
+    return await _queue_of(str(kb_id)).submit(_WriteRequest(kind, apply))
+
+
+def write_queue_stats() -> Dict[str, Any]:
+    return {
+        "coalesce_max_docs": WRITE_COALESCE_MAX_DOCS,
+        "coalesce_wait_ms": WRITE_COALESCE_WAIT_MS,
+        "kbs": {
+            kb_id: {"depth": queue.depth, "pending_docs": queue.pending_docs}
+            for kb_id, queue in _queues.items()
+            if queue.depth
+        },
+    }
+
+
+metrics.register_provider("write_queue", write_queue_stats)